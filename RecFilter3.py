@@ -1,6 +1,5 @@
 #!/usr/bin/python
 import argparse
-import json
 import os
 import re
 import shutil
@@ -8,19 +7,32 @@ import signal
 import subprocess
 import sys
 import csv
-import atexit
 import datetime
 import time
-import yaml
+import threading
+import queue
+from collections import deque
+import cProfile
+import pstats
+import numpy as np
 from pathlib import Path
-from nudenet import NudeDetector
+from recfilter_detector import detect_batched, DetectorPool, shared_detector, model_version, native_scale_filter
+from recfilter_cache import file_identity, cache_key, load_entry, store_entry, default_cache_dir
+from recfilter_probe import probe_recording, load_index, store_index, keyframes_around
+from recfilter_analysis import write_analysis, load_analysis, sample_labels
+from recfilter_intervals import plan_segments, complement_segments, snap_segments
+from recfilter_server import connect_server, server_available, detect_served, run_server
+from recfilter_checkpoint import AnalysisJournal, write_marker, marker_matches
+from recfilter_profile import RunProfile
+from recfilter_presets import load_presets, resolve_presets, preset_suffix
+from recfilter_dedup import deduplicated
+from recfilter_fanout import run_fanout, fanout_args, preset_options, is_settings_code, settings_code_args
+from recfilter_cleanup import register_cleanup, unregister_cleanup
 
 MIN_PYTHON = (3, 7, 6)
 if sys.version_info < MIN_PYTHON:
   sys.exit("\nPython %s.%s.%s or later is required.\n" % MIN_PYTHON)
 
-detector = NudeDetector()
-
 def current_time():
   return time.strftime("%H:%M:%S", time.localtime())
 
@@ -52,7 +64,10 @@ def yes_or_quit():
       sys.exit()
     else: print("Please enter y or n.")
 
+#Set while an analysis that can be resumed is unfinished, its temporary files are kept then
+analysis_incomplete = False
 def clean_on_exit(path):
+  if analysis_incomplete: return
   if verbose: print('Deleting ' + str(path))
   if os.path.exists(path):
     if os.path.isdir(path):
@@ -61,9 +76,17 @@ def clean_on_exit(path):
 
 print('\n--- RecFilter3 ---')
 parser = argparse.ArgumentParser(prog='RecFilter', description='RecFilter: Remove SFW sections of videos')
-parser.add_argument('file', type=str, help='Video file to process')
+parser.add_argument('file', type=str, nargs='?', help='Video file to process')
 parser.add_argument('-i', '--interval', type=int, help='Interval between image samples (default: 5)')
+#refine adaptive boundary resolution precision accuracy
+parser.add_argument('-r', '--refine', type=int, help='Add samples around match borders until they are at most x seconds apart, 0 = off (default: 0)')
 #gap cut split slice separate pause break, merge bridge
+#scene change detection shot cut
+parser.add_argument('--scene', type=float, help='Sample at scene changes with a higher ffmpeg scene score than x, e.g. 0.3, and at least every interval seconds; 0 = fixed interval (default: 0)')
+parser.add_argument('--scene_min', type=int, help='Minimum seconds between scene change samples (default: 1)')
+#dedup duplicate static similar perceptual hash reuse
+parser.add_argument('--dedup', type=int, help='Reuse the detections of the last analysed sample for samples whose image hash differs in at most x of 64 bits, 0 = off (default: 0)')
+parser.add_argument('--dedup_max', type=int, help='Maximum number of samples in a row that reuse the same detections (default: 10)')
 parser.add_argument('-g', '--gap', type=int, help='Split segments more than x seconds apart (default: 30)')
 #extension extend expand enlarge elongate stretch broaden lengthen prolong widen protrude overhang attach reach radius scope sphere area keep range zone width span radius duration size resolution adjustment
 parser.add_argument('-e', '--extension', type=int, help='Extend start and end of segments by x seconds (default: 3)')
@@ -79,15 +102,41 @@ parser.add_argument('-c', '--category', type=str, help='Category of the preset,
 parser.add_argument('-w', '--wanted', type=str, help='Tags being used, seperated by comma')
 #unwanted unneeded exclude discard reject drop
 parser.add_argument('-u', '--unwanted', type=str, help='Tags being specifically excluded, seperated by comma')
+parser.add_argument('-m', '--min_score', type=float, help='Ignore detections with a lower score than x, e.g. 0.8 (default: 0)')
 #fast quick rapid
 parser.add_argument('-f', '--fast', action='store_true', help='Lower needed certainty for matches from 0.6 to 0.5 (default: False)')
 #negative inverse opposite transposed sfw
 parser.add_argument('-n', '--negative', default=False, action='store_true', help='Create compililation of all excluded segments too')
+parser.add_argument('--single_pass', default=False, action='store_true', help='Extract all segments in one pass over the source instead of one ffmpeg run per segment (default: False)')
+parser.add_argument('--smart_render', default=False, action='store_true', help='Cut frame accurately, only the frames between a cut and the nearest keyframe are encoded again (default: False)')
+parser.add_argument('--native_size', default=False, action='store_true', help='Let ffmpeg scale streamed frames to the size NudeNet analyses them at (default: False)')
+parser.add_argument('--batch_size', type=int, help='Number of samples NudeNet analyses in one pass (default: 8)')
+parser.add_argument('--workers', type=int, help='Number of NudeNet processes sharing the analysis (default: 1)')
+#follow live growing tail
+parser.add_argument('--follow', default=False, action='store_true', help='The recording is still being written, analyse it while it grows (default: False)')
+parser.add_argument('--follow_idle', type=int, help='With --follow the recording counts as finished after x seconds without growing (default: 60)')
+parser.add_argument('--nocache', default=False, action='store_true', help='Neither use nor update the analysis cache (default: False)')
 parser.add_argument('-l', '--logs', default=False, action='store_true', help='Keep the logs after every step (default: False)')
 parser.add_argument('-k', '--keep', default=False, action='store_true', help='Keep all temporary files (default: False)')
 #quiet silent batch unattended
 parser.add_argument('-q', '--quiet', default=False, action='store_true', help='No user interactions. E.g. for batch processing (default: False)')
 parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Output working information (default: False)')
+#profile profiling timing performance hotspots
+parser.add_argument('--profile', default=False, action='store_true', help='Record every Python function call with cProfile and keep the logs (default: False)')
+#daemon service watch queue server background
+parser.add_argument('--daemon', default=False, action='store_true', help='Keep running and process recordings from watched folders and --port, all other options are used for every job')
+parser.add_argument('--watch', type=str, action='append', help='Folder to watch in daemon mode, optionally with a preset: folder=preset')
+parser.add_argument('--port', type=int, help='Number of the daemon\'s socket, a local port on Windows. Without --daemon the file is handed to the daemon, if it is running')
+parser.add_argument('--jobs', type=int, help='Number of recordings the daemon processes at the same time (default: 1)')
+parser.add_argument('--server', default=False, action='store_true', help='Run the shared NudeNet inference server used by all other RecFilter3 runs, see --batch_size')
+parser.add_argument('--poll', type=int, help='Seconds between two scans of the watched folders (default: 10)')
+#batch many multiple files pipeline
+parser.add_argument('--batch', type=str, nargs='+', help='Process these recordings too, the next one is analysed while the last one is cut')
+#fanout several multiple presets codes outputs one analysis
+parser.add_argument('--fanout', type=str, nargs='+', help='Also cut the recording for these presets or settings codes, it is only sampled and analysed once. A settings code starts from the default preset, not from -p')
+#part of a batch or fan-out run, see recfilter_batch.py and recfilter_fanout.py
+parser.add_argument('--stage', choices=['analyse','cut','plan'], help=argparse.SUPPRESS)
+parser.add_argument('--plan_suffix', type=str, help=argparse.SUPPRESS)
 parser.add_argument('-1', '--images', action='append_const', dest='switches', const=1, help='Create sample images and allimages.txt with ffmpeg')
 parser.add_argument('-2', '--analyse', action='append_const', dest='switches', const=2, help='Create analysis.txt with NudeNet AI; Requires all_images.txt')
 parser.add_argument('-3', '--match', action='append_const', dest='switches', const=3, help='Create matched_images.txt; Requires analysis.txt')
@@ -97,15 +146,62 @@ parser.add_argument('-6', '--save', action='append_const', dest='switches', cons
 
 args = parser.parse_args()
 
+#Inference server, every RecFilter3 run on this machine sends its samples to it as long as it is running
+if args.server:
+  run_server(args.batch_size or 8)
+  sys.exit()
+
+#Daemon mode, every job runs this script again inside a long-running worker process
+if args.daemon:
+  from recfilter_daemon import run_daemon
+  daemon_folders = []
+  for folder in args.watch or []:
+    folder_name, separator, folder_preset = folder.rpartition('=')
+    if separator and folder_name and not re.search(r'[\\/]', folder_preset): daemon_folders.append((abspath(Path(folder_name)), folder_preset.lower()))
+    else: daemon_folders.append((abspath(Path(folder)), None))
+  if not (daemon_folders or args.port): sys.exit('\nERROR:  The daemon needs at least one --watch folder or a --port')
+  run_daemon(abspath(Path(sys.argv[0])), sys.argv[1:], daemon_folders, args.port, args.jobs or 1, args.poll or 10)
+  sys.exit()
+
+#Batch mode, every recording runs this script again in an analysis and a cutting worker process
+if args.batch:
+  from recfilter_batch import run_batch, batch_files, batch_args
+  if args.follow or args.switches or args.port or args.fanout: sys.exit('\nERROR:  --batch can\'t be combined with --follow, --port, --fanout or the step switches')
+  batch_recordings = batch_files(([args.file] if args.file else []) + args.batch)
+  missing = [recording for recording in batch_recordings if not Path(recording).is_file()]
+  if missing: sys.exit('\nERROR:  Recording not found: ' + missing[0])
+  failed = run_batch(abspath(Path(sys.argv[0])), batch_recordings, batch_args(sys.argv[1:], args.file))
+  if failed: sys.exit('\nERROR:  ' + str(failed) + ' of ' + str(len(batch_recordings)) + ' recordings failed')
+  sys.exit()
+if not args.file: parser.error('the following arguments are required: file')
+#Hand the recording to a running daemon instead of loading everything again
+if args.port:
+  from recfilter_daemon import submit, job_default_args
+  job_args = job_default_args(sys.argv[1:])
+  job_args.remove(args.file)
+  job_id = submit(args.port, [str(abspath(Path(args.file)))] + job_args)
+  if job_id: sys.exit(current_time() + ' INFO:  Queued as job ' + job_id + ' of the daemon on port ' + str(args.port))
+  print(current_time() + ' WARN:  No daemon is running on port ' + str(args.port) + ', processing the file directly')
+
+#Wall and CPU time of every step and subprocess, written to profile.json next to the logs
+run_profile = RunProfile()
+if args.profile:
+  python_profiler = cProfile.Profile()
+  python_profiler.enable()
+else: python_profiler = None
+
 #variables only in either command line or config
 video_name = Path(args.file)
 keep = args.keep
-logs = args.logs
+logs = args.logs or args.profile
 verbose = args.verbose
 create_negative = args.negative
 quiet = args.quiet
 keep_filedate = True
 move_original = ''
+#-q doesn't confirm unless the config allows it
+confirm_overwrite = False
+confirm_defaults = False
 
 # Default wanted is gender neutral, if a particular gender is required it can be entered into the config file per preset
 # Other terms can also be set in the config, see https://github.com/Jafea7/RecFilter3 for valid terms
@@ -129,6 +225,26 @@ if args.interval:
   sample_interval = args.interval
   commandline['interval'] = args.interval
 else: sample_interval = 5
+if args.refine:
+  sample_refine = args.refine
+  commandline['refine'] = args.refine
+else: sample_refine = 0
+if args.scene:
+  scene_threshold = args.scene
+  commandline['scene'] = args.scene
+else: scene_threshold = 0
+if args.scene_min:
+  scene_min_spacing = args.scene_min
+  commandline['scene_min'] = args.scene_min
+else: scene_min_spacing = 1
+if args.dedup:
+  sample_dedup = args.dedup
+  commandline['dedup'] = args.dedup
+else: sample_dedup = 0
+if args.dedup_max:
+  sample_dedup_max = args.dedup_max
+  commandline['dedup_max'] = args.dedup_max
+else: sample_dedup_max = 10
 if args.gap:
   segment_gap = args.gap
   commandline['gap'] = args.gap
@@ -155,10 +271,40 @@ if args.wanted:
 if args.unwanted:
   unwanted = args.unwanted.split(',')
   commandline['exclude'] =  args.unwanted
+if args.min_score:
+  min_score = args.min_score
+  commandline['min_score'] = args.min_score
+else: min_score = 0
 if args.fast:
   fastmode = args.fast
   commandline['fastmode'] =  args.fast
 else: fastmode = False
+if args.single_pass:
+  single_pass = args.single_pass
+  commandline['single_pass'] = args.single_pass
+else: single_pass = False
+if args.smart_render:
+  smart_render = args.smart_render
+  commandline['smart_render'] = args.smart_render
+else: smart_render = False
+if args.native_size:
+  native_size = args.native_size
+  commandline['native_size'] = args.native_size
+else: native_size = False
+create_segment_files = False
+if args.batch_size:
+  batch_size = args.batch_size
+  commandline['batch_size'] = args.batch_size
+else: batch_size = 8
+if args.workers:
+  workers = args.workers
+  commandline['workers'] = args.workers
+else: workers = 1
+use_cache = not args.nocache
+follow_recording = args.follow
+follow_idle = args.follow_idle or 60
+cache_size = 200 # MiB, 0 disables the analysis cache
+cache_dir = default_cache_dir
 
 #Initial path variables
 video_path = abspath(video_name) # Get the full video path
@@ -172,26 +318,25 @@ modification_time = os.stat(video_path).st_mtime_ns
 print('\n' + current_time() + ' INFO:  Input file: ')
 print(str(video_path))
 
-#Load config
+list_of_valid_config_keys = ['note','inherit','interval','refine','scene','scene_min','dedup','dedup_max','gap','duration','extension','category','include','exclude','min_score','startafter','stopbefore','filesuffix','videoext','fastmode','native_size','single_pass','smart_render','segment_files','batch_size','workers','cache_size','cache_dir','destination','move_original','rename_identical','move_identical','rename_noresult','move_noresult','move_segments','move_txt_files','confirm_overwrite','confirm_defaults','create_noresult_txt','create_identical_txt','keep_filedate']
+
+#Load config, the compiled presets are cached, so the yaml is only parsed again when the config changed
 config_path = Path(os.path.splitext(sys.argv[0])[0] + '.config')
+config_valid = False
 if config_path.exists() == False:
   print('\nWARN:  No config file \'%s\' found.' % config_path)
 else:
   try:
-    with open(config_path,"r") as f:
-      config = yaml.safe_load(f)
-      config_valid = True
+    with run_profile.stage('presets'):
+      preset_index = load_presets(config_path,list_of_valid_config_keys,default_cache_dir if use_cache and (cache_size > 0) else None,cache_size * 1048576)
+    config_valid = True
   except Exception as config_error: 
     print('\nERROR:  Config file ' + str(config_path) + ' is invalid. The following error occured: ')
     print(config_error)
-    config_valid = False
-  if config_path.exists() == False or config_valid == False:
-      print("Do you you want to continue with default arguments instead?")
-      yes_or_quit()
-
+    print("Do you you want to continue with default arguments instead?")
+    yes_or_quit()
 
-list_of_valid_config_keys = ['note','inherit','interval','gap','duration','extension','category','include','exclude','startafter','stopbefore','filesuffix','videoext','fastmode','destination','move_original','rename_identical','move_identical','rename_noresult','move_noresult','move_segments','move_txt_files','confirm_overwrite','confirm_defaults','create_noresult_txt','create_identical_txt','keep_filedate']
-main_settings_list = ['interval','gap','duration','extension','include','exclude','fastmode']
+main_settings_list = ['interval','gap','duration','extension','include','exclude','min_score','fastmode']
 main_settings = []
 other_settings = []
 
@@ -229,67 +374,59 @@ if config_valid and preset:
     else: return False
 
 #Check config keys for typos
-  for i in list(config.items()):
-    for j in i[1]:
-      if j in list_of_valid_config_keys: pass
-      else: sys.exit('\nERROR:  Config key ' + j + ' is invalid. Check for typos.')
-
-#Loop through all the config presets
-  inherit = ''
-  i = 0
-  while i < 2:
-    justinherited = False #reset re-loop trigger
-    for preset_name,preset_dict in config.items():
-      #skip presets that have already been applied
-      if (preset_name in presets_found) == False:
-        if (preset_name == preset) or (preset_name == inherit):
-          #reset inherit to an empty string once we were able to use it to get into the right preset
-          if preset_name == inherit: inherit = ''
-          #if category is used, the category has to match, otherwise only inherit allows entry
-          if (category == False) or (category and preset_dict.get('category') == category):
-            if write_config_value('inherit',str):
-              inherit = preset_dict.get('inherit')
-              justinherited = True #trigger to rerun preset loop
-            if write_config_value('code',str): code = preset_dict.get('code')
-            if write_config_value('interval',int): sample_interval = preset_dict.get('interval')
-            if write_config_value('gap',int): segment_gap = preset_dict.get('gap')
-            if write_config_value('extension',int): segment_extension = preset_dict.get('extension')
-            if write_config_value('duration',int): min_segment_duration = preset_dict.get('duration')
-            if write_config_value('include',str): wanted = preset_dict.get('include').split(',')
-            if write_config_value('exclude',str): unwanted = preset_dict.get('exclude').split(',')
-            if write_config_value('startafter',int): skip_begin = preset_dict.get('startafter')
-            if write_config_value('stopbefore',int): skip_finish = preset_dict.get('stopbefore')
-            if write_config_value('filesuffix',str): filesuffix_list.append(preset_dict.get('filesuffix'))
-            if write_config_value('code_suffix',bool): code_suffix = preset_dict.get('code_suffix')
-            if write_config_value('videoext',str): file_ext = preset_dict.get('videoext')
-            if write_config_value('fastmode',bool): fastmode = preset_dict.get('fastmode')
-            if write_config_value('destination','path'): destination = preset_dict.get('destination')
-            if write_config_value('tempdir','path'): tmpdir = preset_dict.get('tempdir')
-            if write_config_value('move_original','path'): move_original = abspath(preset_dict.get('move_original'))
-#            if write_config_value('move_tempdir','path'): move_tempdir = preset_dict.get('move_tempdir')
-#            if write_config_value('rename_identical','path'): rename_identical = preset_dict.get('rename_identical')
-#            if write_config_value('move_identical','path'): move_identical = preset_dict.get('move_identical')
-#            if write_config_value('rename_noresult','path'): rename_noresult = preset_dict.get('rename_noresult')
-#            if write_config_value('move_noresult','path'): move_noresult = preset_dict.get('move_noresult')
-#            if write_config_value('move_segments','path'): move_segments = preset_dict.get('move_segments')
-#            if write_config_value('move_txt_files','path'): move_segments = preset_dict.get('move_segments')
-            if write_config_value('confirm_overwrite',bool): confirm_overwrite = preset_dict.get('confirm_overwrite')
-#            if write_config_value('confirm_defaults',bool): confirm_defaults = preset_dict.get('confirm_defaults')
-#            if write_config_value('create_noresult_txt',bool): create_noresult_txt = preset_dict.get('create_noresult_txt')
-#            if write_config_value('create_identical_txt',bool): create_identical_txt = preset_dict.get('create_identical_txt')
-#            if write_config_value('create_contact_sheet',bool): create_contact_sheet = preset_dict.get('create_contact_sheet')
-            if write_config_value('keep_filedate',bool): keep_filedate = preset_dict.get('keep_filedate')
-            #note down used presets, so we can skip them
-            presets_found.append(preset_name)
-            #stop the loop once default was applied as a last possible inheritance
-            if 'default' in presets_found: break
-    #if it was the last preset and no inheritance has been set, inherit the default preset
-    if (i == 1) and inherit == '':
-      inherit = 'default'
-      justinherited = True
-    #If a preset inherits look through all presets again
-    if justinherited: i = 0
-    else: i+=1
+  if preset_index['invalid_key']: sys.exit('\nERROR:  Config key ' + preset_index['invalid_key'][1] + ' is invalid. Check for typos.')
+
+#Apply the preset and the presets it inherits, ending with default
+  try: resolved_presets = resolve_presets(preset_index,preset,category)
+  except ValueError as preset_error: sys.exit('\nERROR:  ' + str(preset_error))
+  for preset_name in resolved_presets:
+    preset_dict = preset_index['presets'][preset_name]['settings']
+    write_config_value('inherit',str)
+    if write_config_value('code',str): code = preset_dict.get('code')
+    if write_config_value('interval',int): sample_interval = preset_dict.get('interval')
+    if write_config_value('refine',int): sample_refine = preset_dict.get('refine')
+    if write_config_value('scene',float): scene_threshold = preset_dict.get('scene')
+    if write_config_value('scene_min',int): scene_min_spacing = preset_dict.get('scene_min')
+    if write_config_value('dedup',int): sample_dedup = preset_dict.get('dedup')
+    if write_config_value('dedup_max',int): sample_dedup_max = preset_dict.get('dedup_max')
+    if write_config_value('gap',int): segment_gap = preset_dict.get('gap')
+    if write_config_value('extension',int): segment_extension = preset_dict.get('extension')
+    if write_config_value('duration',int): min_segment_duration = preset_dict.get('duration')
+    if write_config_value('include',str): wanted = preset_dict.get('include').split(',')
+    if write_config_value('exclude',str): unwanted = preset_dict.get('exclude').split(',')
+    if write_config_value('min_score',float): min_score = preset_dict.get('min_score')
+    if write_config_value('startafter',int): skip_begin = preset_dict.get('startafter')
+    if write_config_value('stopbefore',int): skip_finish = preset_dict.get('stopbefore')
+    if write_config_value('filesuffix',str): filesuffix_list.append(preset_dict.get('filesuffix'))
+    if write_config_value('code_suffix',bool): code_suffix = preset_dict.get('code_suffix')
+    if write_config_value('videoext',str): file_ext = preset_dict.get('videoext')
+    if write_config_value('fastmode',bool): fastmode = preset_dict.get('fastmode')
+    if write_config_value('native_size',bool): native_size = preset_dict.get('native_size')
+    if write_config_value('single_pass',bool): single_pass = preset_dict.get('single_pass')
+    if write_config_value('smart_render',bool): smart_render = preset_dict.get('smart_render')
+    if write_config_value('segment_files',bool): create_segment_files = preset_dict.get('segment_files')
+    if write_config_value('batch_size',int): batch_size = preset_dict.get('batch_size')
+    if write_config_value('workers',int): workers = preset_dict.get('workers')
+    if write_config_value('cache_size',int): cache_size = preset_dict.get('cache_size')
+    if write_config_value('cache_dir',str): cache_dir = Path(preset_dict.get('cache_dir'))
+    if write_config_value('destination','path'): destination = preset_dict.get('destination')
+    if write_config_value('tempdir','path'): tmpdir = preset_dict.get('tempdir')
+    if write_config_value('move_original','path'): move_original = abspath(preset_dict.get('move_original'))
+#    if write_config_value('move_tempdir','path'): move_tempdir = preset_dict.get('move_tempdir')
+#    if write_config_value('rename_identical','path'): rename_identical = preset_dict.get('rename_identical')
+#    if write_config_value('move_identical','path'): move_identical = preset_dict.get('move_identical')
+#    if write_config_value('rename_noresult','path'): rename_noresult = preset_dict.get('rename_noresult')
+#    if write_config_value('move_noresult','path'): move_noresult = preset_dict.get('move_noresult')
+#    if write_config_value('move_segments','path'): move_segments = preset_dict.get('move_segments')
+#    if write_config_value('move_txt_files','path'): move_segments = preset_dict.get('move_segments')
+    if write_config_value('confirm_overwrite',bool): confirm_overwrite = preset_dict.get('confirm_overwrite')
+#    if write_config_value('confirm_defaults',bool): confirm_defaults = preset_dict.get('confirm_defaults')
+#    if write_config_value('create_noresult_txt',bool): create_noresult_txt = preset_dict.get('create_noresult_txt')
+#    if write_config_value('create_identical_txt',bool): create_identical_txt = preset_dict.get('create_identical_txt')
+#    if write_config_value('create_contact_sheet',bool): create_contact_sheet = preset_dict.get('create_contact_sheet')
+    if write_config_value('keep_filedate',bool): keep_filedate = preset_dict.get('keep_filedate')
+    #note down used presets
+    presets_found.append(preset_name)
  
   if preset.lower() not in presets_found:
     print('\n' + current_time() + ' INFO:  Preset \'' + preset + '\' not found.')
@@ -352,6 +489,12 @@ tag_codes = [
 (["14","16"],"EXPOSED_GENITALIA")
 ]
 
+#Exact labels every tag stands for, eg. EXPOSED_BREAST for EXPOSED_BREAST_F and EXPOSED_BREAST_M
+code_labels = {codes[0]: tag for codes, tag in tag_codes if len(codes) == 1}
+tag_label_map = {tag: [code_labels[code] for code in codes] for codes, tag in tag_codes}
+def tag_labels(tags):
+  return set(label for tag in tags if tag for label in tag_label_map.get(tag, [tag]))
+
 used_integers = []
 wanted_tag_codes = []
 unwanted_tag_codes = []
@@ -367,6 +510,9 @@ for j in main_settings:
     used_integers.append('e'+str(j[2]))
   if j[1] == 'fastmode':
     if j[2] == True: used_integers.append('f1')
+  #in thousandths, so the code stays made of letters and integers
+  if j[1] == 'min_score':
+    if j[2]: used_integers.append('m'+str(round(j[2]*1000)))
   if j[1] == 'include':
     for k in j[2].split(','):
       for i in tag_codes:
@@ -437,6 +583,7 @@ keyframe_interval = 1
 
 #derived path variables
 images_dir = Path(tmpdir) / 'images'
+images_complete_path = images_dir / 'complete'
 segments_dir = Path(tmpdir) / 'segments'
 excluded_segments_dir = Path(tmpdir) / 'excluded_segments'
 
@@ -444,8 +591,27 @@ excluded_segments_dir = Path(tmpdir) / 'excluded_segments'
 pushdir(Path(video_path).parent) 
 
 #Finding expected video duration in metadata till image creation gives an exact result
-ffprobe_cmd = subprocess.check_output('ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 -i "' + str(video_path) + '"', shell=True).decode()
-expected_duration_float = round(float(ffprobe_cmd),3)
+#The same ffprobe run indexes the keyframes for the edge frames of step 1 and the cuts of step 6, the index is cached until the recording changes
+#A recording that is still being written only gets its duration, it is indexed once it is complete
+recording_index = None
+def index_recording():
+  global recording_index
+  with run_profile.stage('probe'):
+    if use_cache and (cache_size > 0): recording_index = load_index(cache_dir,video_path)
+    if recording_index: run_profile.count('probe cache')
+    else:
+      recording_index = probe_recording(video_path)
+      if use_cache and (cache_size > 0): store_index(cache_dir,video_path,recording_index,cache_size * 1048576)
+  return recording_index
+
+try:
+  if follow_recording:
+    with run_profile.stage('probe'): expected_duration_float = round(probe_recording(video_path,packets=False)['duration'],3)
+  else: expected_duration_float = round(index_recording()['duration'],3)
+except (subprocess.CalledProcessError, ValueError):
+  #a recording that is still being written may not have a duration yet, step 1 finds the real one
+  if not follow_recording: raise
+  expected_duration_float = 0
 duration_float = expected_duration_float
 duration = int(round(duration_float))
 if verbose:
@@ -473,17 +639,20 @@ try:
     print('Text files will be kept as input for further processing.')
 #if the user didn't specify any sections run all sections
 except: code_sections = [1,2,3,4,5,6]
+#A batch runs the steps in two stages, the second one continues in the temporary folder of the first
+if args.stage == 'analyse': code_sections = [1,2,3,4]
+if args.stage == 'cut': code_sections = [5,6]
+#A fan-out plan matches and cuts with the analysis of the run it is fanned out from
+if args.stage == 'plan': code_sections = [3,4,5,6]
+if args.fanout and args.switches: sys.exit('\nERROR:  --fanout can\'t be combined with the step switches')
 
 # Creation of temporary folders
 print('\n' + current_time() + ' INFO:  Creating temporary directory ...')
-if Path(tmpdir).exists():
-    print('WARN:  The following temporary folder will be overwritten:')
-    print(abspath(tmpdir))
-    if (not quiet):
-      print('\nAre you sure you want to potentially overwrite previous results?')
-      yes_or_quit()
-    else:
-      if quiet and (not confirm_overwrite): sys.exit('confirm_overwrite = False')
+tmpdir_existed = False
+if args.stage in ('cut','plan'):
+  if not Path(tmpdir).exists(): sys.exit('\nERROR:  The temporary directory of the analysis is missing: ' + str(abspath(tmpdir)))
+#An existing temporary folder is only overwritten once it is clear that it holds no analysis this run can resume
+elif Path(tmpdir).exists(): tmpdir_existed = True
 else:
   try:
     os.mkdir(tmpdir)
@@ -491,18 +660,58 @@ else:
   except OSError: sys.exit('Creation of the temporary directory failed')
 print('\n')
 
-#Delete tmpdir again after program termination
-if keep == False and logs == False: atexit.register(clean_on_exit,tmpdir)
+#Delete tmpdir again after program termination, the run a plan is fanned out from deletes it
+def register_tmpdir_cleanup():
+  if keep == False and logs == False and args.stage != 'plan': register_cleanup(clean_on_exit,tmpdir)
+if not tmpdir_existed: register_tmpdir_cleanup()
 
 # Filenames used
 all_images_txt_path = os.path.join(tmpdir, 'all_images.txt')
 analysis_txt_path = os.path.join(tmpdir, 'analysis.txt')
+analysis_npz_path = os.path.join(tmpdir, 'analysis.npz')
 matched_images_txt_path = os.path.join(tmpdir, 'matched_images.txt')
+matched_images_npy_path = os.path.join(tmpdir, 'matched_images.npy')
 cuts_txt_path = os.path.join(tmpdir, 'cuts.txt')
 segments_txt_path = os.path.join(tmpdir, 'segments.txt')
 excluded_segments_txt_path = os.path.join(tmpdir, 'excluded_segments.txt')
+analysis_journal_path = os.path.join(tmpdir, 'analysis_journal.txt')
+analysis_complete_path = os.path.join(tmpdir, 'analysis_complete')
+if args.stage: profile_json_path = os.path.join(tmpdir, 'profile_' + args.stage + '.json')
+else: profile_json_path = os.path.join(tmpdir, 'profile.json')
+python_profile_path = os.path.join(tmpdir, 'profile.prof')
+python_profile_txt_path = os.path.join(tmpdir, 'profile.txt')
 if filesuffix_list: addtofilename = ''.join(reversed(filesuffix_list)).replace(' ', '_')
 else: addtofilename = ''
+#A settings code of a fan-out is cut without the preset of its run, but named after it
+if args.plan_suffix: addtofilename = args.plan_suffix
+#Every plan cuts into folders of its own, so -k keeps the segments of all of them
+if args.stage == 'plan':
+  segments_dir = Path(tmpdir) / ('segments_plan' + addtofilename)
+  excluded_segments_dir = Path(tmpdir) / ('excluded_segments_plan' + addtofilename)
+
+#Fan-out plans, each one is cut from the analysis of this run with its own preset or settings code
+#Plans must not write the same output files as this run or another plan
+fanout_plans = []
+if args.fanout and not args.stage:
+  plan_base_args = [str(video_path)] + fanout_args(sys.argv[1:],args.file) + ['--stage','plan','-q']
+  code_base_args = [str(video_path)] + fanout_args(sys.argv[1:],args.file,preset_options) + ['--stage','plan','-q']
+  if args.category: plan_category = args.category.lower()
+  else: plan_category = False
+  plan_suffixes = {addtofilename: 'this run'}
+  for plan in args.fanout:
+    if is_settings_code(plan):
+      plan_suffix = addtofilename + '_' + plan
+      try: plan_args = code_base_args + settings_code_args(plan,code_labels) + ['--plan_suffix=' + plan_suffix]
+      except ValueError as code_error: sys.exit('\nERROR:  ' + str(code_error))
+    else:
+      plan = plan.lower()
+      plan_args = plan_base_args + ['-p',plan]
+      if not (config_valid and (plan in preset_index['presets'])): sys.exit('\nERROR:  Preset ' + plan + ' of --fanout not found')
+      try: plan_suffix = preset_suffix(preset_index,plan,plan_category)
+      except ValueError as preset_error: sys.exit('\nERROR:  ' + str(preset_error))
+    if plan_suffix in plan_suffixes: sys.exit('\nERROR:  --fanout ' + plan + ' would write the same files as ' + plan_suffixes[plan_suffix] + ', it needs another filesuffix')
+    plan_suffixes[plan_suffix] = plan
+    fanout_plans.append((plan, plan_args))
 
 def recreate(txt,dir = None):
   if dir is not None:
@@ -512,10 +721,452 @@ def recreate(txt,dir = None):
   #Delete previously created output txt to rerun steps
   if Path(txt).exists(): os.remove(txt)
   #Delete txt again in case of program termination
-  if keep == False and logs == False: atexit.register(clean_on_exit,txt)
+  if keep == False and logs == False: register_cleanup(clean_on_exit,txt)
+
+#Written at the end of every run that keeps its temporary folder, also when a step ends it early
+#Without -k / -l the folder is deleted right after, unless an interrupted analysis is left in it
+def write_profile():
+  if keep == False and logs == False and not analysis_incomplete: return
+  if python_profiler:
+    python_profiler.disable()
+    python_profiler.dump_stats(python_profile_path)
+    with open(python_profile_txt_path,"w") as profile_txt:
+      pstats.Stats(python_profiler,stream=profile_txt).sort_stats('cumulative').print_stats(60)
+  try: run_profile.write(profile_json_path,{'file': str(video_path), 'arguments': sys.argv[1:]})
+  except OSError: return
+  if verbose or python_profiler: print(current_time() + ' INFO:  Profile written to ' + str(profile_json_path))
+register_cleanup(write_profile)
+
+#Yields (key, NudeNet detections) for (key, image file or BGR frame) items
+#batch_size samples are analysed in one pass of the model, with more than one worker each has its own model
+#A running inference server is preferred over a model of our own
+#The worker processes of --workers are started by the first call and kept for the refinement and follow rounds
+detector_pool = None
+def detect_samples(items):
+  global detector_pool
+  if fastmode: mode = 'fast'
+  else: mode = 'default'
+  inference_server = connect_server()
+  if inference_server: return run_profile.timed('inference',detect_served(inference_server, items, batch_size, mode, native_side))
+  if workers > 1:
+    if detector_pool is None:
+      detector_pool = DetectorPool(workers, batch_size, mode, native_side)
+      register_cleanup(detector_pool.close)
+    return run_profile.timed('inference',detector_pool.detect(items))
+  else: return run_profile.timed('inference',detect_batched(shared_detector(), items, batch_size, mode, native_side))
+
+#With --dedup a sample that looks like the last analysed one gets its detections, yields (key, detections, reused from key or None)
+def detect_new_samples(items):
+  if sample_dedup > 0: return deduplicated(items, detect_samples, sample_dedup, sample_dedup_max)
+  return ((key, detections, None) for key, detections in detect_samples(items))
+
+#Names of the samples that reused the detections of another sample, with the name of that sample
+reused_samples = {}
+
+def sorted_labels(detections):
+  return sorted([entry['label'] for entry in detections])
+
+#Tags of a sample in analysis.txt, a sample that reused the detections of another one is marked with its name
+def analysis_tags(name,detections):
+  if name in reused_samples: return ' '.join(sorted_labels(detections) + ['reused:' + reused_samples[name]])
+  return ' '.join(sorted_labels(detections))
+
+#Journal entries carry the name of the reused sample as well
+def journal_sample(timestamp,name,detections):
+  if name in reused_samples: return [timestamp, name, detections, reused_samples[name]]
+  return [timestamp, name, detections]
+
+#Same decision as step 3 for a single sample
+def sample_matches(detections):
+  labels = set(entry['label'] for entry in detections if entry['score'] >= min_score)
+  if labels & tag_labels(unwanted): return False
+  return bool(labels & tag_labels(wanted))
+
+use_inference_server = ((1 in code_sections) or (2 in code_sections)) and server_available()
+if use_inference_server:
+  print(current_time() + ' INFO:  Samples are analysed by the running inference server')
+
+#Sample frames are piped straight into NudeNet unless the images are needed on disk afterwards
+stream_frames = (keep == False) and (not args.switches)
+if follow_recording:
+  if not stream_frames: sys.exit('\nERROR:  --follow can\'t be combined with -k / --keep or the step switches')
+  if skip_finish:
+    print(current_time() + ' WARN:  --stopbefore is ignored with --follow, the final duration is unknown')
+    skip_finish = 0
+  #the recording's identity changes while it grows
+  use_cache = False
+frame_detections = {}
+
+#Sample selection of step 1
+#Fixed interval: one keyframe per second is picked by the fps filter, duplicates are dropped, every interval-th second is kept
+#Scene changes: a keyframe is kept if its scene score to the previous keyframe is above the threshold and at least scene_min_spacing
+#seconds passed since the last sample, or if interval seconds passed without one, so sample spacing is uneven
+if scene_threshold > 0:
+  sample_ffmpeg_prefilters = ''
+  sample_ffmpeg_select = 'if(isnan(prev_selected_t),1,if(gte(t-prev_selected_t,' + str(sample_interval) + '),1,gt(scene,' + str(scene_threshold) + ')*gte(t-prev_selected_t,' + str(scene_min_spacing) + ')))'
+else:
+  sample_ffmpeg_prefilters = 'fps=1,mpdecimate,'
+  sample_ffmpeg_select = 'not(mod(t,' + str(sample_interval) + '))'
+
+#Frames handed to NudeNet without image files are resized like the sample images
+if fastmode: max_side_length = 800
+else: max_side_length = 1280
+frame_ffmpeg_resize = 'scale=\'' + str(max_side_length) + ':' + str(max_side_length) + ':force_original_aspect_ratio=decrease\''
+#With --native_size ffmpeg scales the frames straight to the size NudeNet analyses them at, instead of NudeNet resizing them again
+#The boxes still refer to the sample size
+native_side = None
+if native_size and stream_frames:
+  if fastmode: frame_ffmpeg_resize = native_scale_filter('fast')
+  else: frame_ffmpeg_resize = native_scale_filter('default')
+  native_side = max_side_length
+frame_ffmpeg_rawvideo = ['-vsync','0','-an','-f','rawvideo','-pix_fmt','bgr24','-']
+
+showinfo_pts_pattern = re.compile(r' pts: *([0-9\-]+) ')
+showinfo_pos_pattern = re.compile(r' pos: *([0-9]+) ')
+showinfo_size_pattern = re.compile(r' s:([0-9]+)x([0-9]+) ')
+showinfo_time_base_pattern = re.compile(r'\[(Parsed_showinfo_[0-9]+) @ [^\]]*\] config in time_base: *([0-9]+)/([0-9]+)')
+
+#pts are counted in the time base of the filter, Matroska uses milliseconds, MP4 eg. 1/15360 seconds
+def pts_to_timestamp(pts,time_base=(1,1000)):
+  if time_base == (1,1000): return pts.zfill(4)[:-3]+'.'+pts.zfill(4)[-3:]
+  return '%.3f' % (int(pts) * time_base[0] / time_base[1])
+
+#Cut positions are whole seconds unless they were moved to a keyframe, eg. 56 or 93.923344
+#Keyframes keep the microseconds of ffprobe, rounded to milliseconds a 90 kHz timestamp could fall in front of its keyframe
+def cut_time(seconds):
+  return ('%.6f' % seconds).rstrip('0').rstrip('.')
+
+#Cut position in the name of a segment file, the whole seconds have 7 digits so the names sort by time
+def segment_time(seconds):
+  whole, point, fraction = cut_time(seconds).partition('.')
+  return whole.zfill(7) + point + fraction
+
+#Yields (timestamp,width,height) of every frame leaving the filters as soon as ffmpeg prints its showinfo line
+#paired: the first showinfo sits in front of the fps filter and delivers the real timestamps by byte position
+# Positions only grow, so the input frames up to an output frame are dropped and the table stays as small as the interval.
+#Other lines of stderr end up in other_lines
+def showinfo_frames(stderr,paired,other_lines):
+  input_table = {}
+  time_bases = {}
+  for line in iter(stderr.readline, b''):
+    line = line.decode(errors='replace')
+    if ('Parsed_showinfo_' in line) and ('pts:' in line):
+      pts = showinfo_pts_pattern.search(line).group(1)
+      time_base = time_bases.get(line[line.index('Parsed_showinfo_'):].split(' ',1)[0],(1,1000))
+      if paired and ('Parsed_showinfo_0' in line):
+        input_table[int(showinfo_pos_pattern.search(line).group(1))] = pts_to_timestamp(pts,time_base)
+      else:
+        if paired:
+          position = int(showinfo_pos_pattern.search(line).group(1))
+          timestamp = input_table[position]
+          while input_table and (next(iter(input_table)) <= position): del input_table[next(iter(input_table))]
+        else: timestamp = pts_to_timestamp(pts,time_base)
+        size = showinfo_size_pattern.search(line)
+        yield timestamp, int(size.group(1)), int(size.group(2))
+    elif 'config in time_base:' in line:
+      time_base = showinfo_time_base_pattern.search(line)
+      if time_base: time_bases[time_base.group(1)] = (int(time_base.group(2)),int(time_base.group(3)))
+    else: other_lines.append(line)
+
+#Run an ffmpeg command that writes images, the showinfo frames are yielded while ffmpeg is still writing
+def ffmpeg_showinfo(cmd,paired):
+  if verbose: print(subprocess.list2cmdline(cmd))
+  ffmpeg_process = subprocess.Popen(cmd,stdout=subprocess.DEVNULL,stderr=subprocess.PIPE)
+  ffmpeg_stderr = deque(maxlen=10)
+  yield from showinfo_frames(ffmpeg_process.stderr,paired,ffmpeg_stderr)
+  if ffmpeg_process.wait() != 0:
+    print(''.join(ffmpeg_stderr))
+    sys.exit('\nERROR:  ffmpeg failed while creating sample images')
+
+#Read bgr24 frames from ffmpeg's stdout while a thread reads the matching showinfo lines from stderr
+#paired: see showinfo_frames()
+#check: exit if ffmpeg fails, otherwise the frames read until then are all there is
+#ahead: number of frames a thread reads in advance, so ffmpeg keeps decoding while the frames before are analysed.
+#The pipe alone holds less than one frame, ffmpeg would wait for every batch of NudeNet otherwise.
+def ffmpeg_frames(cmd,paired,check=True,ahead=1):
+  if verbose: print(subprocess.list2cmdline(cmd))
+  ffmpeg_process = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+  frame_info = queue.Queue()
+  ffmpeg_stderr = deque(maxlen=10)
+  def read_showinfo():
+    try:
+      for info in showinfo_frames(ffmpeg_process.stderr,paired,ffmpeg_stderr): frame_info.put(info)
+    finally: frame_info.put(None)
+  showinfo_thread = threading.Thread(target=read_showinfo,daemon=True)
+  showinfo_thread.start()
+  frames = queue.Queue(maxsize=ahead)
+  def read_frames():
+    try:
+      while True:
+        info = frame_info.get()
+        if info is None: break
+        timestamp, width, height = info
+        frame_size = width * height * 3
+        frame_bytes = ffmpeg_process.stdout.read(frame_size)
+        if len(frame_bytes) < frame_size: break
+        frames.put((timestamp, np.frombuffer(frame_bytes,dtype=np.uint8).reshape(height,width,3)))
+    finally: frames.put(None)
+  frame_thread = threading.Thread(target=read_frames,daemon=True)
+  frame_thread.start()
+  try:
+    while True:
+      frame = frames.get()
+      if frame is None: break
+      yield frame
+  finally:
+    #when the frames are not read to the end, ffmpeg is stopped and the reader thread let go
+    if frame_thread.is_alive():
+      ffmpeg_process.kill()
+      while frame_thread.is_alive():
+        try: frames.get(timeout=0.1)
+        except queue.Empty: pass
+  frame_thread.join()
+  ffmpeg_process.stdout.close()
+  showinfo_thread.join()
+  if (ffmpeg_process.wait() != 0) and check:
+    print(''.join(ffmpeg_stderr))
+    sys.exit('\nERROR:  ffmpeg failed while streaming sample frames')
+
+#Timestamp of the exact first or last frame step 1 needs, known without decoding from -a / -b or the index
+#None if only ffmpeg can tell, ie. the end of a followed recording
+def edge_frame_target(first):
+  if first:
+    if skip_begin and skip_begin > 0: return skip_begin
+    if recording_index: return recording_index['first_pts']
+  else:
+    if skip_finish and (skip_finish > 0): return duration_float-skip_finish
+    if recording_index: return recording_index['last_pts']
+  return None
+
+#Settings that decide which samples step 1 takes
+sampling_settings = {'interval': sample_interval, 'fastmode': fastmode, 'startafter': skip_begin, 'stopbefore': skip_finish}
+if scene_threshold > 0: sampling_settings.update({'scene': scene_threshold, 'scene_min': scene_min_spacing})
+if native_side: sampling_settings['native_size'] = True
+#Settings that decide the detections of the samples
+analysis_settings = dict(sampling_settings,model=model_version())
+if sample_dedup > 0: analysis_settings['dedup'] = [sample_dedup, sample_dedup_max]
+#A fan-out plan can only use the analysis if it would have sampled and analysed the recording the same way
+if (args.stage == 'plan') and not marker_matches(analysis_complete_path,cache_key({},analysis_settings)):
+  sys.exit('\nERROR:  The analysis was made with other sampling settings, eg. interval, scene, fastmode or dedup, than this preset uses')
+
+#An interrupted analysis of the same recording with the same sampling settings is resumed from its journal
+#Complete sample images of step 1 are marked with the same recording and settings, so they can be used again
+analysis_journal = None
+sample_images_key = None
+if ((1 in code_sections) or (2 in code_sections)) and not follow_recording:
+  recording_identity = file_identity(video_path)
+  sample_images_key = cache_key(recording_identity,sampling_settings)
+  analysis_journal = AnalysisJournal(analysis_journal_path,cache_key(recording_identity,analysis_settings))
+
+if tmpdir_existed:
+  if analysis_journal and (analysis_journal.load() or marker_matches(images_complete_path,sample_images_key)):
+    print(current_time() + ' INFO:  Resuming the unfinished analysis in the temporary folder:')
+    print(abspath(tmpdir))
+  else:
+    print('WARN:  The following temporary folder will be overwritten:')
+    print(abspath(tmpdir))
+    if (not quiet):
+      print('\nAre you sure you want to potentially overwrite previous results?')
+      yes_or_quit()
+    else:
+      if quiet and (not confirm_overwrite): sys.exit('confirm_overwrite = False')
+  register_tmpdir_cleanup()
+
+def note_interrupted_analysis():
+  if analysis_incomplete:
+    print('\n' + current_time() + ' INFO:  The analysis is unfinished, it is resumed when RecFilter3 is run again with the same options')
+    print(abspath(tmpdir))
+register_cleanup(note_interrupted_analysis)
+
+#Steps 1 and 2 are served from the analysis cache when the recording was sampled with the same settings before
+analysis_cache_key = None
+if use_cache and (cache_size > 0) and (1 in code_sections) and (2 in code_sections):
+  analysis_cache_settings = dict(analysis_settings)
+  #refined samples depend on what matched
+  if sample_refine > 0: analysis_cache_settings.update({'refine': sample_refine, 'include': wanted, 'exclude': unwanted, 'min_score': min_score})
+  analysis_cache_key = cache_key(recording_identity,analysis_cache_settings)
+  #--keep wants the sample images, so they have to be created again
+  if not keep: cached_analysis = load_entry(cache_dir,analysis_cache_key)
+  else: cached_analysis = None
+  if cached_analysis:
+    run_profile.count('analysis cache',len(cached_analysis['samples']))
+    print(current_time() + ' INFO:  Step 1+2 of 6: Found the analysis of ' + str(len(cached_analysis['samples'])) + ' samples in the cache')
+    recreate(all_images_txt_path)
+    recreate(analysis_txt_path)
+    recreate(analysis_npz_path)
+    reused_samples.update(cached_analysis.get('reused',{}))
+    with open(all_images_txt_path,"w", newline='') as all_images_txt, open(analysis_txt_path,"w",newline='') as analysis_txt:
+      image_csv = csv.writer(all_images_txt,delimiter=' ')
+      for timestamp, name, detections in cached_analysis['samples']:
+        image_csv.writerow([timestamp,name])
+        analysis_txt.write(timestamp + ' ' + name + ' ' + analysis_tags(name,detections) + '\n')
+    write_analysis(analysis_npz_path,cached_analysis['samples'],reused_samples)
+    duration_float = cached_analysis['duration']
+    duration = int(round(duration_float))
+    code_sections = [section for section in code_sections if section > 2]
+    analysis_cache_key = None
+
+
+if 1 in code_sections and stream_frames: #on/off switch for code
+  run_profile.enter('step 1')
+  if fastmode: print(current_time() + ' INFO:  Step 1 of 6: Fast mode activated:')
+  if fastmode and not native_side: print(current_time() + ' INFO:  Step 1 of 6: Frames will be resized to a max side length of ' + str(max_side_length) )
+  if native_side: print(current_time() + ' INFO:  Step 1 of 6: Frames are scaled to the input size of NudeNet by ffmpeg')
+  print(current_time() + ' INFO:  Step 1 of 6: Streaming sample frames from ffmpeg into NudeNet...')
+  if workers > 1 and not use_inference_server: print(current_time() + ' INFO:  Step 1 of 6: Analysis is spread over ' + str(workers) + ' NudeNet processes')
 
+#Create clean folders/files, no images_dir is needed
+  recreate(all_images_txt_path)
+  os.chdir(tmpdir)
+
+#ffmpeg frame streaming, see the image creation below for the reasoning behind the options
+  if skip_finish: image_ffmpeg_stop = ['-t',str(duration_float-skip_finish)]
+  else: image_ffmpeg_stop = []
+  image_ffmpeg_inputoptions = ['-y','-skip_frame','nokey','-copyts','-avoid_negative_ts','disabled']
+  if skip_begin and skip_begin > 0: image_ffmpeg_inputoptions += ['-ss',str(skip_begin)]
+  image_ffmpeg_filters = 'showinfo,' + sample_ffmpeg_prefilters + 'select=\'' + sample_ffmpeg_select + '\',' + frame_ffmpeg_resize + ',showinfo'
+  image_ffmpeg_cmd = ['ffmpeg'] + image_ffmpeg_inputoptions + ['-i',str(video_path),'-vf',image_ffmpeg_filters] + image_ffmpeg_stop + frame_ffmpeg_rawvideo
+
+  #Yields ((name, timestamp), frame) for all samples of sample_cmd
+  #Frames get the same names the image files would have, so all following steps work unchanged
+  image_timestamps = []
+  def sample_frames(sample_cmd,check=True):
+    for timestamp, frame in run_profile.timed('sampling decode',ffmpeg_frames(sample_cmd,True,check,2 * batch_size)):
+      #a followed recording is sampled again from its last sample on, which is skipped
+      if image_timestamps and float(timestamp) <= float(image_timestamps[-1]): continue
+      image_timestamps.append(timestamp)
+      yield (str(len(image_timestamps)).zfill(7) + '.jpg',timestamp), frame
+
+  #Yields the exact last and first frame if ffmpeg's fps filter missed them
+  def edge_frames():
+    if not image_timestamps: sys.exit('Streaming sample frames failed')
+
+   #Exact last frame (not a keyframe)
+    last_target = edge_frame_target(False)
+    if (last_target is not None) and (float(image_timestamps[-1]) >= last_target):
+      if verbose: print('skipped last frame, because ffmpeg fps filter created it already')
+    else:
+      if last_target is not None: image_ffmpeg_last_cmd = ['ffmpeg','-y','-copyts','-avoid_negative_ts','disabled','-ss',str(last_target),'-i',str(video_path),'-vframes','1','-vf',frame_ffmpeg_resize + ',showinfo'] + frame_ffmpeg_rawvideo
+      else: image_ffmpeg_last_cmd = ['ffmpeg','-y','-copyts','-avoid_negative_ts','disabled','-ss',image_timestamps[-1],'-i',str(video_path),'-vf',frame_ffmpeg_resize + ',showinfo'] + frame_ffmpeg_rawvideo
+      last_frame = None
+      for last_frame in run_profile.timed('last frame',ffmpeg_frames(image_ffmpeg_last_cmd,False)): pass
+      if last_frame:
+        if float(last_frame[0]) > float(image_timestamps[-1]):
+          image_timestamps.append(last_frame[0])
+          yield (str(len(image_timestamps)).zfill(7) + '.jpg',last_frame[0]), last_frame[1]
+        elif verbose: print('skipped last frame, because ffmpeg fps filter created it already')
+      else:
+        if skip_finish and (skip_finish > 0):
+          sys.exit('Finding the last timestamp failed. Make sure the video has correct metadata for the total duration, since -b / --stopbefore is dependend on it. Should the duration be incorrect you should still be able to process the video without -b / --stopbefore.')
+        else: sys.exit('Finding the last timestamp failed')
+
+   #Exact first frame (not a keyframe)
+    if '0000000.jpg' in frame_detections: return
+    first_target = edge_frame_target(True)
+    if (first_target is not None) and (float(image_timestamps[0]) <= first_target):
+      if verbose: print('skipped first frame, because ffmpeg fps filter created it already')
+      return
+    image_ffmpeg_first_cmd = ['ffmpeg','-y','-copyts','-avoid_negative_ts','disabled']
+    if skip_begin and skip_begin > 0: image_ffmpeg_first_cmd += ['-ss',str(skip_begin)]
+    image_ffmpeg_first_cmd += ['-i',str(video_path),'-vframes','1','-vf',frame_ffmpeg_resize + ',showinfo'] + frame_ffmpeg_rawvideo
+    first_frame = None
+    for first_frame in run_profile.timed('first frame',ffmpeg_frames(image_ffmpeg_first_cmd,False)): pass
+    if first_frame:
+      if float(first_frame[0]) < float(image_timestamps[0]):
+        yield ('0000000.jpg',first_frame[0]), first_frame[1]
+      elif verbose: print('skipped first frame, because ffmpeg fps filter created it already')
+    else: sys.exit('Finding the first timestamp failed')
 
-if 1 in code_sections: #on/off switch for code
+  streamed_frames = []
+  def analyse_frames(frames):
+    for (name, timestamp), detections, reused_from in detect_new_samples(frames):
+      if reused_from: reused_samples[name] = reused_from[0]
+      if analysis_journal: analysis_journal.append(journal_sample(timestamp,name,detections))
+      frame_detections[name] = detections
+      streamed_frames.append((name,timestamp))
+      if not verbose: print(current_time() + ' INFO:  Step 2 of 6: Sample frames analysed: ' + str(len(streamed_frames)),end='\r')
+      else: print(name + ' ' + timestamp + ' ' + analysis_tags(name,detections))
+
+  #Samples of an interrupted run are taken over, sampling continues after the last one
+  if analysis_journal:
+    for sample in sorted(analysis_journal.load(),key=lambda sample: sample[1]):
+      timestamp, name, detections = sample[:3]
+      if len(sample) > 3: reused_samples[name] = sample[3]
+      frame_detections[name] = detections
+      streamed_frames.append((name,timestamp))
+      if name != '0000000.jpg': image_timestamps.append(timestamp)
+    if streamed_frames: print(current_time() + ' INFO:  Step 1 of 6: Resuming the interrupted analysis after ' + str(len(streamed_frames)) + ' samples at ' + str(datetime.timedelta(0, round(float(image_timestamps[-1])))))
+    analysis_journal.start([journal_sample(timestamp, name, frame_detections[name]) for name, timestamp in streamed_frames])
+    analysis_incomplete = True
+
+  def all_frames():
+    if image_timestamps: yield from sample_frames(['ffmpeg','-y','-skip_frame','nokey','-copyts','-avoid_negative_ts','disabled','-ss',image_timestamps[-1],'-i',str(video_path),'-vf',image_ffmpeg_filters] + image_ffmpeg_stop + frame_ffmpeg_rawvideo)
+    else: yield from sample_frames(image_ffmpeg_cmd)
+    yield from edge_frames()
+
+  #Sample whatever was added to the recording since the last round, until it stops growing
+  #cuts.txt always holds the cut plan of everything analysed so far
+  if follow_recording:
+    print(current_time() + ' INFO:  Step 1 of 6: Following the recording until it didn\'t grow for ' + str(follow_idle) + ' seconds')
+    recording_size = -1
+    unchanged_since = time.time()
+    while True:
+      current_size = os.path.getsize(video_path)
+      if current_size != recording_size:
+        recording_size = current_size
+        unchanged_since = time.time()
+        if image_timestamps: follow_resume = ['-ss',image_timestamps[-1]]
+        elif skip_begin and skip_begin > 0: follow_resume = ['-ss',str(skip_begin)]
+        else: follow_resume = []
+        follow_ffmpeg_cmd = ['ffmpeg','-y','-skip_frame','nokey','-copyts','-avoid_negative_ts','disabled'] + follow_resume + ['-i',str(video_path),'-vf',image_ffmpeg_filters] + frame_ffmpeg_rawvideo
+        #the end of a recording that is being written can be incomplete
+        analyse_frames(sample_frames(follow_ffmpeg_cmd,False))
+        if image_timestamps:
+          follow_matches = [int(round(float(timestamp))) for name, timestamp in streamed_frames if sample_matches(frame_detections[name])]
+          segment_starts, segment_ends = plan_segments(follow_matches,segment_extension,segment_gap + 2 * keyframe_interval,min_segment_duration,float(image_timestamps[-1]))
+          with open(cuts_txt_path,"w") as cuts_txt:
+            for beginning, ending in zip(segment_starts.tolist(),segment_ends.tolist()):
+              cuts_txt.write(cut_time(beginning) + ' ' + cut_time(ending) + ' ' + str(datetime.timedelta(0, beginning)) + ' ' + str(datetime.timedelta(0, ending)) + '\n')
+          print(current_time() + ' INFO:  Step 1 of 6: Analysed ' + str(int(float(image_timestamps[-1]))) + ' seconds of the recording, ' + str(len(segment_starts)) + ' segments so far')
+      elif time.time() - unchanged_since >= follow_idle: break
+      time.sleep(min(10, follow_idle))
+    analyse_frames(edge_frames())
+  else: analyse_frames(all_frames())
+
+ # Set duration and duration float to the actual values
+  duration_float = round(float(image_timestamps[-1]),3)
+  duration = int(round(duration_float))
+  if verbose:
+    print('\n' + current_time() + ' INFO:  Confirmed duration of input video: ')
+    print(str(duration) + ' seconds')
+
+  with open(all_images_txt_path,"w", newline='') as all_images_txt:
+    image_csv = csv.writer(all_images_txt,delimiter=' ')
+    for name, timestamp in sorted(streamed_frames):
+      image_csv.writerow([timestamp,name])
+  print(current_time() + ' INFO:  Step 1 of 6: Finished streaming ' + str(len(streamed_frames)) + ' sample frames.\n')
+  os.chdir(startdir)
+  run_profile.exit()
+
+#Sample images of an earlier run are used again if they were completed with the same recording and settings
+def sample_images_complete():
+  if not (sample_images_key and marker_matches(images_complete_path,sample_images_key) and Path(all_images_txt_path).exists()): return False
+  with open(all_images_txt_path,"r") as all_images_txt:
+    for line in all_images_txt:
+      if line.strip() and not (images_dir / line.split()[1]).exists(): return False
+  return True
+reuse_sample_images = (1 in code_sections) and (not stream_frames) and sample_images_complete()
+
+if reuse_sample_images:
+  with open(all_images_txt_path,"r") as all_images_txt:
+    image_timestamps = sorted(float(line.split()[0]) for line in all_images_txt if line.strip())
+  duration_float = round(image_timestamps[-1],3)
+  duration = int(round(duration_float))
+  print(current_time() + ' INFO:  Step 1 of 6: Using the ' + str(len(image_timestamps)) + ' complete sample images of an earlier run.\n')
+  analysis_incomplete = True
+
+if 1 in code_sections and not stream_frames and not reuse_sample_images: #on/off switch for code
+  run_profile.enter('step 1')
   if fastmode: max_side_length = 800
   else: max_side_length = 1280
   if fastmode: print(current_time() + ' INFO:  Step 1 of 6: Fast mode activated:')
@@ -531,72 +1182,54 @@ if 1 in code_sections: #on/off switch for code
 # When using the fps filter it can choose the same keyframe for two or more different seconds. To drop duplicates the mpdecimate filter is needed.
   with open(all_images_txt_path,"w", newline='') as all_images_txt:
     image_ffmpeg_filenames = '%07d.jpg'
-    image_ffmpeg_inputpath = '-i "'+ str(video_path) + '"'
-    if fastmode: image_ffmpeg_resize = "',scale=\'" + str(max_side_length) + ":" + str(max_side_length) + ":force_original_aspect_ratio=decrease\'"
-    else: image_ffmpeg_resize = "',scale=\'" + str(max_side_length) + ":" + str(max_side_length) + ":force_original_aspect_ratio=decrease\'"
-    if skip_finish: image_ffmpeg_stop = ' -t ' + str(duration_float-skip_finish)
-    else: image_ffmpeg_stop =  ' '
-    if skip_begin and skip_begin > 0: image_ffmpeg_inputoptions = ' -y -skip_frame nokey -copyts -avoid_negative_ts disabled -ss ' + str(skip_begin)
-    else: image_ffmpeg_inputoptions = ' -y -skip_frame nokey -copyts -avoid_negative_ts disabled'
+    image_ffmpeg_inputpath = ['-i',str(video_path)]
+    if skip_finish: image_ffmpeg_stop = ['-t',str(duration_float-skip_finish)]
+    else: image_ffmpeg_stop = []
+    image_ffmpeg_inputoptions = ['-y','-skip_frame','nokey','-copyts','-avoid_negative_ts','disabled']
+    if skip_begin and skip_begin > 0: image_ffmpeg_inputoptions += ['-ss',str(skip_begin)]
     #showinfo has to be used before and after the fps function to get correct timestamps
-    image_ffmpeg_filters = ' -vf "showinfo,fps=1,mpdecimate,select=\'not(mod(t,' + str(sample_interval) + '))' + image_ffmpeg_resize + ',showinfo"'
-    image_ffmpeg_outputoptions = image_ffmpeg_stop + ' -vsync 0 -muxpreload 0 -muxdelay 0 -an -qmin 1 -q:v 1'
-    image_ffmpeg_cmd = 'ffmpeg' + image_ffmpeg_inputoptions + ' ' + image_ffmpeg_inputpath + image_ffmpeg_filters + image_ffmpeg_outputoptions + ' ' + image_ffmpeg_filenames
-
-    
+    image_ffmpeg_filters = ['-vf','showinfo,' + sample_ffmpeg_prefilters + 'select=\'' + sample_ffmpeg_select + '\',' + frame_ffmpeg_resize + ',showinfo']
+    image_ffmpeg_jpeg = ['-vsync','0','-muxpreload','0','-muxdelay','0','-an','-qmin','1','-q:v','1']
+    image_ffmpeg_cmd = ['ffmpeg'] + image_ffmpeg_inputoptions + image_ffmpeg_inputpath + image_ffmpeg_filters + image_ffmpeg_stop + image_ffmpeg_jpeg + [image_ffmpeg_filenames]
 
    #Create images with ffmpeg fps filter
-    if verbose: print(image_ffmpeg_cmd)
-    #For some reason ffmpeg sends its showinfo output to stderr instead of stdout
-    image_ffmpeg_output = subprocess.run(image_ffmpeg_cmd,check=True,capture_output=True,text=True)
-
+   #For some reason ffmpeg sends its showinfo output to stderr instead of stdout, it is read line by line while the images are written
    #Identify image timestamps
    # https://stackoverflow.com/questions/51325158/ffmpeg-timestamp-information-using-fps-filter-isnt-aligned-with-ffprobe
     image_timestamps = []
-    input_frames_lines = []
-    fps_filter_frames_lines = []
-    input_table = {}
-    output_positions = []
-
-    for line in image_ffmpeg_output.stderr.splitlines():
-      if ('Parsed_showinfo_0' in line) and ('pts:' in line):
-        input_frames_lines.append(line)
-      elif ('Parsed_showinfo_' in line) and ('pts:' in line):
-        fps_filter_frames_lines.append(line)
-
-    for line in input_frames_lines:
-      input_timestamp = re.search(r' pts: *([0-9\-]+) ',str(line)).group(1)
-      input_position = re.search(r' pos: *([0-9]+) ',str(line)).group(1)
-      if input_timestamp and input_position:
-        input_table[input_position] = input_timestamp.zfill(4)[:-3]+'.'+input_timestamp.zfill(4)[-3:]
-    for line in fps_filter_frames_lines:
-      output_position = re.search(r' pos: *([0-9]+) ',str(line)).group(1)
-      if output_position: output_positions.append(output_position)
-    for pos in output_positions:
-      image_timestamps.append(input_table[pos])
+    for timestamp, width, height in run_profile.timed('sampling decode',ffmpeg_showinfo(image_ffmpeg_cmd,True)):
+      #showinfo still sees the frames behind -t, which are not written
+      if skip_finish and (float(timestamp) >= duration_float-skip_finish): continue
+      image_timestamps.append(timestamp)
+      if not verbose: print(current_time() + ' INFO:  Step 1 of 6: Sample images created: ' + str(len(image_timestamps)) + ' (' + str(datetime.timedelta(seconds=int(float(timestamp)))) + ' of ' + str(datetime.timedelta(seconds=duration)) + ')',end='\r')
+    if not verbose: print()
+    if not image_timestamps: sys.exit('\nERROR:  ffmpeg did not create any sample images')
 
    #Create an exact last image (not a keyframe)
    # https://superuser.com/a/1448673
-    if skip_finish and (skip_finish > 0):
-        image_ffmpeg_last_cmd = 'ffmpeg' + ' -y -copyts -avoid_negative_ts disabled -ss ' + str(duration_float-skip_finish) + ' ' + image_ffmpeg_inputpath + ' ' + image_ffmpeg_stop + ' -vframes 1 -vf "showinfo" -vsync 0 -muxpreload 0 -muxdelay 0 -an -qmin 1 -q:v 1' + ' ' + str(len(image_timestamps)+1).zfill(7) + '.jpg'
-    else: 
-      image_ffmpeg_last_cmd = 'ffmpeg' + ' -y -copyts -avoid_negative_ts disabled -ss ' + image_timestamps[-1] + ' ' + image_ffmpeg_inputpath  + ' -update 1 -vf "showinfo" -vsync 0 -muxpreload 0 -muxdelay 0 -an -qmin 1 -q:v 1' + ' ' + str(len(image_timestamps)+1).zfill(7) + '.jpg'
-    if verbose: print(image_ffmpeg_last_cmd)
-    image_ffmpeg_last_output = subprocess.run(image_ffmpeg_last_cmd,check=True,capture_output=True,text=True)
-    last_timestamp = ''
-    for line in image_ffmpeg_last_output.stderr.splitlines():
-      if ('Parsed_showinfo_' in line) and ('pts:' in line):
-        last_timestamp = re.search(r' pts: *([0-9\-]+) ',str(line)).group(1)
-    if last_timestamp:
-      if float(last_timestamp) > float(image_timestamps[-1]):
-        image_timestamps.append(last_timestamp.zfill(4)[:-3]+'.'+last_timestamp.zfill(4)[-3:])
-      else:
-        os.remove(str(len(image_timestamps)+1).zfill(7) + '.jpg')
-        if verbose: print('deleted last frame again, because ffmpeg fps filter created it already')
+    last_target = edge_frame_target(False)
+    if (last_target is not None) and (float(image_timestamps[-1]) >= last_target):
+      if verbose: print('skipped last frame, because ffmpeg fps filter created it already')
     else:
-      if skip_finish and (skip_finish > 0):
-        sys.exit('Finding the last timestamp failed. Make sure the video has correct metadata for the total duration, since -b / --stopbefore is dependend on it. Should the duration be incorrect you should still be able to process the video without -b / --stopbefore.')
-      else: sys.exit('Finding the last timestamp failed')
+      if last_target is not None:
+        image_ffmpeg_last_cmd = ['ffmpeg','-y','-copyts','-avoid_negative_ts','disabled','-ss',str(last_target)] + image_ffmpeg_inputpath + ['-vframes','1','-vf','showinfo'] + image_ffmpeg_jpeg + [str(len(image_timestamps)+1).zfill(7) + '.jpg']
+      else:
+        image_ffmpeg_last_cmd = ['ffmpeg','-y','-copyts','-avoid_negative_ts','disabled','-ss',image_timestamps[-1]] + image_ffmpeg_inputpath + ['-update','1','-vf','showinfo'] + image_ffmpeg_jpeg + [str(len(image_timestamps)+1).zfill(7) + '.jpg']
+      last_timestamp = ''
+      with run_profile.stage('last frame'):
+        #-vframes 1 writes the first frame, -update 1 overwrites the image with every frame
+        for timestamp, width, height in ffmpeg_showinfo(image_ffmpeg_last_cmd,False):
+          if not (last_timestamp and (last_target is not None)): last_timestamp = timestamp
+      if last_timestamp:
+        if float(last_timestamp) > float(image_timestamps[-1]):
+          image_timestamps.append(last_timestamp)
+        else:
+          os.remove(str(len(image_timestamps)+1).zfill(7) + '.jpg')
+          if verbose: print('deleted last frame again, because ffmpeg fps filter created it already')
+      else:
+        if skip_finish and (skip_finish > 0):
+          sys.exit('Finding the last timestamp failed. Make sure the video has correct metadata for the total duration, since -b / --stopbefore is dependend on it. Should the duration be incorrect you should still be able to process the video without -b / --stopbefore.')
+        else: sys.exit('Finding the last timestamp failed')
    # Set duration and duration float to the actual values
     duration_float = round(float(image_timestamps[-1]),3)
     duration = int(round(duration_float))
@@ -606,23 +1239,25 @@ if 1 in code_sections: #on/off switch for code
 
    #Create an exact first image (not a keyframe)
    # https://trac.ffmpeg.org/ticket/5093
-    if skip_begin and skip_begin > 0:
-      image_ffmpeg_first_cmd = 'ffmpeg' + ' -y -copyts -avoid_negative_ts disabled -ss ' + str(skip_begin) + ' ' + image_ffmpeg_inputpath + ' -vframes 1 -vf "showinfo" -vsync 0 -muxpreload 0 -muxdelay 0 -an -qmin 1 -q:v 1 0000000.jpg'
-    else: 
-      image_ffmpeg_first_cmd = 'ffmpeg' + ' -y -copyts -avoid_negative_ts disabled ' + image_ffmpeg_inputpath + ' -vframes 1 -vf "showinfo" -vsync 0 -muxpreload 0 -muxdelay 0 -an -qmin 1 -q:v 1 0000000.jpg'
-    if verbose: print(image_ffmpeg_first_cmd)
-    image_ffmpeg_first_output = subprocess.run(image_ffmpeg_first_cmd,check=True,capture_output=True,text=True)
-    first_timestamp = ''
-    for line in image_ffmpeg_first_output.stderr.splitlines():
-      if ('Parsed_showinfo_' in line) and ('pts:' in line):
-        first_timestamp = re.search(r' pts: *([0-9\-]+) ',str(line)).group(1)
-    if first_timestamp:
-      if float(first_timestamp) < float(image_timestamps[0]):
-        image_timestamps.insert(0,first_timestamp.zfill(4)[:-3]+'.'+first_timestamp.zfill(4)[-3:])
+    first_target = edge_frame_target(True)
+    if (first_target is not None) and (float(image_timestamps[0]) <= first_target):
+      if verbose: print('skipped first frame, because ffmpeg fps filter created it already')
+    else:
+      if skip_begin and skip_begin > 0:
+        image_ffmpeg_first_cmd = ['ffmpeg','-y','-copyts','-avoid_negative_ts','disabled','-ss',str(skip_begin)] + image_ffmpeg_inputpath + ['-vframes','1','-vf','showinfo'] + image_ffmpeg_jpeg + ['0000000.jpg']
       else:
-        os.remove('0000000.jpg')
-        if verbose: print('deleted first frame again, because ffmpeg fps filter created it already')
-    else: sys.exit('Finding the first timestamp failed')
+        image_ffmpeg_first_cmd = ['ffmpeg','-y','-copyts','-avoid_negative_ts','disabled'] + image_ffmpeg_inputpath + ['-vframes','1','-vf','showinfo'] + image_ffmpeg_jpeg + ['0000000.jpg']
+      first_timestamp = ''
+      with run_profile.stage('first frame'):
+        for timestamp, width, height in ffmpeg_showinfo(image_ffmpeg_first_cmd,False):
+          if not first_timestamp: first_timestamp = timestamp
+      if first_timestamp:
+        if float(first_timestamp) < float(image_timestamps[0]):
+          image_timestamps.insert(0,first_timestamp)
+        else:
+          os.remove('0000000.jpg')
+          if verbose: print('deleted first frame again, because ffmpeg fps filter created it already')
+      else: sys.exit('Finding the first timestamp failed')
 
     image_csv = csv.writer(all_images_txt,delimiter=' ')
     file_list = sorted([f for f in os.listdir(images_dir) if re.search(r'[0-9]{7}.jpg', f)])
@@ -633,69 +1268,188 @@ if 1 in code_sections: #on/off switch for code
       image_count +=1
   print(current_time() + ' INFO:  Step 1 of 6: Finished creating ' + str(image_count) + ' sample images.\n')    
   os.chdir(startdir)
+  #the samples of an analysis journal may not be the new images
+  if analysis_journal: analysis_journal.remove()
+  if sample_images_key:
+    write_marker(images_complete_path,sample_images_key)
+    analysis_incomplete = True
+  run_profile.exit()
 
 if 2 in code_sections: #on/off switch for code
+  run_profile.enter('step 2')
   if fastmode: print(current_time() + ' INFO:  Step 2 of 6: Fast mode for NudeNet was activated')
-  print(current_time() + ' INFO:  Step 2 of 6: Analysing images with NudeNet ...')
+  if workers > 1 and not (stream_frames or use_inference_server): print(current_time() + ' INFO:  Step 2 of 6: Analysis is spread over ' + str(workers) + ' NudeNet processes')
+  if stream_frames: print(current_time() + ' INFO:  Step 2 of 6: Writing results of the streamed frames ...')
+  else: print(current_time() + ' INFO:  Step 2 of 6: Analysing images with NudeNet ...')
 
 #Create clean folders/files
   recreate(analysis_txt_path)
-  os.chdir(images_dir)
+  recreate(analysis_npz_path)
+  if not stream_frames: os.chdir(images_dir)
 
   #Delete previously created output to rerun steps
   if Path(analysis_txt_path).exists(): os.remove(analysis_txt_path)
   #Delete analysis.txt again in case of program termination
-  if keep == False and logs == False: atexit.register(clean_on_exit,analysis_txt_path)
+  if keep == False and logs == False: register_cleanup(clean_on_exit,analysis_txt_path)
   #Load images into NudeNet for analysis
   with open(all_images_txt_path,"r") as all_images_txt, open(analysis_txt_path,"w",newline='') as analysis_txt:
 #    images = [line.rstrip('\n') for line in all_images_txt]
     image_lines = []
     for row in csv.reader(all_images_txt): image_lines.append(row[0])
-    tags =[]
+    def image_name(image_line):
+      return re.search(r'[0-9]{7}\.jpg', image_line).group()
+    #streamed frames were already analysed in step 1
+    if stream_frames: analysed_images = frame_detections
+    else:
+      #images analysed by an interrupted run are taken from its journal, every new result is added to it at once
+      analysed_images = {}
+      if analysis_journal:
+        listed_lines = set(image_lines)
+        journal_samples = [sample for sample in analysis_journal.load() if sample[0] + ' ' + sample[1] in listed_lines]
+        for sample in journal_samples:
+          analysed_images[sample[1]] = sample[2]
+          if len(sample) > 3: reused_samples[sample[1]] = sample[3]
+        if analysed_images: print(current_time() + ' INFO:  Step 2 of 6: Resuming the interrupted analysis after ' + str(len(analysed_images)) + ' out of ' + str(len(image_lines)) + ' images')
+        analysis_journal.start(journal_samples)
+        analysis_incomplete = True
+      z = len(analysed_images)
+      for image_line, detections, reused_from in detect_new_samples((image_line, image_name(image_line)) for image_line in image_lines if image_name(image_line) not in analysed_images):
+        if reused_from: reused_samples[image_name(image_line)] = image_name(reused_from)
+        if analysis_journal: analysis_journal.append(journal_sample(*image_line.split(' '),detections))
+        analysed_images[image_name(image_line)] = detections
+        z += 1
+        if not verbose: print(current_time() + ' INFO:  Step 2 of 6: Sample images analysed: ' + str(z) + ' out of ' + str(len(image_lines)),end='\r')
+    analysed_samples = []
     z = 0
     for image_line in image_lines:
-      image_path = re.search(r'[0-9]{7}\.jpg', image_line).group()
-      #correcting wrong json output from NudeNet
-      if fastmode: json_string = str(detector.detect(image_path, mode='fast')).replace("'",'"')
-      else: json_string = str(detector.detect(image_path)).replace("'",'"')
-      for entry in json.loads(json_string):
-        tags.append(entry['label'])
-      tag_line = image_line + ' ' + ' '.join(sorted(tags)) + '\n'
+      detections = analysed_images[image_name(image_line)]
+      analysed_samples.append(image_line.split(' ') + [detections])
+      tag_line = image_line + ' ' + analysis_tags(image_name(image_line),detections) + '\n'
       analysis_txt.write(tag_line)
       if verbose: print(tag_line)
-      tags.clear()
       z += 1
-      if not verbose: print(current_time() + ' INFO:  Step 2 of 6: Sample images analysed: ' + str(z) + ' out of ' + str(len(image_lines)),end='\r')
+
+  #Coarse to fine: bisect every gap between a matching and a non matching sample until it is at most sample_refine seconds wide
+  #The exact frame at the middle of the gap is taken like the exact first frame in step 1
+  if sample_refine > 0 and analysed_samples:
+    def refine_sample(seek,name):
+      refine_ffmpeg_inputoptions = ['ffmpeg','-y','-copyts','-avoid_negative_ts','disabled','-ss',seek,'-i',str(video_path),'-vframes','1']
+      if stream_frames:
+        refine_frames = list(run_profile.timed('refine frames',ffmpeg_frames(refine_ffmpeg_inputoptions + ['-vf',frame_ffmpeg_resize + ',showinfo'] + frame_ffmpeg_rawvideo,False)))
+        if refine_frames: return refine_frames[0]
+        return None
+      refine_ffmpeg_cmd = refine_ffmpeg_inputoptions + ['-vf','showinfo','-vsync','0','-muxpreload','0','-muxdelay','0','-an','-qmin','1','-q:v','1',name]
+      refine_images = list(run_profile.timed('refine frames',ffmpeg_showinfo(refine_ffmpeg_cmd,False)))
+      if refine_images: return refine_images[0][0], name
+      return None
+
+    sample_count = max(int(sample[1][:7]) for sample in analysed_samples)
+    closed_gaps = set()
+    refine_round = 0
+    while True:
+      analysed_samples.sort(key=lambda sample: float(sample[0]))
+      refine_items = []
+      for before, after in zip(analysed_samples, analysed_samples[1:]):
+        if (before[1], after[1]) in closed_gaps: continue
+        if float(after[0]) - float(before[0]) <= sample_refine: continue
+        if sample_matches(before[2]) == sample_matches(after[2]): continue
+        sample_count += 1
+        name = str(sample_count).zfill(7) + '.jpg'
+        refined = refine_sample('%.3f' % ((float(before[0]) + float(after[0])) / 2),name)
+        #keyframe distance or a variable frame rate can put the exact frame outside of the gap, which can't be narrowed any further then
+        if (refined is None) or not (float(before[0]) < float(refined[0]) < float(after[0])):
+          closed_gaps.add((before[1], after[1]))
+          if (refined is not None) and not stream_frames: os.remove(name)
+          continue
+        refine_items.append(((refined[0], name), refined[1]))
+      if not refine_items: break
+      refine_round += 1
+      if verbose: print(current_time() + ' INFO:  Step 2 of 6: Refinement round ' + str(refine_round) + ': ' + str(len(refine_items)) + ' samples')
+      for (timestamp, name), detections in detect_samples(refine_items):
+        analysed_samples.append([timestamp, name, detections])
+        z += 1
+        if verbose: print(timestamp + ' ' + name + ' ' + ' '.join(sorted_labels(detections)))
+    if refine_round:
+      print(current_time() + ' INFO:  Step 2 of 6: Refined match borders to ' + str(sample_refine) + ' seconds in ' + str(refine_round) + ' rounds')
+      #all_images.txt and analysis.txt list the added samples in timestamp order
+      with open(all_images_txt_path,"w", newline='') as all_images_txt, open(analysis_txt_path,"w",newline='') as analysis_txt:
+        image_csv = csv.writer(all_images_txt,delimiter=' ')
+        for timestamp, name, detections in analysed_samples:
+          image_csv.writerow([timestamp,name])
+          analysis_txt.write(timestamp + ' ' + name + ' ' + analysis_tags(name,detections) + '\n')
+  #analysis.txt is the readable export, the following steps use the scores and boxes in analysis.npz
+  write_analysis(analysis_npz_path,analysed_samples,reused_samples)
   print(current_time() + ' INFO:  Step 2 of 6: Finished analysing ' + str(z) + ' images with NudeNet')
+  if reused_samples:
+    run_profile.count('dedup',len(reused_samples))
+    print(current_time() + ' INFO:  Step 2 of 6: ' + str(len(reused_samples)) + ' of them looked like the sample analysed before them and reused its detections')
+  if analysis_cache_key:
+    store_entry(cache_dir,analysis_cache_key,{'duration': duration_float, 'samples': analysed_samples, 'reused': reused_samples},cache_size * 1048576)
+  #the analysis is complete, nothing is left to resume
+  if analysis_journal: analysis_journal.remove()
+  analysis_incomplete = False
   
   #images_dir can be deleted if analysation has been finished
-  if keep == False: atexit.register(clean_on_exit,images_dir)
+  if keep == False: register_cleanup(clean_on_exit,images_dir)
   os.chdir(startdir)
+  run_profile.exit()
+
+
+#The duration confirmed by step 1 is the time of the last sample
+if args.stage in ('cut','plan'):
+  with open(all_images_txt_path,"r") as all_images_txt:
+    duration_float = round(max(float(row[0]) for row in csv.reader(all_images_txt,delimiter=' ') if row),3)
+  duration = int(round(duration_float))
 
+#The analysis is complete, every plan of the fan-out is matched and cut before this run goes on with its own
+if fanout_plans and (3 in code_sections):
+  write_marker(analysis_complete_path,cache_key({},analysis_settings))
+  fanout_failed = run_fanout(abspath(Path(sys.argv[0])),fanout_plans)
+  if fanout_failed: print(current_time() + ' WARN:  Fan-out: ' + str(fanout_failed) + ' of ' + str(len(fanout_plans)) + ' plans failed')
 
 if 3 in code_sections: #on/off switch for code
+  run_profile.enter('step 3')
   print('\n' + current_time() + ' INFO:  Step 3 of 6: Finding selected tags ...')
 
 #Create clean folders/files
   recreate(matched_images_txt_path)
+  recreate(matched_images_npy_path)
   os.chdir(tmpdir)
 
+  #analysis.txt is only used if it was edited by hand after analysis.npz was written, or if there is no analysis.npz
+  use_analysis_npz = Path(analysis_npz_path).exists() and ((not Path(analysis_txt_path).exists()) or os.path.getmtime(analysis_npz_path) >= os.path.getmtime(analysis_txt_path))
+  if min_score and not use_analysis_npz: print(current_time() + ' WARN:  Step 3 of 6: min_score is ignored, analysis.txt has no scores')
+
   match_count = 0
-  with open(analysis_txt_path,"r") as analysis_txt, open(matched_images_txt_path,"w") as matched_images_txt:
-    for line in analysis_txt:
-      foundtags = False
-      for check in wanted:
-        if check in line:
-          foundtags = True
-          for uncheck in unwanted:
-            #string has to be nonempty, otherwise "empty in nonempty" will always uncheck
-            if uncheck: 
-              if uncheck in line:
-                foundtags = False
-                break #one unwanted tag is enough to exclude the whole line
-      if foundtags:
-        matched_images_txt.write(line)
-        match_count +=1
+  if use_analysis_npz:
+    analysis = load_analysis(analysis_npz_path)
+    #every sample gets one bit per class it shows, a tag selects the bits of its exact labels, NudeNet has less than 64 classes
+    def tag_bits(tags):
+      return sum(1 << i for i, name in enumerate(analysis['classes']) if str(name) in tag_labels(tags))
+    detected = analysis['score'] >= min_score
+    sample_bits = np.zeros(len(analysis['timestamps']), dtype=np.uint64)
+    np.bitwise_or.at(sample_bits,analysis['sample'][detected],np.left_shift(np.uint64(1),analysis['label'][detected].astype(np.uint64)))
+    #one unwanted tag is enough to exclude the whole sample
+    matched = ((sample_bits & np.uint64(tag_bits(wanted))) != 0) & ((sample_bits & np.uint64(tag_bits(unwanted))) == 0)
+    matched_samples = np.flatnonzero(matched)
+    with open(matched_images_txt_path,"w") as matched_images_txt:
+      for index in matched_samples:
+        matched_images_txt.write('%.3f' % analysis['timestamps'][index] + ' ' + analysis['names'][index] + ' ' + ' '.join(sample_labels(analysis,index)) + '\n')
+    np.save(matched_images_npy_path,analysis['timestamps'][matched_samples])
+    match_count = len(matched_samples)
+    #close the memory maps, open files can't be deleted on Windows
+    del analysis
+  else:
+    wanted_labels = tag_labels(wanted)
+    unwanted_labels = tag_labels(unwanted)
+    with open(analysis_txt_path,"r") as analysis_txt, open(matched_images_txt_path,"w") as matched_images_txt:
+      for line in analysis_txt:
+        #the labels follow timestamp and name, one unwanted label is enough to exclude the whole line
+        labels = set(line.split()[2:])
+        foundtags = bool(labels & wanted_labels) and not (labels & unwanted_labels)
+        if foundtags:
+          matched_images_txt.write(line)
+          match_count +=1
   print(current_time() + ' INFO:  Step 3 of 6: Found selected tags in ' + str(match_count) + ' images.')
   if match_count == 0:
     os.chdir(startdir)
@@ -704,68 +1458,58 @@ if 3 in code_sections: #on/off switch for code
       info_txt.write(infotext)
     sys.exit(infotext)
   os.chdir(startdir)
+  run_profile.exit()
 
 
+#Smart rendering encodes the frames at the cuts with the encoder of the recording's codec, other codecs are cut at keyframes
+smart_encoders = {'h264': ['libx264','-preset','veryfast','-crf','18'], 'hevc': ['libx265','-preset','veryfast','-crf','20']}
+def check_smart_render():
+  global smart_render
+  codec = (recording_index or index_recording())['video'].get('codec_name')
+  if codec not in smart_encoders:
+    print(current_time() + ' WARN:  Smart rendering does not support ' + str(codec) + ' videos, segments are cut at keyframes')
+    smart_render = False
+
 if 4 in code_sections: #on/off switch for code
+  run_profile.enter('step 4')
   print('\n' + current_time() + ' INFO:  Step 4 of 6: Finding cut positions ...')  
+  if smart_render: check_smart_render()
 
 #Create clean folders/files
   recreate(cuts_txt_path)
   os.chdir(tmpdir)
 
+  #matched_images.txt is only used if it was edited by hand after matched_images.npy was written
+  use_matched_npy = Path(matched_images_npy_path).exists() and os.path.getmtime(matched_images_npy_path) >= os.path.getmtime(matched_images_txt_path)
   with open(matched_images_txt_path,"r") as matched_images_txt, open(cuts_txt_path,"w") as cuts_txt:
-    for line in matched_images_txt:
-      imagelist.append(int(round(float(re.match(r'[0-9\.\-]+', line).group()))))
-    #Remove timestamp doubles and make sure the timestamps are in ascending order
-    sorted(list(set(imagelist)))
-    found_segment_start = False
-    for i in range(0,len(imagelist)):
-# variables
-      last_element = len(imagelist) - 1
-      #avoid using elements not existent in list
-      if i == 0: gap_to_prev_match = 0
-      else: gap_to_prev_match = imagelist[i] - imagelist[i - 1]
-      if i == last_element: gap_to_next_match = 0
-      else: gap_to_next_match = imagelist[i + 1] - imagelist[i]
-      segment_start = imagelist[i] - segment_extension
-      segment_end = imagelist[i] + segment_extension
-      #different parts making up a cut inbetween sample images, where the resulting segments need to be split apart
-      #extension and a safety margin to make up for ffmpeg jumping to the closest keyframe during a cut on both ends
-      #this will avoid segment overlaps. default keyframe interval is set to 1.
-      cut_duration = segment_gap + 2 * segment_extension + 2 * keyframe_interval
-
-# case for finding the start of a segment
-      #if first element has matches in reach become beginning
-      #or if previous match is too far away
-      if (i == 0 and gap_to_next_match <= cut_duration) or (gap_to_prev_match > cut_duration):
-        #save beginning timestamp
-        if segment_start >= 0: b = segment_start #segment_extension only if timestamp doesn't become negative
-        else: 
-          b = 0 #otherwise use 0 as a beginning
-        found_segment_start = True
-# case for finding the end of a segment and finalizing it
-      #if next match is too far away
-      #if last element while previous match is close
-      if (gap_to_next_match > cut_duration) or (i == last_element and gap_to_prev_match <= cut_duration):
-        #save ending timestamp, only include segment_extension if timestamp doesn't exceed file duration
-        if duration > segment_end: e = segment_end
-        else: e = duration
-        if found_segment_start:
-          segment_duration = e - b
-          #finalize segment
-          #only finalize if the result would have a positive duration
-          #only finalize segment if long enough
-          if (segment_duration > 0) and (segment_duration >= min_segment_duration):
-            beginnings.append(b)
-            endings.append(e)
-
-    # else go to next sample without doing anything
+    if use_matched_npy: matched_times = np.load(matched_images_npy_path,mmap_mode='r')
+    else: matched_times = np.array([float(re.match(r'[0-9\.\-]+', line).group()) for line in matched_images_txt])
+    imagelist += [int(round(float(timestamp))) for timestamp in matched_times]
+    #Scene change samples stand for everything up to the next sample, which is where the picture changed
+    if scene_threshold > 0:
+      with open(all_images_txt_path,"r") as all_images_txt:
+        sample_times = np.sort([float(row[0]) for row in csv.reader(all_images_txt,delimiter=' ') if row])
+      next_sample = np.minimum(np.searchsorted(sample_times,matched_times,side='right'),len(sample_times) - 1)
+      reaches = np.maximum(np.rint(sample_times[next_sample]).astype(int),imagelist)
+    else: reaches = None
+    #The segments are moved to the keyframes of the recording's index, where ffmpeg cuts when it copies the streams.
+    #This avoids segment overlaps. Smart rendering cuts at the exact positions instead.
+    #Without keyframes in the index a safety margin makes up for ffmpeg jumping to the closest keyframe on both ends,
+    #the default keyframe interval is set to 1.
+    keyframe_times = [keyframe[0] for keyframe in (recording_index or index_recording())['keyframes']]
+    if keyframe_times:
+      segment_starts, segment_ends = plan_segments(imagelist,segment_extension,segment_gap,min_segment_duration,duration,reaches)
+      if not smart_render: segment_starts, segment_ends = snap_segments(segment_starts,segment_ends,keyframe_times,segment_gap,duration)
+    else: segment_starts, segment_ends = plan_segments(imagelist,segment_extension,segment_gap + 2 * keyframe_interval,min_segment_duration,duration,reaches)
+    beginnings = segment_starts.tolist()
+    endings = segment_ends.tolist()
+    del matched_times
 
     if verbose: print('Image list: ' + str(imagelist) + '\nBeginnings: ' + str(beginnings) + '\nEndings: ' + str(endings))
 
 # Write results to file    
     for i in range(0, len(beginnings)):
-      cuts_txt.write(str(beginnings[i]) + ' ' + str(endings[i]) + ' ' + str(datetime.timedelta(0, beginnings[i])) + ' ' + str(datetime.timedelta(0, endings[i])) + '\n')
+      cuts_txt.write(cut_time(beginnings[i]) + ' ' + cut_time(endings[i]) + ' ' + str(datetime.timedelta(0, beginnings[i])) + ' ' + str(datetime.timedelta(0, endings[i])) + '\n')
 
   os.chdir(startdir)
 
@@ -788,9 +1532,12 @@ if 4 in code_sections: #on/off switch for code
     else: 
       print('Converting video from ' + os.path.splitext(video_path)[1] + ' to ' + str(file_ext) + '...',end='\r')
       os.system('ffmpeg' + ' -copyts -avoid_negative_ts disabled' + ' -i "' + str(video_path) + str(os.path.splitext(video_path)[0] + addtofilename + '.' + str(file_ext)))
-    sys.exit('Finished converting the video from ' + os.path.splitext(video_path)[1] + ' to ' + str(file_ext))
+    sys.exit(current_time() + ' INFO:  Step 4 of 6: Finished converting the video from ' + os.path.splitext(video_path)[1] + ' to ' + str(file_ext))
   else:
     print(current_time() + ' INFO:  Step 4 of 6: Found cut positions resulting in ' + str(len(beginnings)) + ' segments.')
+  #the cutting stage of the batch needs the temporary folder and deletes it when it is done
+  if args.stage == 'analyse': unregister_cleanup(clean_on_exit)
+  run_profile.exit()
 
 #option to confirm overwriting in ffmpeg
 if quiet and confirm_overwrite: ffmpeg_overwrite = ' -y'
@@ -801,8 +1548,18 @@ if (not quiet): ffmpeg_overwrite = ''
 if verbose: quietffmpeg = ''
 else: quietffmpeg = ' -v quiet'
 
-if 5 in code_sections: #on/off switch for code
+#Segment files are only needed if the segment folder can be edited between steps 5 and 6, or should be kept
+#Otherwise step 6 cuts the final video straight out of the source, so every kept byte is only written once
+#Smart rendering joins encoded and copied parts into segment files
+cut_from_source = (5 in code_sections) and (6 in code_sections) and (keep == False) and (create_segment_files == False) and (smart_render == False)
+
+if 5 in code_sections and cut_from_source:
+  print('\n' + current_time() + ' INFO:  Step 5 of 6: Segments will be cut straight from the source in step 6')
+
+if 5 in code_sections and not cut_from_source: #on/off switch for code
+  run_profile.enter('step 5')
   print('\n' + current_time() + ' INFO:  Step 5 of 6: Extracting video segments with ffmpeg ...')
+  if smart_render: check_smart_render()
 
 #Create clean folders/files
   recreate(segments_txt_path,segments_dir)
@@ -813,6 +1570,13 @@ if 5 in code_sections: #on/off switch for code
     csv_reader = csv.reader(cuts_txt, delimiter=' ')
     timestamps = list(csv_reader) #[i][0] for beginnings, [i][1] for endings
 
+    #The cut markers and the keyframes of the index are timestamps of the file, sampled with -copyts, while -ss and -to count
+    #from its start. Every -ss and -to of this step is given the marker or keyframe minus start_offset, the inpoints and
+    #outpoints of the concat demuxer take file timestamps as they are.
+    start_offset = (recording_index or index_recording())['video'].get('start_time') or 0
+    def seek_time(timestamp):
+      return cut_time(max(0,timestamp - start_offset))
+
     #Use ffmpeg to extract segments
     def extract_segments(dir,txt,ts):
       os.chdir(dir)
@@ -820,58 +1584,164 @@ if 5 in code_sections: #on/off switch for code
         if txt == excluded_segments_txt_path: negative_str = ' negative'
         else: negative_str = ''
         for i in range(0,len(ts)):
-          ffmpeg_cut_start = int(ts[i][0])
-          ffmpeg_cut_end = int(ts[i][1])
+          ffmpeg_cut_start = float(ts[i][0])
+          ffmpeg_cut_end = float(ts[i][1])
           ffmpeg_cut_duration = ffmpeg_cut_end - ffmpeg_cut_start
-          segment_path = dir.joinpath(video_name.stem + '_' + str(ts[i][0]).zfill(7) + '-' + str(ts[i][1]).zfill(7) + '.' + str(file_ext))
-          ffmpeg_cut_input_options = ffmpeg_overwrite + quietffmpeg + ' -vsync 0 -ss ' + str(ts[i][0]) + ' -avoid_negative_ts disabled' + ' -i "'
-          ffmpeg_cut_output_options = '" -t ' + str(ffmpeg_cut_duration) + ' -c copy -muxpreload 0 -muxdelay 0 ' + '"' + str(segment_path) + '"'
-          ffmpeg_cut_cmd = 'ffmpeg' + ' ' + ffmpeg_cut_input_options + str(video_path) + ffmpeg_cut_output_options
+          segment_path = dir.joinpath(video_name.stem + '_' + segment_time(ffmpeg_cut_start) + '-' + segment_time(ffmpeg_cut_end) + '.' + str(file_ext))
           #Write output filenames into file for ffmpeg -f concat
           segments_txt.write("file 'file:" + str(dir.joinpath(segment_path.stem)).replace('\\', '/') + "'\n")
-          if verbose: print(ffmpeg_cut_cmd)
-          os.system(ffmpeg_cut_cmd)
+          if smart_render:
+            with run_profile.stage('smart render'): render_segment(ffmpeg_cut_start,ffmpeg_cut_end,segment_path)
+          else:
+            ffmpeg_cut_input_options = ffmpeg_overwrite + quietffmpeg + ' -vsync 0 -ss ' + seek_time(ffmpeg_cut_start) + ' -avoid_negative_ts disabled' + ' -i "'
+            ffmpeg_cut_output_options = '" -t ' + cut_time(ffmpeg_cut_duration) + ' -c copy -muxpreload 0 -muxdelay 0 ' + '"' + str(segment_path) + '"'
+            ffmpeg_cut_cmd = 'ffmpeg' + ' ' + ffmpeg_cut_input_options + str(video_path) + ffmpeg_cut_output_options
+            if verbose: print(ffmpeg_cut_cmd)
+            with run_profile.stage('segment cut'): os.system(ffmpeg_cut_cmd)
           if keep_filedate: os.utime(segment_path,ns=(modification_time, modification_time))
           if not verbose: print(current_time() + ' INFO:  Step 5 of 6: Extracting' + negative_str + ' segments: ' + str(i+1) + ' out of ' + str(len(ts)),end='\r')
         print(current_time() + ' INFO:  Step 5 of 6: Finished extracting ' + str(len(ts)) + negative_str + ' video segments.')
         if txt == excluded_segments_txt_path: os.chdir(segments_dir)
 
+    #Smart rendering: the frames from the start marker up to the first keyframe and from the last keyframe up to the end marker
+    #are encoded again, the GOPs in between are copied. All parts are written as MPEG-TS, which repeats the codec headers in front
+    #of every keyframe, so the encoder's and the source's headers don't get mixed up when the parts are joined into the segment.
+    #The copied part is cut like step 6 cuts from the source, by the concat demuxer ending in front of the keyframe's dts.
+    #The parts only hold the video, the audio is copied in one piece from the cut on when they are joined.
+    def render_segment(start,end,segment_path):
+      parts_dir = Path(tmpdir) / 'parts'
+      if parts_dir.exists(): shutil.rmtree(parts_dir)
+      os.mkdir(parts_dir)
+      register_cleanup(clean_on_exit,parts_dir)
+      keyframe_before, first_keyframe = keyframes_around(recording_index,start)
+      last_keyframe, keyframe_after = keyframes_around(recording_index,end)
+      if (first_keyframe is None) or (first_keyframe[0] >= end): parts = [('encode',start,end)]
+      else:
+        parts = []
+        if first_keyframe[0] > start: parts.append(('encode',start,first_keyframe[0]))
+        if last_keyframe[0] > first_keyframe[0]: parts.append(('copy',first_keyframe,last_keyframe))
+        if end > last_keyframe[0]: parts.append(('encode',last_keyframe[0],end))
+      parts_txt_path = parts_dir / 'parts.txt'
+      with open(parts_txt_path,"w") as parts_txt:
+        parts_txt.write('ffconcat version 1.0\n')
+        for n, (mode, part_start, part_end) in enumerate(parts):
+          part_path = parts_dir / (str(n) + '.ts')
+          part_output = ['-map','0:v:0','-vsync','0','-muxpreload','0','-muxdelay','0','-f','mpegts',str(part_path)]
+          if mode == 'copy':
+            copy_txt_path = parts_dir / 'copy.txt'
+            with open(copy_txt_path,"w") as copy_txt:
+              copy_txt.write('ffconcat version 1.0\n')
+              copy_txt.write("file 'file:" + str(video_path).replace('\\', '/').replace("'", "'\\''") + "'\n")
+              copy_txt.write('inpoint ' + str(round(part_start[0],6)) + '\n')
+              copy_txt.write('outpoint ' + str(round(part_end[1],6)) + '\n')
+              copy_txt.write('duration ' + str(round(part_end[0] - part_start[0],6)) + '\n')
+            part_cmd = ['ffmpeg','-y'] + quietffmpeg.split() + ['-f','concat','-safe','0','-i',str(copy_txt_path),'-c','copy'] + part_output
+          else:
+            part_cmd = ['ffmpeg','-y'] + quietffmpeg.split() + ['-ss',seek_time(part_start),'-i',str(video_path),'-t',str(round(part_end - part_start,6)),'-c:v'] + smart_encoders[recording_index['video']['codec_name']] + ['-pix_fmt',recording_index['video']['pix_fmt']] + part_output
+          if verbose: print(subprocess.list2cmdline(part_cmd))
+          subprocess.run(part_cmd,check=True)
+          parts_txt.write("file '" + part_path.name + "'\n")
+          #the length ffmpeg guesses for an MPEG-TS file is off by a few milliseconds
+          if mode == 'copy': parts_txt.write('duration ' + str(round(part_end[0] - part_start[0],6)) + '\n')
+          else: parts_txt.write('duration ' + str(round(part_end - part_start,6)) + '\n')
+      #-copypriorss 0 drops the audio between the keyframe the input was seeked to and the cut
+      ffmpeg_join_cmd = ['ffmpeg'] + ffmpeg_overwrite.split() + quietffmpeg.split() + ['-f','concat','-safe','0','-i',str(parts_txt_path),'-ss',seek_time(start),'-t',str(round(end - start,6)),'-i',str(video_path),'-map','0:v','-map','1:a?','-c','copy','-copypriorss','0','-muxpreload','0','-muxdelay','0',str(segment_path)]
+      if verbose: print(subprocess.list2cmdline(ffmpeg_join_cmd))
+      subprocess.run(ffmpeg_join_cmd,check=True)
+      shutil.rmtree(parts_dir)
+
     #Makes a new timestamp table with all non-selected parts
     def inverse_timestamps(ts):
-      inverse_timestamps = []
-      found_inverse = 0
-      for i in range(0,len(ts)):
-        if (i == 0) and (int(ts[0][0]) != 0):
-          inverse_timestamps.append([0,int(ts[0][0])])
-          found_inverse +=1
-        if (i == len(ts) - 1) and (int(ts[-1][1]) != duration):
-          inverse_timestamps.append([int(ts[-1][1]),duration])
-          found_inverse +=1
-        if  i < len(ts) - 1:
-          inverse_timestamps.append([int(ts[i][1]),int(ts[i+1][0])])
-          found_inverse +=1
-      if found_inverse < 1: return False
-      else: return inverse_timestamps
-
-    extract_segments(segments_dir,segments_txt_path,timestamps)
-    if create_negative and inverse_timestamps(timestamps): extract_segments(excluded_segments_dir,excluded_segments_txt_path,inverse_timestamps(timestamps))
+      gap_starts, gap_ends = complement_segments([float(t[0]) for t in ts],[float(t[1]) for t in ts],duration)
+      if len(gap_starts) < 1: return False
+      else: return [[float(gap_start),float(gap_end)] for gap_start, gap_end in zip(gap_starts,gap_ends)]
+
+    #Use a single ffmpeg run with one output per segment, the source is opened and read once, no matter how many segments there are
+    #Every output only keeps the packets between its cut markers, pieces that aren't wanted are never written
+    #With stream copy an output can only start at a keyframe, so a segment runs from the first keyframe after its cut marker
+    #to the first keyframe after its end marker, like the pieces of a split at every cut marker would
+    def extract_segments_single_pass(ts,excluded_ts):
+      intervals = [(float(t[0]),float(t[1]),segments_dir,segments_txt_path) for t in ts]
+      if create_negative and excluded_ts: intervals += [(t[0],t[1],excluded_segments_dir,excluded_segments_txt_path) for t in excluded_ts]
+      intervals.sort()
+      #the keyframes come from the index of the recording, a followed recording is indexed now that it is complete
+      index = recording_index or index_recording()
+      segment_paths = []
+      ffmpeg_split_cmd = ['ffmpeg'] + ffmpeg_overwrite.split() + quietffmpeg.split() + ['-i',str(video_path)]
+      for start, end, dir, txt in intervals:
+        #Without keyframes in the index, eg. of a stream ffprobe lists no key packets for, ffmpeg cuts at the markers themselves
+        if not index['keyframes']: ffmpeg_split_cmd += ['-ss',seek_time(start),'-to',seek_time(end)]
+        else:
+          keyframe_before, first_keyframe = keyframes_around(index,start)
+          keyframe_before, end_keyframe = keyframes_around(index,end)
+          if (first_keyframe is None) or (first_keyframe == end_keyframe):
+            if txt == segments_txt_path: print(current_time() + ' WARN:  Step 5 of 6: Segment ' + cut_time(start) + '-' + cut_time(end) + ' lies between two keyframes and was dropped')
+            continue
+          ffmpeg_split_cmd += ['-ss',seek_time(first_keyframe[0])]
+          if end_keyframe: ffmpeg_split_cmd += ['-to',seek_time(end_keyframe[0])]
+        segment_path = dir.joinpath(video_name.stem + '_' + segment_time(start) + '-' + segment_time(end) + '.' + str(file_ext))
+        ffmpeg_split_cmd += ['-c','copy','-muxpreload','0','-muxdelay','0',str(segment_path)]
+        segment_paths.append((txt,segment_path))
+      if segment_paths:
+        if verbose: print(subprocess.list2cmdline(ffmpeg_split_cmd))
+        with run_profile.stage('segment split'): subprocess.run(ffmpeg_split_cmd,check=True)
+      for txt, segment_path in segment_paths:
+        if keep_filedate: os.utime(segment_path,ns=(modification_time, modification_time))
+      #Write output filenames into file for ffmpeg -f concat
+      for txt in set(interval[3] for interval in intervals):
+        with open(txt,"w") as segments_txt:
+          for segment_txt, segment_path in segment_paths:
+            if segment_txt == txt: segments_txt.write("file 'file:" + str(segment_path).replace('\\', '/') + "'\n")
+      print(current_time() + ' INFO:  Step 5 of 6: Finished extracting ' + str(len(segment_paths)) + ' video segments in a single pass.')
+
+    excluded_timestamps = inverse_timestamps(timestamps)
+    if single_pass and not smart_render: extract_segments_single_pass(timestamps,excluded_timestamps)
+    else:
+      extract_segments(segments_dir,segments_txt_path,timestamps)
+      if create_negative and excluded_timestamps: extract_segments(excluded_segments_dir,excluded_segments_txt_path,excluded_timestamps)
 
   os.chdir(startdir)
+  run_profile.exit()
 
   
 
 if 6 in code_sections: #on/off switch for code
+  run_profile.enter('step 6')
   print('\n' + current_time() + ' INFO:  Step 6 of 6: Creating final video with ffmpeg ...')
 
 #Create clean folders/files
   recreate(segments_txt_path)
   if create_negative: recreate(excluded_segments_txt_path)
 
+#Write a concat script with the cut markers as in and out points of the source
+#Like the segment files, a cut starts at the keyframe before its marker. It ends in front of the keyframe after its end marker,
+#with an explicit duration, so B-frames behind the out point can't overlap the start of the next cut.
+  def write_source_cuts(txt,ts):
+    #the keyframes come from the index of the recording, a followed recording is indexed now that it is complete
+    index = recording_index or index_recording()
+    with open(txt,"w",newline='') as segments_txt:
+      segments_txt.write('ffconcat version 1.0\n')
+      for start, end in ts:
+        segments_txt.write("file 'file:" + str(video_path).replace('\\', '/').replace("'", "'\\''") + "'\n")
+        inpoint = 0
+        if start > 0:
+          keyframe_before, keyframe_after = keyframes_around(index,start)
+          if keyframe_before: inpoint = keyframe_before[0]
+          else: inpoint = start
+          segments_txt.write('inpoint ' + str(round(inpoint,6)) + '\n')
+        if end < duration:
+          keyframe_before, keyframe_after = keyframes_around(index,end)
+          if keyframe_after:
+            segments_txt.write('outpoint ' + str(round(keyframe_after[1],6)) + '\n')
+            segments_txt.write('duration ' + str(round(keyframe_after[0] - inpoint,6)) + '\n')
+          else: segments_txt.write('outpoint ' + str(end) + '\n')
+    return len(ts)
+
 #Recreate txt in case the user deleted, added or reordered files in the segment folder
   def scan_segments(dir,txt):
     os.chdir(dir)
     with open(txt,"w",newline='') as segments_txt:
-      file_list = [f for f in os.listdir(dir) if re.search(r'.*\.' + str(file_ext), f)]
+      file_list = sorted([f for f in os.listdir(dir) if re.search(r'.*\.' + str(file_ext), f)])
       i = 0
       for file in file_list:
         segments_txt.write("file 'file:" + str(dir.joinpath(file)).replace('\\', '/') + "'\n")
@@ -879,23 +1749,33 @@ if 6 in code_sections: #on/off switch for code
         i +=1
     return file_list, i
 
-  segment_files, segments_count = scan_segments(segments_dir,segments_txt_path)
-  if create_negative: excluded_segment_files, excluded_segments_count = scan_segments(excluded_segments_dir,excluded_segments_txt_path)
+  if cut_from_source:
+    with open(cuts_txt_path,"r") as cuts_txt:
+      cut_timestamps = [[float(row[0]),float(row[1])] for row in csv.reader(cuts_txt, delimiter=' ') if row]
+    segment_files = []
+    segments_count = write_source_cuts(segments_txt_path,cut_timestamps)
+    if create_negative:
+      gap_starts, gap_ends = complement_segments([t[0] for t in cut_timestamps],[t[1] for t in cut_timestamps],duration)
+      excluded_segment_files = []
+      excluded_segments_count = write_source_cuts(excluded_segments_txt_path,[[float(gap_start),float(gap_end)] for gap_start, gap_end in zip(gap_starts,gap_ends)])
+  else:
+    segment_files, segments_count = scan_segments(segments_dir,segments_txt_path)
+    if create_negative: excluded_segment_files, excluded_segments_count = scan_segments(excluded_segments_dir,excluded_segments_txt_path)
 
 #Use ffmpeg to concatenate
   def concat_segments(dir,txt,file_list,count):
-    os.chdir(dir)
+    if not cut_from_source: os.chdir(dir)
     if dir == excluded_segments_dir: negative_str = '_negative'
     else: negative_str = ''
     ffmpeg_concat_destpath = Path(os.path.splitext(video_path)[0] + addtofilename + negative_str + '.' + str(file_ext))
     ffmpeg_concat_options = quietffmpeg + ffmpeg_overwrite + ' -vsync 0 -safe 0 -f concat' + ' -avoid_negative_ts disabled' + ' -i "' + txt.replace('\\', '/') + '" -c copy -muxpreload 0 -muxdelay 0'
     ffmpeg_concat_cmd = 'ffmpeg' + ' ' + ffmpeg_concat_options + ' ' + '"' + str(ffmpeg_concat_destpath) + '"'
     #Don't use ffmpeg concat if it is only a single segment with the same video cotainer
-    if (count == 1) and (os.path.splitext(video_name)[1] == '.' + str(file_ext)):
+    if (count == 1) and file_list and (os.path.splitext(video_name)[1] == '.' + str(file_ext)):
       shutil.move(os.path.join(dir,Path(file_list[0])),ffmpeg_concat_destpath)
     else:
       if verbose: print(ffmpeg_concat_cmd)
-      os.system(ffmpeg_concat_cmd)
+      with run_profile.stage('concat'): os.system(ffmpeg_concat_cmd)
     if keep_filedate: os.utime(ffmpeg_concat_destpath,ns=(modification_time, modification_time))
 
   concat_segments(segments_dir,segments_txt_path,segment_files,segments_count)
@@ -906,8 +1786,9 @@ if 6 in code_sections: #on/off switch for code
 
 #segments_dir can be deleted if final video has been made
   if keep == False: 
-    atexit.register(clean_on_exit,segments_dir)
-    if create_negative: atexit.register(clean_on_exit,excluded_segments_dir)
+    register_cleanup(clean_on_exit,segments_dir)
+    if create_negative: register_cleanup(clean_on_exit,excluded_segments_dir)
+  run_profile.exit()
 
 if move_original:
   shutil.move(video_path,move_original/video_name)
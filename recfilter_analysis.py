@@ -0,0 +1,58 @@
+# Columnar analysis format of RecFilter3
+# analysis.npz keeps every detection with its label, score and box. It is written uncompressed,
+# so each column can be memory-mapped straight out of the archive instead of being parsed.
+import struct
+import zipfile
+import numpy as np
+
+#samples: (timestamp, name, detections) in the order of all_images.txt
+#reused: names of the samples that reused the detections of another sample, with the name of that sample
+def write_analysis(path, samples, reused=None):
+  classes = sorted(set(entry['label'] for timestamp, name, detections in samples for entry in detections))
+  class_ids = {name: i for i, name in enumerate(classes)}
+  detection_count = sum(len(detections) for timestamp, name, detections in samples)
+  sample = np.empty(detection_count, dtype=np.uint32)
+  label = np.empty(detection_count, dtype=np.uint8)
+  score = np.empty(detection_count, dtype=np.float32)
+  box = np.empty((detection_count, 4), dtype=np.int32)
+  row = 0
+  for index, (timestamp, name, detections) in enumerate(samples):
+    for entry in detections:
+      sample[row] = index
+      label[row] = class_ids[entry['label']]
+      score[row] = entry['score']
+      box[row] = entry['box']
+      row += 1
+  #index of the sample whose detections a sample reused, -1 for the analysed ones
+  sample_index = {name: index for index, (timestamp, name, detections) in enumerate(samples)}
+  reused_from = np.array([sample_index.get((reused or {}).get(name), -1) for timestamp, name, detections in samples], dtype=np.int32)
+  np.savez(path,
+    timestamps=np.array([float(timestamp) for timestamp, name, detections in samples], dtype=np.float64),
+    names=np.array([name for timestamp, name, detections in samples], dtype='U11'),
+    classes=np.array(classes, dtype='U32'),
+    sample=sample, label=label, score=score, box=box, reused=reused_from)
+
+#Returns a dict of read-only arrays mapped from the archive members
+def load_analysis(path):
+  arrays = {}
+  with zipfile.ZipFile(path) as archive, open(path, 'rb') as analysis_file:
+    for info in archive.infolist():
+      name = info.filename[:-4]
+      if info.compress_type != zipfile.ZIP_STORED:
+        arrays[name] = np.load(archive.open(info))
+        continue
+      #The member data starts behind its local file header, which has its own name and extra field lengths
+      analysis_file.seek(info.header_offset + 26)
+      name_length, extra_length = struct.unpack('<HH', analysis_file.read(4))
+      analysis_file.seek(info.header_offset + 30 + name_length + extra_length)
+      version = np.lib.format.read_magic(analysis_file)
+      if version == (1, 0): shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(analysis_file)
+      else: shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(analysis_file)
+      if int(np.prod(shape)) == 0: arrays[name] = np.empty(shape, dtype=dtype)
+      else: arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=analysis_file.tell(), shape=shape, order='F' if fortran_order else 'C')
+  return arrays
+
+#Labels of one sample, sorted like in analysis.txt
+def sample_labels(analysis, index):
+  start, end = np.searchsorted(analysis['sample'], [index, index + 1])
+  return sorted(str(analysis['classes'][label]) for label in analysis['label'][start:end])
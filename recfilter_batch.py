@@ -0,0 +1,91 @@
+# Batch mode of RecFilter3
+# The recordings pass through two stages, each with its own worker process: the analysis (steps 1 to 4) and the cutting
+# (steps 5 and 6). While one recording is cut, the next one is already analysed, so the disk and the CPU are busy at the
+# same time. Both stages run RecFilter3 with the same arguments as a single run, so the results and output names are the same.
+# Sampling and inference stay in one stage, ffmpeg already decodes the samples in its own process while NudeNet analyses them.
+import glob
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from recfilter_daemon import start_worker, run_in_worker
+
+def current_time():
+  return time.strftime("%H:%M:%S", time.localtime())
+
+#Patterns are expanded here as well, the Windows shell leaves them alone. Every recording is only processed once.
+def batch_files(patterns):
+  files = []
+  for pattern in patterns:
+    if glob.has_magic(pattern): matches = sorted(glob.glob(pattern))
+    else: matches = [pattern]
+    for match in matches:
+      path = os.path.abspath(match)
+      if path not in files: files.append(path)
+  return files
+
+#The recordings of the batch are taken out of the command line, everything else is passed on to every recording
+def batch_args(argv, file=None):
+  args = []
+  in_batch = False
+  for arg in argv:
+    if arg == '--batch': in_batch = True
+    elif in_batch and not arg.startswith('-'): continue
+    else:
+      in_batch = False
+      args.append(arg)
+  if file in args: args.remove(file)
+  return args
+
+#Runs the stages over files, returns the number of recordings that failed
+#queue_size analysed recordings wait for the cutting at most, so the analysis doesn't run far ahead of the disk
+def run_batch(script_path, files, args, queue_size=1):
+  if '-q' not in args and '--quiet' not in args: args = args + ['-q']
+  cut_queue = queue.Queue(maxsize=queue_size)
+  results = {}
+  #a recording's temporary folder is named after it, one with the same name has to wait until the cutting is done with it
+  busy = set()
+  released = threading.Condition()
+
+  def finish(path, reply):
+    results[path] = reply
+    print(current_time() + ' INFO:  Batch: ' + os.path.basename(path) + ' ' + reply['state'] + (': ' + str(reply['result']).strip() if reply['result'] else ''))
+
+  def analyse():
+    process = start_worker(script_path)
+    for path in files:
+      tmpdir = Path(path).parent / ('~' + Path(path).stem)
+      with released:
+        while tmpdir in busy: released.wait()
+      print(current_time() + ' INFO:  Batch: Analysing ' + path)
+      reply, process = run_in_worker(process, script_path, [path] + args + ['--stage', 'analyse'], True)
+      #a run that ended before step 5 without an error, eg. with no segments found, is complete
+      if (reply['state'] == 'done') and not reply['result']:
+        with released: busy.add(tmpdir)
+        cut_queue.put((path, tmpdir))
+      else: finish(path, reply)
+    cut_queue.put(None)
+    process.stdin.close()
+
+  def cut():
+    process = start_worker(script_path, False)
+    while True:
+      task = cut_queue.get()
+      if task is None: break
+      path, tmpdir = task
+      print(current_time() + ' INFO:  Batch: Cutting ' + path)
+      reply, process = run_in_worker(process, script_path, [path] + args + ['--stage', 'cut'], False)
+      with released:
+        busy.discard(tmpdir)
+        released.notify_all()
+      finish(path, reply)
+    process.stdin.close()
+
+  print(current_time() + ' INFO:  Batch of ' + str(len(files)) + ' recordings, analysis and cutting run side by side')
+  stages = [threading.Thread(target=analyse, daemon=True), threading.Thread(target=cut, daemon=True)]
+  for stage in stages: stage.start()
+  for stage in stages: stage.join()
+  failed = [path for path in files if results.get(path, {}).get('state') != 'done']
+  print(current_time() + ' INFO:  Batch finished, ' + str(len(files) - len(failed)) + ' of ' + str(len(files)) + ' recordings done')
+  return len(failed)
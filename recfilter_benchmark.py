@@ -0,0 +1,276 @@
+# Benchmark of RecFilter3
+# Synthetic recordings are generated with ffmpeg's testsrc, then the pipeline is run on them step by step (-1 ... -6)
+# and as one streamed run. Wall time, frames per second, peak memory and bytes written are reported per step as json,
+# so the results of two commits can be compared with the compare command.
+# With --stub the NudeNet model is replaced by a deterministic stand-in, so only RecFilter3's own work is measured.
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+script_dir = Path(os.path.abspath(__file__)).parent
+step_names = {'all': 'streamed run', '1': 'images', '2': 'analyse', '3': 'match', '4': 'timestamps', '5': 'split', '6': 'save'}
+
+#Every benchmark uses the same preset, independent of the config of the installation
+benchmark_config = '''default:
+  gap: 30
+  duration: 10
+  extension: 3
+  include: EXPOSED_BREAST,EXPOSED_BUTTOCKS,EXPOSED_ANUS,EXPOSED_GENITALIA,EXPOSED_BELLY,FACE_F
+  exclude: ''
+  filesuffix: _bench
+  videoext: mkv
+  confirm_overwrite: true
+'''
+
+#Classes of NudeNet's default model
+stub_classes = ['EXPOSED_ANUS', 'EXPOSED_ARMPITS', 'COVERED_BELLY', 'EXPOSED_BELLY', 'COVERED_BUTTOCKS', 'EXPOSED_BUTTOCKS', 'FACE_F', 'FACE_M',
+  'COVERED_FEET', 'EXPOSED_FEET', 'COVERED_BREAST_F', 'EXPOSED_BREAST_F', 'COVERED_GENITALIA_F', 'EXPOSED_GENITALIA_F', 'EXPOSED_BREAST_M', 'EXPOSED_GENITALIA_M']
+
+def current_time():
+  return time.strftime("%H:%M:%S", time.localtime())
+
+#Stands in for the ONNX Runtime session of NudeDetector, its outputs only depend on the image content
+#Bright images get a wanted tag, darkened ones an unwanted one, so the synthetic video has segments to cut
+class StubSession:
+  class Node:
+    def __init__(self, name):
+      self.name = name
+
+  def __init__(self, delay):
+    self.delay = delay
+
+  def get_inputs(self):
+    return [self.Node('input_1')]
+
+  def get_outputs(self):
+    return [self.Node('boxes'), self.Node('scores'), self.Node('labels')]
+
+  def run(self, output_names, feed):
+    import numpy as np
+    images = next(iter(feed.values()))
+    if self.delay: time.sleep(self.delay * len(images))
+    boxes = np.zeros((len(images), 2, 4), dtype=np.float32)
+    scores = np.zeros((len(images), 2), dtype=np.float32)
+    labels = np.zeros((len(images), 2), dtype=np.int32)
+    for i, image in enumerate(images):
+      #NudeNet subtracts the mean colour of its training data, so dark images have a low mean
+      bright = float(image.mean()) > -60
+      value = int(abs(float(image.mean())) * 1000)
+      labels[i] = [stub_classes.index('EXPOSED_BELLY' if bright else 'COVERED_BELLY'), (value + 5) % len(stub_classes)]
+      scores[i] = [0.9, 0.5 + (value % 10) / 100]
+      boxes[i] = [[0, 0, 100, 100], [10, 10, 110, 110]]
+    return [boxes, scores, labels]
+
+class StubDetector:
+  def __init__(self, delay):
+    self.detection_model = StubSession(delay)
+    self.classes = stub_classes
+
+def ffmpeg_version():
+  try: return subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout.splitlines()[0]
+  except (OSError, IndexError): return None
+
+def git_commit(path):
+  try:
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path, capture_output=True, text=True, check=True).stdout.strip()
+    dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=path, capture_output=True, text=True).stdout.strip())
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  return commit + ('-dirty' if dirty else '')
+
+#testsrc video with a sine tone, generated once per combination of settings
+#Every other period seconds the picture is darkened, which the stub detector tells apart
+def synthetic_video(folder, length, size, rate, gop, period):
+  video_path = Path(folder) / ('testsrc_' + str(length) + 's_' + size + '_' + str(rate) + 'fps_g' + str(gop) + '_p' + str(period) + '.mkv')
+  if video_path.exists(): return video_path
+  print(current_time() + ' INFO:  Generating ' + str(video_path))
+  temp_path = video_path.with_suffix('.tmp.mkv')
+  video_cmd = ['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=size=' + size + ':rate=' + str(rate) + ':duration=' + str(length),
+    '-f', 'lavfi', '-i', 'sine=frequency=440:duration=' + str(length),
+    '-vf', 'eq=brightness=\'if(lt(mod(t,' + str(2 * period) + '),' + str(period) + '),0,-0.8)\':eval=frame',
+    '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-g', str(gop), '-c:a', 'aac', str(temp_path)]
+  subprocess.run(video_cmd, check=True)
+  os.replace(temp_path, video_path)
+  return video_path
+
+#RecFilter3 and its modules are copied next to the benchmark config, so the installation's config isn't used
+def prepare_script(folder):
+  run_dir = Path(folder) / 'script'
+  if run_dir.exists(): shutil.rmtree(run_dir)
+  run_dir.mkdir(parents=True)
+  for module_path in script_dir.glob('*.py'): shutil.copy2(module_path, run_dir)
+  with open(run_dir / 'RecFilter3.config', 'w') as config_file: config_file.write(benchmark_config)
+  return run_dir / 'RecFilter3.py'
+
+def remove_outputs(video_path):
+  temp_dir = video_path.parent / ('~' + video_path.stem)
+  if temp_dir.exists(): shutil.rmtree(temp_dir)
+  for output_path in video_path.parent.glob(video_path.stem + '_bench*'):
+    if output_path.is_dir(): shutil.rmtree(output_path)
+    else: output_path.unlink()
+
+#Size and modification time of every file below folder
+def folder_state(folder):
+  state = {}
+  for root, dirs, files in os.walk(folder):
+    for name in files:
+      try: stat = os.stat(os.path.join(root, name))
+      except OSError: continue
+      state[os.path.join(root, name)] = (stat.st_size, stat.st_mtime_ns)
+  return state
+
+#Size of the files a step created or changed, the modification time alone isn't enough since RecFilter3 can keep the source's
+def bytes_written(before, after):
+  return sum(size for path, (size, mtime) in after.items() if before.get(path) != (size, mtime))
+
+def sample_count(video_path):
+  all_images_path = video_path.parent / ('~' + video_path.stem) / 'all_images.txt'
+  try:
+    with open(all_images_path, 'r') as all_images_txt: return sum(1 for line in all_images_txt if line.strip())
+  except OSError: return None
+
+#Runs RecFilter3 once, the peak memory is the largest resident set of its process tree where the platform reports it
+def run_step(cmd, video_path, video_frames):
+  state_before = folder_state(video_path.parent)
+  start = time.perf_counter()
+  with tempfile.TemporaryFile() as error_file:
+    process = subprocess.Popen(cmd, cwd=video_path.parent, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=error_file)
+    peak_rss = None
+    if hasattr(os, 'wait4'):
+      pid, status, usage = os.wait4(process.pid, 0)
+      if hasattr(os, 'waitstatus_to_exitcode'): exit_code = os.waitstatus_to_exitcode(status)
+      else: exit_code = status >> 8
+      process.returncode = exit_code
+      #kilobytes on Linux, bytes on macOS
+      peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    else: exit_code = process.wait()
+    wall = time.perf_counter() - start
+    error_file.seek(0)
+    errors = error_file.read().decode(errors='replace')
+  samples = sample_count(video_path)
+  result = {
+    'exit_code': exit_code,
+    'wall_seconds': round(wall, 4),
+    'frames_per_second': round(video_frames / wall, 1),
+    'samples': samples,
+    'samples_per_second': round(samples / wall, 2) if samples else None,
+    'peak_rss_bytes': peak_rss,
+    'bytes_written': bytes_written(state_before, folder_state(video_path.parent))}
+  if exit_code != 0: result['error'] = (errors.strip().splitlines() or [''])[-1]
+  return result
+
+def summarise(runs):
+  summary = {}
+  for step in dict.fromkeys(run['step'] for run in runs):
+    step_runs = [run for run in runs if run['step'] == step and run['exit_code'] == 0]
+    if not step_runs: continue
+    summary[step] = {
+      'wall_seconds': round(statistics.median(run['wall_seconds'] for run in step_runs), 4),
+      'frames_per_second': round(statistics.median(run['frames_per_second'] for run in step_runs), 1),
+      'peak_rss_bytes': max((run['peak_rss_bytes'] or 0) for run in step_runs) or None,
+      'bytes_written': max(run['bytes_written'] for run in step_runs)}
+  return summary
+
+def benchmark(args, recfilter_args):
+  folder = Path(args.folder).resolve()
+  folder.mkdir(parents=True, exist_ok=True)
+  video_path = synthetic_video(folder, args.length, args.size, args.rate, args.gop, args.period)
+  script_path = prepare_script(folder)
+  video_frames = args.length * args.rate
+  if args.stub: base_cmd = [sys.executable, str(script_path.parent / Path(__file__).name), 'stub', str(args.stub_delay), str(script_path)]
+  else: base_cmd = [sys.executable, str(script_path)]
+  base_cmd += [str(video_path), '-q', '--nocache', '-i', str(args.interval)] + recfilter_args
+  runs = []
+  for run in range(args.runs):
+    chain_failed = False
+    for step in args.steps.split(','):
+      step = step.strip()
+      if step == 'all' or step == '1':
+        remove_outputs(video_path)
+        chain_failed = False
+      #a step works on the files of the one before, after a failure its numbers would mean nothing
+      elif chain_failed: continue
+      if step == 'all': cmd = base_cmd
+      else: cmd = base_cmd + ['-' + step]
+      result = dict({'step': step, 'run': run + 1}, **run_step(cmd, video_path, video_frames))
+      runs.append(result)
+      if step != 'all' and result['exit_code'] != 0: chain_failed = True
+      print(current_time() + ' INFO:  Run ' + str(run + 1) + ', ' + (step if step == 'all' else 'step ' + step) + ' (' + step_names.get(step, '') + '): '
+        + str(result['wall_seconds']) + ' s' + ('' if result['exit_code'] == 0 else ', failed: ' + result['error']), file=sys.stderr)
+  remove_outputs(video_path)
+  return {
+    'commit': git_commit(script_dir),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'ffmpeg': ffmpeg_version(),
+    'detector': ('stub, ' + str(args.stub_delay) + ' s per image') if args.stub else 'nudenet',
+    'video': {'length': args.length, 'size': args.size, 'rate': args.rate, 'gop': args.gop, 'period': args.period, 'frames': video_frames},
+    'arguments': ['-i', str(args.interval)] + recfilter_args,
+    'runs': runs,
+    'summary': summarise(runs)}
+
+#Prints the change of the median wall time and memory of every step from one result file to another
+def compare(before_path, after_path):
+  with open(before_path, 'r') as before_file: before = json.load(before_file)
+  with open(after_path, 'r') as after_file: after = json.load(after_file)
+  print('step          wall before    wall after    change    rss before   rss after')
+  for step, after_step in after['summary'].items():
+    before_step = before['summary'].get(step)
+    if not before_step: continue
+    change = (after_step['wall_seconds'] / before_step['wall_seconds'] - 1) * 100 if before_step['wall_seconds'] else 0
+    rss_before = str(round((before_step['peak_rss_bytes'] or 0) / 1048576)) + ' MiB'
+    rss_after = str(round((after_step['peak_rss_bytes'] or 0) / 1048576)) + ' MiB'
+    print('%-12s %10.3f s %11.3f s %+8.1f %% %11s %11s' % (step, before_step['wall_seconds'], after_step['wall_seconds'], change, rss_before, rss_after))
+
+#Runs RecFilter3 in this process with the stub detector in place of the model
+def run_stubbed(delay, recfilter_path, recfilter_args):
+  import runpy
+  sys.path.insert(0, os.path.dirname(os.path.abspath(recfilter_path)))
+  import recfilter_detector
+  import recfilter_server
+  recfilter_detector.load_detector = lambda intra_op_threads=0, inter_op_threads=0: StubDetector(delay)
+  #a running inference server would analyse the samples with the real model
+  recfilter_server.connect_server = lambda: None
+  recfilter_server.server_available = lambda: False
+  sys.argv = [recfilter_path] + recfilter_args
+  runpy.run_path(recfilter_path, run_name='__main__')
+
+if __name__ == '__main__':
+  if len(sys.argv) > 3 and sys.argv[1] == 'stub':
+    run_stubbed(float(sys.argv[2]), sys.argv[3], sys.argv[4:])
+    sys.exit()
+  if len(sys.argv) == 4 and sys.argv[1] == 'compare':
+    compare(sys.argv[2], sys.argv[3])
+    sys.exit()
+  parser = argparse.ArgumentParser(prog='recfilter_benchmark', description='Benchmark of RecFilter3 on synthetic videos. Arguments after -- are passed on to RecFilter3.',
+    epilog='python recfilter_benchmark.py compare before.json after.json compares two results.')
+  parser.add_argument('--folder', default='benchmark', help='Folder for the generated videos and temporary files (default: benchmark)')
+  parser.add_argument('--length', type=int, default=600, help='Length of the video in seconds (default: 600)')
+  parser.add_argument('--size', default='1280x720', help='Resolution of the video (default: 1280x720)')
+  parser.add_argument('--rate', type=int, default=30, help='Frame rate of the video (default: 30)')
+  parser.add_argument('--gop', type=int, default=60, help='Frames from one keyframe to the next (default: 60)')
+  parser.add_argument('--period', type=int, default=60, help='Seconds from one change between a bright and a dark picture to the next (default: 60)')
+  parser.add_argument('--interval', type=int, default=5, help='Interval between samples passed to RecFilter3 (default: 5)')
+  parser.add_argument('--steps', default='all,1,2,3,4,5,6', help='Comma separated steps to run in this order, all = one streamed run without step switches (default: all,1,2,3,4,5,6)')
+  parser.add_argument('--runs', type=int, default=3, help='Number of times every step is run (default: 3)')
+  parser.add_argument('--stub', action='store_true', help='Replace the NudeNet model with a deterministic stand-in (default: False)')
+  parser.add_argument('--stub_delay', type=float, default=0, help='Seconds the stand-in takes per image to simulate a model (default: 0)')
+  parser.add_argument('--output', help='Write the results to this json file instead of stdout')
+  if '--' in sys.argv:
+    args = parser.parse_args(sys.argv[1:sys.argv.index('--')])
+    recfilter_args = sys.argv[sys.argv.index('--') + 1:]
+  else:
+    args = parser.parse_args()
+    recfilter_args = []
+  results = benchmark(args, recfilter_args)
+  if args.output:
+    with open(args.output, 'w') as output_file: json.dump(results, output_file, indent=1)
+  else: print(json.dumps(results, indent=1))
@@ -0,0 +1,59 @@
+# Persistent analysis cache for RecFilter3
+# Results of steps 1 and 2 are stored under a hash of the recording's identity and the settings that influence sampling and detection
+import hashlib
+import json
+import os
+from pathlib import Path
+
+cache_version = 1
+default_cache_dir = Path.home() / '.RecFilter3' / 'cache'
+
+#Size, modification time and a hash of the first and the last MiB identify a recording without reading all of it
+def file_identity(path, block_size=1048576):
+  stat = os.stat(path)
+  content_hash = hashlib.sha1()
+  with open(path, 'rb') as video:
+    content_hash.update(video.read(block_size))
+    if stat.st_size > block_size:
+      video.seek(max(block_size, stat.st_size - block_size))
+      content_hash.update(video.read(block_size))
+  return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': content_hash.hexdigest()}
+
+def cache_key(identity, settings):
+  key_source = json.dumps({'version': cache_version, 'file': identity, 'settings': settings}, sort_keys=True)
+  return hashlib.sha1(key_source.encode()).hexdigest()
+
+#Returns the cached entry or None. A hit refreshes the entry's mtime, which is what the LRU eviction goes by.
+def load_entry(cache_dir, key):
+  entry_path = Path(cache_dir) / (key + '.json')
+  try:
+    with open(entry_path, 'r') as entry_file:
+      entry = json.load(entry_file)
+    os.utime(entry_path)
+  except (OSError, ValueError):
+    return None
+  return entry
+
+#Entries are written to a temporary file first, so an interrupted run never leaves a broken entry behind
+def store_entry(cache_dir, key, entry, max_bytes):
+  Path(cache_dir).mkdir(parents=True, exist_ok=True)
+  entry_path = Path(cache_dir) / (key + '.json')
+  temp_path = Path(cache_dir) / (key + '.tmp')
+  with open(temp_path, 'w') as entry_file:
+    json.dump(entry, entry_file, separators=(',', ':'))
+  os.replace(temp_path, entry_path)
+  evict(cache_dir, max_bytes)
+
+#Delete the least recently used entries until the cache fits into max_bytes
+def evict(cache_dir, max_bytes):
+  entries = []
+  for entry_path in Path(cache_dir).glob('*.json'):
+    try: stat = entry_path.stat()
+    except OSError: continue
+    entries.append((stat.st_mtime, stat.st_size, entry_path))
+  total = sum(entry[1] for entry in entries)
+  for mtime, size, entry_path in sorted(entries, key=lambda entry: entry[0]):
+    if total <= max_bytes: break
+    try: entry_path.unlink()
+    except OSError: continue
+    total -= size
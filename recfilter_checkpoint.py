@@ -0,0 +1,84 @@
+# Checkpoints of RecFilter3's analysis
+# Every analysed sample is appended to a journal right away, so an interrupted run continues after the last one.
+# The journal starts with a key of the recording and the sampling settings, and every line carries a checksum.
+# A journal of another recording or other settings is ignored, reading stops at the first line a crash tore apart.
+import json
+import os
+import zlib
+
+def checked_line(entry):
+  data = json.dumps(entry, separators=(',', ':'))
+  return '%08x' % zlib.crc32(data.encode()) + ' ' + data + '\n'
+
+#Returns the entry of a line written by checked_line() or None if the line is incomplete or damaged
+def read_checked_line(line):
+  if not line.endswith('\n'): return None
+  checksum, _, data = line.rstrip('\n').partition(' ')
+  if checksum != '%08x' % zlib.crc32(data.encode()): return None
+  try: return json.loads(data)
+  except ValueError: return None
+
+class AnalysisJournal:
+  def __init__(self, path, key, sync_every=8):
+    self.path = path
+    self.key = key
+    self.sync_every = sync_every
+    self.journal_file = None
+    self.unsynced = 0
+
+  #The samples [timestamp, name, detections] of an earlier run with the same key
+  def load(self):
+    samples = []
+    try:
+      with open(self.path, 'r') as journal_file:
+        header = read_checked_line(journal_file.readline())
+        if (header is None) or (header.get('key') != self.key): return []
+        for line in journal_file:
+          sample = read_checked_line(line)
+          if sample is None: break
+          samples.append(sample)
+    except OSError:
+      return []
+    return samples
+
+  #Starts a new journal holding the given samples, written to a temporary file first so the old one stays valid until then
+  def start(self, samples=()):
+    temp_path = self.path + '.tmp'
+    with open(temp_path, 'w') as journal_file:
+      journal_file.write(checked_line({'key': self.key}))
+      for sample in samples: journal_file.write(checked_line(sample))
+      journal_file.flush()
+      os.fsync(journal_file.fileno())
+    os.replace(temp_path, self.path)
+    self.journal_file = open(self.path, 'a')
+
+  #Every line is flushed at once, every sync_every lines are synced to the disk as well
+  def append(self, sample):
+    self.journal_file.write(checked_line(sample))
+    self.journal_file.flush()
+    self.unsynced += 1
+    if self.unsynced >= self.sync_every:
+      os.fsync(self.journal_file.fileno())
+      self.unsynced = 0
+
+  def close(self):
+    if self.journal_file is not None:
+      self.journal_file.close()
+      self.journal_file = None
+
+  def remove(self):
+    self.close()
+    if os.path.exists(self.path): os.remove(self.path)
+
+#A marker that the files of a step are complete, holding the key they were created with
+def write_marker(path, key):
+  with open(path, 'w') as marker_file:
+    marker_file.write(checked_line({'key': key}))
+
+def marker_matches(path, key):
+  try:
+    with open(path, 'r') as marker_file:
+      marker = read_checked_line(marker_file.readline())
+  except OSError:
+    return False
+  return (marker is not None) and (marker.get('key') == key)
@@ -0,0 +1,23 @@
+# Cleanups of a RecFilter3 run
+# A run registers what has to happen when it ends, e.g. deleting its temporary files, here instead of with atexit.
+# A run of its own does them when Python exits. A worker that runs one job after the other does them after every job,
+# without touching the exit functions of Python and its libraries.
+import atexit
+import traceback
+
+cleanups = []
+
+def register_cleanup(function, *args):
+  cleanups.append((function, args))
+
+def unregister_cleanup(function):
+  cleanups[:] = [cleanup for cleanup in cleanups if cleanup[0] != function]
+
+#Last registered first like atexit, a failing cleanup doesn't stop the others
+def run_cleanups():
+  while cleanups:
+    function, args = cleanups.pop()
+    try: function(*args)
+    except Exception: traceback.print_exc()
+
+atexit.register(run_cleanups)
@@ -0,0 +1,280 @@
+# Daemon mode of RecFilter3
+# Recordings from watched folders or a local socket are queued and handed to long-running worker processes.
+# Every worker runs RecFilter3 in-process, so nudenet, onnxruntime and the model are only loaded once per worker.
+# The queue is kept in a json file, jobs that were queued or running when the daemon stopped are picked up again.
+import gc
+import json
+import os
+import runpy
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import yaml
+from pathlib import Path
+
+video_extensions = ('.mp4', '.mkv', '.ts', '.flv', '.mov', '.avi', '.webm', '.m4v')
+default_state_path = Path.home() / '.RecFilter3' / 'daemon_jobs.json'
+
+def current_time():
+  return time.strftime("%H:%M:%S", time.localtime())
+
+#Options of the daemon itself, everything else on the command line is passed on to every job
+daemon_options = ['--watch', '--port', '--jobs', '--poll']
+def job_default_args(argv):
+  job_args = []
+  skip_value = False
+  for arg in argv:
+    if skip_value:
+      skip_value = False
+    elif arg == '--daemon': continue
+    elif arg in daemon_options: skip_value = True
+    elif arg.split('=')[0] in daemon_options: continue
+    else: job_args.append(arg)
+  return job_args
+
+#Output files are named after the recording plus a filesuffix of the config, they must not be queued again
+def output_suffixes(config_path):
+  suffixes = set()
+  try:
+    with open(config_path, 'r') as config_file:
+      config = yaml.safe_load(config_file) or {}
+    for preset_dict in config.values():
+      if isinstance(preset_dict, dict) and preset_dict.get('filesuffix'): suffixes.add(str(preset_dict.get('filesuffix')).replace(' ', '_'))
+  except (OSError, yaml.YAMLError): pass
+  return tuple(suffixes) + tuple(suffix + '_negative' for suffix in suffixes) + ('_negative',)
+
+class JobQueue:
+  def __init__(self, state_path):
+    self.state_path = Path(state_path)
+    self.changed = threading.Condition()
+    self.jobs = []
+    self.seen = set()
+    self.first_start = not self.state_path.exists()
+    if not self.first_start:
+      with open(self.state_path, 'r') as state_file:
+        state = json.load(state_file)
+      self.jobs = state.get('jobs', [])
+      self.seen = set(state.get('seen', []))
+      #a job that was running when the daemon stopped is started again from the beginning
+      for job in self.jobs:
+        if job['state'] == 'running': job['state'] = 'queued'
+
+  #Written to a temporary file first, so a crash never leaves a broken queue behind
+  def save(self):
+    self.state_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = self.state_path.with_suffix('.tmp')
+    with open(temp_path, 'w') as state_file:
+      json.dump({'jobs': self.jobs, 'seen': sorted(self.seen)}, state_file, indent=1)
+    os.replace(temp_path, self.state_path)
+
+  def add(self, args):
+    with self.changed:
+      for job in self.jobs:
+        if job['args'] == args and job['state'] in ('queued', 'running'): return job
+      job = {'id': max([job['id'] for job in self.jobs] + [0]) + 1, 'args': args, 'state': 'queued', 'added': time.time()}
+      self.jobs.append(job)
+      self.save()
+      self.changed.notify_all()
+    print(current_time() + ' INFO:  Queued job ' + str(job['id']) + ': ' + ' '.join(args))
+    return job
+
+  #Blocks until a job is queued
+  def take(self):
+    with self.changed:
+      while True:
+        for job in self.jobs:
+          if job['state'] == 'queued':
+            job['state'] = 'running'
+            job['started'] = time.time()
+            self.save()
+            return job
+        self.changed.wait()
+
+  def finish(self, job, state, result):
+    with self.changed:
+      job['state'] = state
+      job['result'] = result
+      job['finished'] = time.time()
+      self.save()
+
+  def mark_seen(self, paths):
+    with self.changed:
+      self.seen.update(paths)
+      self.save()
+
+#Queue new recordings of a folder once their size and modification time didn't change between two polls
+def watch_folder(jobs, folder, args, suffixes, poll_interval):
+  folder = Path(folder)
+  candidates = {}
+  if jobs.first_start:
+    jobs.mark_seen([str(path) for path in folder.iterdir() if path.is_file()])
+  while True:
+    current = {}
+    for path in folder.iterdir():
+      if (not path.is_file()) or (path.suffix.lower() not in video_extensions) or path.stem.endswith(suffixes): continue
+      if str(path) in jobs.seen: continue
+      try: stat = path.stat()
+      except OSError: continue
+      current[str(path)] = (stat.st_size, stat.st_mtime_ns)
+    for path, signature in current.items():
+      if candidates.get(path) == signature:
+        jobs.mark_seen([path])
+        jobs.add([path] + args)
+    candidates = current
+    time.sleep(poll_interval)
+
+#Unix domain socket that only the user running the daemon can connect to where available, a port on localhost otherwise (Windows)
+#Every job runs as that user and writes wherever its arguments say, so no other user may queue jobs
+def daemon_address(port):
+  if hasattr(socket, 'AF_UNIX'): return str(Path.home() / '.RecFilter3' / ('daemon_' + str(port) + '.sock'))
+  return ('127.0.0.1', port)
+
+#Accepts one job per line, either a path or a json list of RecFilter3 arguments, e.g. ["rec.mp4", "-p", "freddo"]
+#The reply is the id of the queued job
+def serve_socket(jobs, port, args):
+  class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+      for line in self.rfile:
+        line = line.decode(errors='replace').strip()
+        if not line: continue
+        if line.startswith('['): job_args = [str(arg) for arg in json.loads(line)]
+        else: job_args = [line]
+        job_args[0] = os.path.abspath(job_args[0])
+        #arguments sent with the job override the daemon's defaults, since argparse keeps the last value
+        job = jobs.add(job_args[:1] + args + job_args[1:])
+        self.wfile.write((str(job['id']) + '\n').encode())
+  address = daemon_address(port)
+  if isinstance(address, str):
+    Path(address).parent.mkdir(parents=True, exist_ok=True)
+    #a socket file left behind by a daemon that didn't stop cleanly
+    if Path(address).exists(): os.remove(address)
+    server = socketserver.ThreadingUnixStreamServer(address, JobHandler, bind_and_activate=False)
+    #the socket is created with permissions for the user only, there is no moment another user could connect
+    old_umask = os.umask(0o177)
+    try: server.server_bind()
+    finally: os.umask(old_umask)
+    os.chmod(address, 0o600)
+    server.server_activate()
+  else:
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(address, JobHandler)
+  server.daemon_threads = True
+  with server:
+    server.serve_forever()
+
+#Sends a job to a running daemon, returns the job id or None if no daemon is listening
+def submit(port, args):
+  address = daemon_address(port)
+  try:
+    if isinstance(address, str): connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else: connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    with connection:
+      connection.settimeout(5)
+      connection.connect(address)
+      connection.sendall((json.dumps(args) + '\n').encode())
+      connection.shutdown(socket.SHUT_WR)
+      reply = connection.makefile('r').readline().strip()
+  except OSError:
+    return None
+  return reply or None
+
+#State and message of a job that ended with SystemExit. RecFilter3 exits with an INFO message when there is nothing to do,
+#eg. no segments found, any other message or exit code means it failed.
+def exit_state(code):
+  if code in (None, 0): return 'done', ''
+  result = str(code)
+  if isinstance(code, str) and (' INFO:  ' in result): return 'done', result
+  return 'failed', result
+
+#Workers that don't analyse anything can leave the model out
+def start_worker(script_path, load_model=True):
+  worker_cmd = [sys.executable, os.path.abspath(__file__), 'worker', str(script_path)]
+  if not load_model: worker_cmd.append('nomodel')
+  return subprocess.Popen(worker_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+#Runs RecFilter3 with args in the worker, returns the reply and the worker for the next job
+def run_in_worker(process, script_path, args, load_model=True):
+  try:
+    process.stdin.write(json.dumps(args) + '\n')
+    process.stdin.flush()
+    reply = json.loads(process.stdout.readline())
+  except (OSError, ValueError):
+    #the worker died, the job fails and the next one gets a new worker
+    reply = {'state': 'failed', 'result': 'Worker process ended unexpectedly'}
+    process.kill()
+    process = start_worker(script_path, load_model)
+  return reply, process
+
+def run_jobs(jobs, script_path):
+  process = start_worker(script_path)
+  while True:
+    job = jobs.take()
+    print(current_time() + ' INFO:  Starting job ' + str(job['id']) + ': ' + ' '.join(job['args']))
+    reply, process = run_in_worker(process, script_path, job['args'])
+    jobs.finish(job, reply['state'], reply['result'])
+    print(current_time() + ' INFO:  Job ' + str(job['id']) + ' ' + reply['state'] + ': ' + str(reply['result']).strip())
+
+#watch: list of (folder, preset or None)
+def run_daemon(script_path, argv, watch, port, job_count, poll_interval, state_path=default_state_path):
+  jobs = JobQueue(state_path)
+  args = job_default_args(argv)
+  if '-q' not in args and '--quiet' not in args: args.append('-q')
+  suffixes = output_suffixes(os.path.splitext(script_path)[0] + '.config')
+  print(current_time() + ' INFO:  Daemon started with ' + str(job_count) + ' worker(s), job queue: ' + str(jobs.state_path))
+  for job in jobs.jobs:
+    if job['state'] == 'queued': print(current_time() + ' INFO:  Resuming job ' + str(job['id']) + ': ' + ' '.join(job['args']))
+  threads = []
+  for folder, preset in watch:
+    if preset: folder_args = args + ['-p', preset]
+    else: folder_args = args
+    print(current_time() + ' INFO:  Watching ' + str(folder))
+    threads.append(threading.Thread(target=watch_folder, args=(jobs, folder, folder_args, suffixes, poll_interval), daemon=True))
+  if port:
+    print(current_time() + ' INFO:  Accepting jobs on ' + str(daemon_address(port)))
+    threads.append(threading.Thread(target=serve_socket, args=(jobs, port, args), daemon=True))
+  for i in range(job_count):
+    threads.append(threading.Thread(target=run_jobs, args=(jobs, script_path), daemon=True))
+  for thread in threads: thread.start()
+  try:
+    while True: time.sleep(3600)
+  except KeyboardInterrupt:
+    print(current_time() + ' INFO:  Daemon stopped, unfinished jobs are resumed on the next start')
+
+#A worker runs one job at a time as if RecFilter3 had been started with the job's arguments
+#nudenet, onnxruntime and the detector loaded by the first job stay in memory for the following ones
+if __name__ == '__main__' and len(sys.argv) in (3, 4) and sys.argv[1] == 'worker':
+  script_path = sys.argv[2]
+  #The protocol keeps the original stdin and stdout, RecFilter3's output goes to stderr and it can't wait for input
+  channel_in = os.fdopen(os.dup(sys.stdin.fileno()), 'r')
+  channel_out = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+  os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+  sys.stdin = open(os.devnull, 'r')
+  sys.path.insert(0, os.path.dirname(os.path.abspath(script_path)))
+  from recfilter_cleanup import run_cleanups
+  if sys.argv[3:] != ['nomodel']:
+    from recfilter_detector import shared_detector
+    shared_detector()
+  for line in channel_in:
+    sys.argv = [script_path] + json.loads(line)
+    workdir = os.getcwd()
+    state = 'done'
+    result = ''
+    try:
+      runpy.run_path(script_path, run_name='__main__')
+    except SystemExit as exit_status:
+      state, result = exit_state(exit_status.code)
+    except BaseException as job_error:
+      state = 'failed'
+      result = repr(job_error)
+    finally:
+      #release the job's memory-mapped analysis files first, on Windows they couldn't be deleted otherwise
+      gc.collect()
+      #what RecFilter3 registered to run at its end, e.g. deleting the temporary files
+      run_cleanups()
+      os.chdir(workdir)
+    sys.stdout.flush()
+    channel_out.write(json.dumps({'state': state, 'result': result}) + '\n')
+    channel_out.flush()
@@ -0,0 +1,64 @@
+# Deduplication of near-identical samples for RecFilter3
+# Every sample gets a 64 bit difference hash of its brightness. A sample whose hash is at most max_distance bits away
+# from the hash of the last sample NudeNet analysed gets that sample's detections instead of being analysed itself.
+# After max_reuse samples in a row the next one is analysed again, so a slow change can't hide behind the same detections.
+from collections import deque
+import numpy as np
+
+#Brightness of a BGR frame in 8 rows of 9 blocks, every block is compared with its right neighbour
+def frame_hash(frame):
+  height, width = frame.shape[:2]
+  #every few pixels are enough for the block averages
+  step = max(1, min(height, width) // 64)
+  small = frame[::step, ::step]
+  rows = (small.shape[0] // 8) * 8
+  columns = (small.shape[1] // 9) * 9
+  gray = small[:rows, :columns].astype(np.float32)
+  if gray.ndim == 3: gray = gray @ np.array([0.114, 0.587, 0.299], dtype=np.float32)
+  blocks = gray.reshape(8, rows // 8, 9, columns // 9).mean(axis=(1, 3))
+  return int.from_bytes(np.packbits(blocks[:, 1:] > blocks[:, :-1]).tobytes(), 'big')
+
+#Image files are read at an eighth of their size, OpenCV comes with NudeNet
+def sample_hash(sample):
+  if isinstance(sample, np.ndarray): return frame_hash(sample)
+  import cv2
+  image = cv2.imread(str(sample), cv2.IMREAD_REDUCED_COLOR_8)
+  if image is None: return None
+  return frame_hash(image)
+
+def hash_distance(first, second):
+  return bin(first ^ second).count('1')
+
+#Yields (key, detections, reused from key or None) for (key, image file or BGR frame) items, in the order of items
+#detect(items) yields (key, detections) for the items that are analysed
+def deduplicated(items, detect, max_distance, max_reuse):
+  pending = deque()
+  waiting = {}
+  reference = {'hash': None, 'entry': None, 'reused': 0}
+
+  def analysed_items():
+    for key, sample in items:
+      sample_bits = sample_hash(sample)
+      if (sample_bits is not None) and (reference['hash'] is not None) and (reference['reused'] < max_reuse) and (hash_distance(sample_bits, reference['hash']) <= max_distance):
+        reference['reused'] += 1
+        pending.append([key, None, reference['entry']])
+        continue
+      entry = [key, None, None]
+      reference.update({'hash': sample_bits, 'entry': entry, 'reused': 0})
+      waiting[key] = entry
+      pending.append(entry)
+      yield key, sample
+
+  #a reused sample waits until the sample it reuses is analysed
+  def ready():
+    while pending:
+      key, detections, source = pending[0]
+      if source is not None: detections = source[1]
+      if detections is None: return
+      pending.popleft()
+      yield key, detections, (source[0] if source is not None else None)
+
+  for key, detections in detect(analysed_items()):
+    waiting.pop(key)[1] = detections
+    yield from ready()
+  yield from ready()
@@ -0,0 +1,218 @@
+# NudeNet analysis engine for RecFilter3
+# Samples are preprocessed like NudeDetector.detect() does it, but several of them share one ONNX Runtime pass
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import threading
+import numpy as np
+import onnxruntime
+from nudenet import NudeDetector
+from nudenet.detector import FILE_URLS
+from nudenet.detector_utils import preprocess_image
+
+#min_side, max_side and needed certainty, identical to NudeDetector.detect()
+detect_modes = {
+  'default': (800, 1333, 0.6),
+  'fast': (480, 800, 0.5)
+}
+
+#NudeNet's caffe style preprocessing subtracts this mean from every BGR pixel
+caffe_mean = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+
+#ffmpeg filter that scales frames to the size NudeNet would resize them to, the short side to min_side unless the long side
+#gets longer than max_side. The model has no fixed input shape, so nothing needs to be padded.
+def native_scale_filter(mode='default'):
+  min_side, max_side, min_prob = detect_modes[mode]
+  return 'scale=\'if(gte(iw,ih),' + str(max_side) + ',' + str(min_side) + ')\':\'if(gte(iw,ih),' + str(min_side) + ',' + str(max_side) + ')\':force_original_aspect_ratio=decrease'
+
+#A frame of native size only needs the mean subtracted, its boxes are scaled to a sample with a long side of native_side
+def preprocess_native(frame, native_side):
+  return frame.astype(np.float32) - caffe_mean, max(frame.shape[:2]) / native_side
+
+#Where NudeDetector downloads its model and the list of its classes to
+model_folder = os.path.join(os.path.expanduser('~'), '.NudeNet')
+checkpoint_path = os.path.join(model_folder, os.path.basename(FILE_URLS['default']['checkpoint']))
+classes_path = os.path.join(model_folder, 'classes')
+
+#Name and size of the checkpoint, results of different models must not be mixed up
+def model_version():
+  try: return os.path.basename(checkpoint_path) + ':' + str(os.path.getsize(checkpoint_path))
+  except OSError: return os.path.basename(checkpoint_path)
+
+#Downloads the model the first time like NudeDetector does
+def download_model():
+  import pydload
+  os.makedirs(model_folder, exist_ok=True)
+  for path, url in ((checkpoint_path, FILE_URLS['default']['checkpoint']), (classes_path, FILE_URLS['default']['classes'])):
+    if not os.path.exists(path):
+      print('Downloading', os.path.basename(path), 'to', path)
+      pydload.dload(url, save_to_path=path, max_time=None)
+
+#NudeDetector with its ONNX Runtime session limited to the given number of threads (0 = all cores)
+#The session is created here instead of in NudeDetector(), which would load the model a second time without the limits
+def load_detector(intra_op_threads=0, inter_op_threads=0):
+  download_model()
+  options = onnxruntime.SessionOptions()
+  if intra_op_threads or inter_op_threads:
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+  detector = NudeDetector.__new__(NudeDetector)
+  detector.detection_model = onnxruntime.InferenceSession(checkpoint_path, options, providers=onnxruntime.get_available_providers())
+  with open(classes_path, 'r') as classes_file:
+    detector.classes = [line.strip() for line in classes_file if line.strip()]
+  return detector
+
+#The model is only loaded once it is needed and then kept for the lifetime of the process
+shared = None
+def shared_detector():
+  global shared
+  if shared is None: shared = load_detector()
+  return shared
+
+def run_session(detector, images):
+  session = detector.detection_model
+  return session.run([output.name for output in session.get_outputs()], {session.get_inputs()[0].name: np.stack(images)})
+
+#Turn the model outputs back into NudeNet's detection dicts, one list per image of the batch
+def process_outputs(detector, outputs, scales, min_prob):
+  labels = [op for op in outputs if op.dtype == 'int32'][0]
+  scores = [op for op in outputs if isinstance(op[0][0], np.float32)][0]
+  boxes = [op for op in outputs if isinstance(op[0][0], np.ndarray)][0]
+  results = []
+  for image_boxes, image_scores, image_labels, scale in zip(boxes, scores, labels, scales):
+    image_boxes = image_boxes / scale
+    detections = []
+    for box, score, label in zip(image_boxes, image_scores, image_labels):
+      if score < min_prob: continue
+      box = box.astype(int).tolist()
+      detections.append({'box': [int(c) for c in box], 'score': float(score), 'label': detector.classes[label]})
+    results.append(detections)
+  return results
+
+def analyse_batch(detector, batch, min_prob):
+  keys = [entry[0] for entry in batch]
+  images = [entry[1] for entry in batch]
+  scales = [entry[2] for entry in batch]
+  try:
+    outputs = run_session(detector, images)
+  except Exception:
+    #Models exported with a fixed batch dimension only accept one image at a time
+    if len(batch) == 1: raise
+    results = []
+    for image, scale in zip(images, scales):
+      results += process_outputs(detector, run_session(detector, [image]), [scale], min_prob)
+    return zip(keys, results)
+  return zip(keys, process_outputs(detector, outputs, scales, min_prob))
+
+#Yields (key, detections) for every (key, image) of items in the same order
+#An image can be a file path or a BGR frame array. Only images of the same size can share a batch.
+#With native_side the frames were scaled by native_scale_filter(), their boxes refer to samples with that long side
+def detect_batched(detector, items, batch_size=1, mode='default', native_side=None):
+  min_side, max_side, min_prob = detect_modes[mode]
+  batch = []
+  for key, image in items:
+    if native_side and isinstance(image, np.ndarray): image, scale = preprocess_native(image, native_side)
+    else: image, scale = preprocess_image(image, min_side=min_side, max_side=max_side)
+    if batch and ((len(batch) >= batch_size) or (image.shape != batch[0][1].shape)):
+      yield from analyse_batch(detector, batch, min_prob)
+      batch = []
+    batch.append((key, image, scale))
+  if batch: yield from analyse_batch(detector, batch, min_prob)
+
+def chunks(items, size):
+  chunk = []
+  for item in items:
+    chunk.append(item)
+    if len(chunk) >= size:
+      yield chunk
+      chunk = []
+  if chunk: yield chunk
+
+#Start a worker process with its own detector session, see the bottom of this file
+def start_worker(threads, batch_size, mode, native_side):
+  worker_cmd = [sys.executable, os.path.abspath(__file__), 'worker', str(threads), str(batch_size), mode, str(native_side or 0)]
+  return subprocess.Popen(worker_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+#Same as detect_batched(), but batches are spread over several worker processes
+#Every worker gets an equal share of the cores for its session, so they don't oversubscribe the CPU
+#The workers are started once and load the model once, every detect() of a run uses them until close()
+class DetectorPool:
+  def __init__(self, workers, batch_size=1, mode='default', native_side=None):
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    self.batch_size = batch_size
+    self.processes = [start_worker(threads, batch_size, mode, native_side) for i in range(workers)]
+
+  #Only a few batches per worker are queued at any time to keep the memory use of streamed frames bounded
+  def detect(self, items):
+    tasks = queue.Queue(maxsize=len(self.processes))
+    results = {}
+    finished = threading.Condition()
+
+    def feed_worker(process):
+      while True:
+        task = tasks.get()
+        if task is None: break
+        index, chunk = task
+        try:
+          pickle.dump(chunk, process.stdin, protocol=pickle.HIGHEST_PROTOCOL)
+          process.stdin.flush()
+          result = pickle.load(process.stdout)
+        except Exception as worker_error:
+          result = worker_error
+        with finished:
+          results[index] = result
+          finished.notify_all()
+
+    feeders = [threading.Thread(target=feed_worker, args=(process,), daemon=True) for process in self.processes]
+    for feeder in feeders: feeder.start()
+
+    def take(index, wait):
+      with finished:
+        while wait and (index not in results): finished.wait()
+        result = results.pop(index, None)
+      if isinstance(result, Exception): sys.exit('\nERROR:  NudeNet worker failed: ' + str(result))
+      return result
+
+    try:
+      submitted = 0
+      returned = 0
+      for chunk in chunks(items, self.batch_size):
+        tasks.put((submitted, chunk))
+        submitted += 1
+        #hand out finished results in the original order while feeding
+        result = take(returned, False)
+        while result is not None:
+          yield from result
+          returned += 1
+          result = take(returned, False)
+      while returned < submitted:
+        yield from take(returned, True)
+        returned += 1
+    finally:
+      #batches still queued are answered before the feeders stop, so no reply is left for the next detect()
+      for feeder in feeders: tasks.put(None)
+      for feeder in feeders: feeder.join()
+
+  def close(self):
+    for process in self.processes:
+      process.stdin.close()
+      process.wait()
+    self.processes = []
+
+if __name__ == '__main__' and len(sys.argv) == 6 and sys.argv[1] == 'worker':
+  #The protocol keeps the original stdout, everything printed goes to stderr instead
+  channel = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+  os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+  threads = int(sys.argv[2])
+  batch_size = int(sys.argv[3])
+  mode = sys.argv[4]
+  native_side = int(sys.argv[5]) or None
+  detector = load_detector(threads, 1)
+  while True:
+    try: chunk = pickle.load(sys.stdin.buffer)
+    except EOFError: break
+    pickle.dump(list(detect_batched(detector, chunk, batch_size, mode, native_side)), channel, protocol=pickle.HIGHEST_PROTOCOL)
+    channel.flush()
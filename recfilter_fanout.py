@@ -0,0 +1,67 @@
+# Fan-out of RecFilter3
+# A recording is sampled and analysed once and then cut for several presets or settings codes. After step 2 every plan runs
+# steps 3 to 6 on the analysis in the temporary folder, in a worker process and one after the other, as if RecFilter3 had
+# been started with its preset or code. The other options of the command line apply to every plan, the run's preset and
+# category only to the plans that are presets.
+import re
+import time
+from recfilter_daemon import start_worker, run_in_worker
+
+#The code RecFilter3 prints with the main settings, eg. v1m800i4g30e3d10w071215v1, m is min_score in thousandths
+settings_code_pattern = re.compile(r'v1((?:[a-z][0-9]+)*)w((?:[0-9]{2})*)(?:u((?:[0-9]{2})+))?v1')
+code_options = {'i': '-i', 'g': '-g', 'e': '-e', 'd': '-d'}
+
+def current_time():
+  return time.strftime("%H:%M:%S", time.localtime())
+
+def is_settings_code(plan):
+  return settings_code_pattern.fullmatch(plan) is not None
+
+#Command line options of a settings code, code_labels maps the two digit tag codes to the exact labels
+def settings_code_args(code, code_labels):
+  match = settings_code_pattern.fullmatch(code)
+  args = []
+  for key, value in re.findall(r'([a-z])([0-9]+)', match.group(1)):
+    if key == 'f':
+      if value == '1': args.append('-f')
+    elif key == 'm': args += ['-m', str(int(value) / 1000)]
+    elif key in code_options: args += [code_options[key], value]
+    else: raise ValueError('Setting ' + key + ' of code ' + code + ' is unknown')
+  for option, tag_codes in (('-w', match.group(2)), ('-u', match.group(3))):
+    codes = re.findall(r'[0-9]{2}', tag_codes or '')
+    unknown = [tag_code for tag_code in codes if tag_code not in code_labels]
+    if unknown: raise ValueError('Tag code ' + unknown[0] + ' of code ' + code + ' is unknown')
+    if codes: args += [option, ','.join(code_labels[tag_code] for tag_code in codes)]
+  return args
+
+#The preset of the run, a settings code holds all the settings of its plan and starts from the default preset instead
+preset_options = ('-p', '--preset', '-c', '--category')
+
+#The plans are taken out of the command line, everything else is passed on to every plan, except the options in drop and their values
+def fanout_args(argv, file=None, drop=()):
+  args = []
+  in_fanout = False
+  drop_value = False
+  for arg in argv:
+    if drop_value: drop_value = False
+    elif arg == '--fanout': in_fanout = True
+    elif in_fanout and not arg.startswith('-'): continue
+    else:
+      in_fanout = False
+      if arg in drop: drop_value = True
+      elif (arg.split('=')[0] in drop) or (not arg.startswith('--') and arg[:2] in drop): continue
+      else: args.append(arg)
+  if file in args: args.remove(file)
+  return args
+
+#plans: list of (name, RecFilter3 arguments), returns the number of plans that failed
+def run_fanout(script_path, plans):
+  process = start_worker(script_path, False)
+  failed = 0
+  for name, args in plans:
+    print(current_time() + ' INFO:  Fan-out: Cutting for ' + name)
+    reply, process = run_in_worker(process, script_path, args, False)
+    if reply['state'] != 'done': failed += 1
+    print(current_time() + ' INFO:  Fan-out: ' + name + ' ' + reply['state'] + (': ' + str(reply['result']).strip() if reply['result'] else ''))
+  process.stdin.close()
+  return failed
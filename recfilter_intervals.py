@@ -0,0 +1,50 @@
+# Interval engine for RecFilter3's cut planning
+# Works on whole NumPy arrays, so planning a day-long recording sampled every second takes milliseconds
+import numpy as np
+
+#Turns matched sample timestamps into (starts, ends) of the segments to keep
+#Every match is widened by extension, matches closer than gap are merged into one segment,
+#segments are clipped to [0, duration] and dropped if shorter than min_duration
+#reaches optionally gives the time up to which each match holds, e.g. the next sample when samples are unevenly spaced
+def plan_segments(timestamps, extension, gap, min_duration, duration, reaches=None):
+  timestamps = np.asarray(timestamps)
+  if timestamps.size == 0: return timestamps.copy(), timestamps.copy()
+  if reaches is None: reaches = timestamps
+  #Make sure the timestamps are in ascending order, a match never ends before an earlier one
+  order = np.argsort(timestamps, kind='stable')
+  timestamps = timestamps[order]
+  reaches = np.maximum.accumulate(np.maximum(np.asarray(reaches)[order], timestamps))
+  starts = timestamps - extension
+  ends = reaches + extension
+  #a new segment begins wherever the space to the previous widened match is larger than gap
+  breaks = np.flatnonzero(starts[1:] - ends[:-1] > gap) + 1
+  segment_starts = np.clip(starts[np.r_[0, breaks]], 0, duration)
+  segment_ends = np.clip(ends[np.r_[breaks - 1, timestamps.size - 1]], 0, duration)
+  lengths = segment_ends - segment_starts
+  keep = (lengths > 0) & (lengths >= min_duration)
+  return segment_starts[keep], segment_ends[keep]
+
+#All parts of [0, duration] not covered by the segments, e.g. for --negative
+def complement_segments(starts, ends, duration):
+  starts = np.asarray(starts)
+  ends = np.asarray(ends)
+  gap_starts = np.r_[0, ends]
+  gap_ends = np.r_[starts, duration]
+  keep = gap_ends > gap_starts
+  return gap_starts[keep], gap_ends[keep]
+
+#Moves every segment start to the keyframe at or before it and every end to the keyframe at or after it, which is where
+#a stream copy cuts anyway. Segments that overlap or come closer than gap afterwards are merged.
+#A start in front of the first keyframe becomes 0, an end behind the last keyframe becomes duration.
+def snap_segments(starts, ends, keyframes, gap, duration):
+  starts = np.asarray(starts, dtype=float)
+  ends = np.asarray(ends, dtype=float)
+  keyframes = np.asarray(keyframes, dtype=float)
+  if (starts.size == 0) or (keyframes.size == 0): return starts, ends
+  before = np.searchsorted(keyframes, starts, side='right') - 1
+  starts = np.where(before >= 0, keyframes[np.maximum(before, 0)], 0)
+  after = np.searchsorted(keyframes, ends, side='left')
+  ends = np.minimum(np.where(after < keyframes.size, keyframes[np.minimum(after, keyframes.size - 1)], duration), duration)
+  ends = np.maximum.accumulate(ends)
+  breaks = np.flatnonzero(starts[1:] - ends[:-1] > gap) + 1
+  return starts[np.r_[0, breaks]], ends[np.r_[breaks - 1, starts.size - 1]]
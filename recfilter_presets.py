@@ -0,0 +1,87 @@
+# Compiled presets of RecFilter3
+# The config is parsed once and compiled into an index by preset name. Every entry holds the preset's values, its category
+# and the chain of presets it inherits from, so a run only walks the chain of the preset it uses instead of the whole config.
+# The index is kept in the cache directory and stays valid as long as size and modification time of the config don't change.
+import hashlib
+import os
+import yaml
+from pathlib import Path
+from recfilter_cache import load_entry, store_entry
+
+presets_version = 1
+
+#Follows the inherits of name, end is 'default' when the chain ends on its own, 'missing' when it inherits a preset
+#that doesn't exist and 'cycle' when it comes back to a preset that is already in the chain
+def inherit_chain(name, inherits):
+  chain = [name]
+  target = inherits.get(name)
+  while target:
+    if target not in inherits: return chain, 'missing'
+    if target in chain: return chain + [target], 'cycle'
+    chain.append(target)
+    target = inherits.get(target)
+  return chain, 'default'
+
+#invalid_key is the first [preset, key] that isn't in valid_keys, None if there is none
+def compile_presets(config, valid_keys):
+  valid_keys = set(valid_keys)
+  index = {'version': presets_version, 'keys': sorted(valid_keys), 'invalid_key': None, 'presets': {}}
+  inherits = {}
+  for name, settings in (config or {}).items():
+    settings = settings or {}
+    if index['invalid_key'] is None:
+      for key in settings:
+        if key not in valid_keys:
+          index['invalid_key'] = [str(name), str(key)]
+          break
+    if not isinstance(settings, dict): continue
+    inherit = settings.get('inherit')
+    inherits[str(name)] = inherit if isinstance(inherit, str) else None
+    index['presets'][str(name)] = {'settings': settings, 'category': settings.get('category')}
+  for name, entry in index['presets'].items():
+    entry['chain'], entry['end'] = inherit_chain(name, inherits)
+  return index
+
+def presets_key(config_path):
+  return 'presets-' + hashlib.sha1(str(Path(config_path).resolve()).encode()).hexdigest()
+
+#Returns the compiled presets of the config, the yaml is only parsed when the config or the valid keys changed.
+#cache_dir None compiles without the cache. Errors of the yaml parser are passed on.
+def load_presets(config_path, valid_keys, cache_dir=None, max_bytes=0):
+  stat = os.stat(config_path)
+  if cache_dir is not None:
+    index = load_entry(cache_dir, presets_key(config_path))
+    if index and (index.get('version') == presets_version) and (index.get('size') == stat.st_size) and (index.get('mtime') == stat.st_mtime_ns) and (index.get('keys') == sorted(set(valid_keys))):
+      return index
+  with open(config_path, 'r') as config_file:
+    config = yaml.safe_load(config_file)
+  index = compile_presets(config, valid_keys)
+  index['size'] = stat.st_size
+  index['mtime'] = stat.st_mtime_ns
+  if cache_dir is not None:
+    #yaml knows types json doesn't, eg. dates, such a config is compiled on every run
+    try: store_entry(cache_dir, presets_key(config_path), index, max_bytes)
+    except (OSError, TypeError, ValueError): pass
+  return index
+
+#Names of the presets to apply in this order: the preset and the presets it inherits, then default and its inherits.
+#With a category only presets of that category are applied, the first one that doesn't match ends the chain.
+#A chain that inherits a missing preset doesn't fall back to default.
+def resolve_presets(index, preset, category=False):
+  presets = index['presets']
+  found = []
+  def follow(name):
+    entry = presets[name]
+    if entry['end'] == 'cycle': raise ValueError('Preset ' + name + ' inherits itself: ' + ' -> '.join(entry['chain']))
+    for chain_name in entry['chain']:
+      if (chain_name in found) or (category and presets[chain_name]['category'] != category): return 'default'
+      found.append(chain_name)
+    return entry['end']
+  end = follow(preset) if preset in presets else 'default'
+  if (end == 'default') and ('default' in presets) and ('default' not in found): follow('default')
+  return found
+
+#Suffix of the output files of a preset, the filesuffix values of its chain with the first preset last
+def preset_suffix(index, preset, category=False):
+  suffixes = [index['presets'][name]['settings'].get('filesuffix') for name in resolve_presets(index, preset, category)]
+  return ''.join(reversed([suffix for suffix in suffixes if isinstance(suffix, str)])).replace(' ', '_')
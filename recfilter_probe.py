@@ -0,0 +1,74 @@
+# Probe index of a recording for RecFilter3
+# A single ffprobe run reads the container without decoding anything and collects the duration, the first video stream,
+# its first and last timestamp and all of its keyframes. The index is kept in the cache directory and stays valid
+# as long as size and modification time of the recording don't change.
+import hashlib
+import os
+import subprocess
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from recfilter_cache import load_entry, store_entry
+
+index_version = 2
+
+def parse_value(value):
+  try: return float(value)
+  except ValueError: return None
+
+#Returns the index of a recording, packets=False only asks for the duration and the stream, which a growing recording needs
+def probe_recording(path, packets=True):
+  entries = 'format=duration,size,format_name:stream=codec_name,pix_fmt,width,height,avg_frame_rate,time_base,start_time'
+  if packets: entries += ':packet=pts_time,dts_time,pos,flags'
+  stat = os.stat(path)
+  index = {'version': index_version, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'duration': None, 'video': {}, 'packets': 0, 'first_pts': None, 'last_pts': None, 'keyframes': []}
+  probe_cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', entries, '-of', 'compact', '-i', str(path)]
+  probe_process = subprocess.Popen(probe_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+  for line in probe_process.stdout:
+    section, _, fields = line.rstrip('\n').partition('|')
+    fields = dict(field.partition('=')[::2] for field in fields.split('|'))
+    if section == 'packet':
+      index['packets'] += 1
+      pts = parse_value(fields.get('pts_time', ''))
+      if pts is None: continue
+      if (index['first_pts'] is None) or (pts < index['first_pts']): index['first_pts'] = pts
+      if (index['last_pts'] is None) or (pts > index['last_pts']): index['last_pts'] = pts
+      if fields.get('flags', '').startswith('K'):
+        #Matroska has no decoding timestamps, ffprobe leaves the first one out
+        dts = parse_value(fields.get('dts_time', ''))
+        if dts is None: dts = pts
+        pos = fields.get('pos', '')
+        index['keyframes'].append([pts, dts, int(pos) if pos.isdigit() else None])
+    elif section == 'stream':
+      index['video'] = {key: parse_value(value) if key in ('width', 'height', 'start_time') else value for key, value in fields.items()}
+    elif section == 'format':
+      index['duration'] = parse_value(fields.get('duration', ''))
+      index['format'] = fields.get('format_name')
+  if probe_process.wait() != 0: raise subprocess.CalledProcessError(probe_process.returncode, probe_cmd)
+  index['keyframes'].sort()
+  #the duration is missing from some containers, the last frame is as far as the recording goes then
+  if index['duration'] is None: index['duration'] = index['last_pts']
+  if index['duration'] is None: raise ValueError('ffprobe found no duration of ' + str(path))
+  return index
+
+#Indexes are stored under the path of the recording, a changed recording replaces its entry
+def index_key(path):
+  return 'index-' + hashlib.sha1(str(Path(path).resolve()).encode()).hexdigest()
+
+def load_index(cache_dir, path):
+  index = load_entry(cache_dir, index_key(path))
+  if not index: return None
+  stat = os.stat(path)
+  if (index.get('version') != index_version) or (index.get('size') != stat.st_size) or (index.get('mtime') != stat.st_mtime_ns): return None
+  return index
+
+def store_index(cache_dir, path, index, max_bytes):
+  store_entry(cache_dir, index_key(path), index, max_bytes)
+
+#The (pts, dts) of the last keyframe at or before and the first one at or after timestamp, None where there is none
+def keyframes_around(index, timestamp):
+  keyframe_times = [keyframe[0] for keyframe in index['keyframes']]
+  before = bisect_right(keyframe_times, timestamp)
+  after = bisect_left(keyframe_times, timestamp)
+  keyframe_before = tuple(index['keyframes'][before - 1][:2]) if before > 0 else None
+  keyframe_after = tuple(index['keyframes'][after][:2]) if after < len(keyframe_times) else None
+  return keyframe_before, keyframe_after
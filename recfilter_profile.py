@@ -0,0 +1,88 @@
+# Run profile of RecFilter3
+# Records wall time, CPU time of the process, CPU time of finished child processes (ffmpeg, NudeNet workers)
+# and item counts per stage. Stages can be nested, their self time excludes the nested stages.
+# Generators are timed only while they produce an item, so a decoder feeding the analysis and the analysis
+# itself end up in different stages even though they run interleaved.
+import json
+import os
+import time
+
+def snapshot():
+  times = os.times()
+  return (time.perf_counter(), time.process_time(), times.children_user + times.children_system)
+
+class RunProfile:
+  def __init__(self):
+    self.started = time.time()
+    self.start = snapshot()
+    self.stages = {}
+    #[name, snapshot at entry, snapshot since the stage runs itself again]
+    self.active = []
+
+  def record(self, name):
+    if name not in self.stages:
+      self.stages[name] = {'calls': 0, 'items': 0, 'wall_seconds': 0.0, 'self_wall_seconds': 0.0, 'cpu_seconds': 0.0, 'child_cpu_seconds': 0.0}
+    return self.stages[name]
+
+  def enter(self, name, call=True):
+    now = snapshot()
+    if self.active:
+      parent = self.active[-1]
+      self.record(parent[0])['self_wall_seconds'] += now[0] - parent[2][0]
+    if call: self.record(name)['calls'] += 1
+    self.active.append([name, now, now])
+
+  def exit(self):
+    now = snapshot()
+    name, entered, resumed = self.active.pop()
+    stage = self.record(name)
+    stage['wall_seconds'] += now[0] - entered[0]
+    stage['cpu_seconds'] += now[1] - entered[1]
+    stage['child_cpu_seconds'] += now[2] - entered[2]
+    stage['self_wall_seconds'] += now[0] - resumed[0]
+    if self.active: self.active[-1][2] = now
+
+  def count(self, name, items=1):
+    self.record(name)['items'] += items
+
+  #with run_profile.stage('ffprobe'): ...
+  def stage(self, name):
+    profile = self
+    class Stage:
+      def __enter__(self):
+        profile.enter(name)
+      def __exit__(self, *exc_info):
+        profile.exit()
+    return Stage()
+
+  #Yields the items of iterable, the time it takes to produce each of them is added to the stage
+  def timed(self, name, iterable):
+    self.record(name)['calls'] += 1
+    iterator = iter(iterable)
+    while True:
+      self.enter(name, False)
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        self.exit()
+      self.count(name)
+      yield item
+
+  #Stages that are still running when the program ends, eg. after sys.exit(), are closed first
+  def report(self, details=None):
+    while self.active: self.exit()
+    now = snapshot()
+    profile = {
+      'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+      'wall_seconds': round(now[0] - self.start[0], 4),
+      'cpu_seconds': round(now[1] - self.start[1], 4),
+      'child_cpu_seconds': round(now[2] - self.start[2], 4)}
+    if details: profile.update(details)
+    profile['stages'] = [dict({'name': name}, **{key: round(value, 4) if isinstance(value, float) else value for key, value in stage.items()}) for name, stage in self.stages.items()]
+    return profile
+
+  def write(self, path, details=None):
+    with open(path, 'w') as profile_file:
+      json.dump(self.report(details), profile_file, indent=1)
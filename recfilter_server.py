@@ -0,0 +1,203 @@
+# Shared NudeNet inference server of RecFilter3
+# One process holds the model, every RecFilter3 run sends its samples to it instead of loading its own session.
+# Frames are passed in shared memory, only their names and shapes go over the socket. Samples of all clients
+# with the same size are put into common batches. When too many samples are waiting, clients are slowed down.
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import numpy as np
+from pathlib import Path
+from recfilter_detector import detect_modes, load_detector, analyse_batch, chunks, preprocess_native
+from nudenet.detector_utils import preprocess_image
+try:
+  from multiprocessing import shared_memory
+except ImportError: #Python < 3.8
+  shared_memory = None
+
+#Unix domain socket where available, a port on localhost otherwise (Windows)
+server_socket_path = Path.home() / '.RecFilter3' / 'inference.sock'
+server_port = 47361
+def server_address():
+  if hasattr(socket, 'AF_UNIX'): return str(server_socket_path)
+  return ('127.0.0.1', server_port)
+
+#Messages are json, prefixed with their length
+def send_message(connection, message):
+  data = json.dumps(message).encode()
+  connection.sendall(struct.pack('!I', len(data)) + data)
+
+def receive_exactly(connection, size):
+  data = b''
+  while len(data) < size:
+    chunk = connection.recv(size - len(data))
+    if not chunk: return None
+    data += chunk
+  return data
+
+def receive_message(connection):
+  header = receive_exactly(connection, 4)
+  if header is None: return None
+  data = receive_exactly(connection, struct.unpack('!I', header)[0])
+  if data is None: return None
+  return json.loads(data)
+
+#Connection to a running server or None
+def connect_server():
+  if shared_memory is None: return None
+  address = server_address()
+  try:
+    if isinstance(address, str): connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else: connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connection.connect(address)
+  except OSError:
+    return None
+  return connection
+
+def server_available():
+  connection = connect_server()
+  if connection is None: return False
+  connection.close()
+  return True
+
+#Same as detect_batched(), but the analysis is done by the server. batch_size samples are sent at once.
+def detect_served(connection, items, batch_size=1, mode='default', native_side=None):
+  try:
+    for chunk in chunks(items, batch_size):
+      frames = [image for key, image in chunk if isinstance(image, np.ndarray)]
+      frame_memory = None
+      if frames: frame_memory = shared_memory.SharedMemory(create=True, size=sum(frame.nbytes for frame in frames))
+      try:
+        images = []
+        offset = 0
+        for key, image in chunk:
+          if isinstance(image, np.ndarray):
+            frame_view = np.ndarray(image.shape, dtype=np.uint8, buffer=frame_memory.buf, offset=offset)
+            frame_view[:] = image
+            del frame_view
+            images.append({'memory': frame_memory.name, 'offset': offset, 'shape': list(image.shape)})
+            offset += image.nbytes
+          else: images.append({'path': os.path.abspath(str(image))})
+        send_message(connection, {'mode': mode, 'native_side': native_side, 'images': images})
+        reply = receive_message(connection)
+      finally:
+        if frame_memory is not None:
+          frame_memory.close()
+          frame_memory.unlink()
+      if reply is None: sys.exit('\nERROR:  The inference server closed the connection')
+      if 'error' in reply: sys.exit('\nERROR:  The inference server failed: ' + reply['error'])
+      yield from zip([key for key, image in chunk], reply['detections'])
+  finally:
+    connection.close()
+
+class PendingSample:
+  def __init__(self, image, scale, mode):
+    self.image = image
+    self.scale = scale
+    self.mode = mode
+    self.done = threading.Event()
+    self.detections = None
+    self.error = None
+
+  def finish(self, detections, error=None):
+    self.detections = detections
+    self.error = error
+    self.done.set()
+
+#Forms batches of up to batch_size samples of the same mode and size, from whichever clients sent them
+#A batch is started once it is full or max_wait seconds after its first sample arrived
+def run_batches(detector, pending, batch_size, max_wait):
+  deferred = []
+  while True:
+    if deferred: batch = [deferred.pop(0)]
+    else: batch = [pending.get()]
+    def fits(sample):
+      return sample.mode == batch[0].mode and sample.image.shape == batch[0].image.shape
+    for sample in [sample for sample in deferred if fits(sample)][:batch_size - 1]:
+      deferred.remove(sample)
+      batch.append(sample)
+    deadline = time.monotonic() + max_wait
+    while len(batch) < batch_size:
+      try: sample = pending.get(timeout=max(0, deadline - time.monotonic()))
+      except queue.Empty: break
+      if fits(sample): batch.append(sample)
+      else: deferred.append(sample)
+    try:
+      results = analyse_batch(detector, [(i, sample.image, sample.scale) for i, sample in enumerate(batch)], detect_modes[batch[0].mode][2])
+      for i, detections in results: batch[i].finish(detections)
+    except Exception as batch_error:
+      for sample in batch: sample.finish(None, repr(batch_error))
+
+def attach_memory(name):
+  frame_memory = shared_memory.SharedMemory(name=name)
+  #The client owns the memory, the server's resource tracker must not remove it
+  if os.name == 'posix':
+    from multiprocessing import resource_tracker
+    resource_tracker.unregister(frame_memory._name, 'shared_memory')
+  return frame_memory
+
+def make_handler(pending):
+  class InferenceHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+      while True:
+        request = receive_message(self.request)
+        if request is None: break
+        try:
+          min_side, max_side, min_prob = detect_modes[request['mode']]
+          samples = []
+          for entry in request['images']:
+            if 'path' in entry:
+              image, scale = preprocess_image(entry['path'], min_side=min_side, max_side=max_side)
+            else:
+              frame_memory = attach_memory(entry['memory'])
+              frame = np.ndarray(entry['shape'], dtype=np.uint8, buffer=frame_memory.buf, offset=entry['offset'])
+              if request.get('native_side'): image, scale = preprocess_native(frame, request['native_side'])
+              else: image, scale = preprocess_image(frame, min_side=min_side, max_side=max_side)
+              del frame
+              frame_memory.close()
+            sample = PendingSample(image, scale, request['mode'])
+            #blocks while the queue is full, which holds back the client until the model catches up
+            pending.put(sample)
+            samples.append(sample)
+          for sample in samples: sample.done.wait()
+          errors = [sample.error for sample in samples if sample.error]
+          if errors: send_message(self.request, {'error': errors[0]})
+          else: send_message(self.request, {'detections': [sample.detections for sample in samples]})
+        except Exception as request_error:
+          send_message(self.request, {'error': repr(request_error)})
+  return InferenceHandler
+
+def run_server(batch_size=8, max_wait=0.01, max_pending=None):
+  if shared_memory is None: sys.exit('\nERROR:  The inference server needs Python 3.8 or later')
+  detector = load_detector()
+  pending = queue.Queue(maxsize=max_pending or 4 * batch_size)
+  threading.Thread(target=run_batches, args=(detector, pending, batch_size, max_wait), daemon=True).start()
+  address = server_address()
+  if isinstance(address, str):
+    Path(address).parent.mkdir(parents=True, exist_ok=True)
+    #a socket file left behind by a server that didn't stop cleanly
+    if Path(address).exists(): os.remove(address)
+    server = socketserver.ThreadingUnixStreamServer(address, make_handler(pending), bind_and_activate=False)
+    #the socket is created with permissions for the user only, there is no moment another user could connect
+    old_umask = os.umask(0o177)
+    try: server.server_bind()
+    finally: os.umask(old_umask)
+    os.chmod(address, 0o600)
+    server.server_activate()
+  else:
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(address, make_handler(pending))
+  server.daemon_threads = True
+  print(time.strftime("%H:%M:%S", time.localtime()) + ' INFO:  Inference server is listening on ' + str(address) + ' with a batch size of ' + str(batch_size))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    if isinstance(address, str) and Path(address).exists(): os.remove(address)
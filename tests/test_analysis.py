@@ -0,0 +1,48 @@
+# Tests of the columnar analysis format of RecFilter3
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from recfilter_analysis import write_analysis, load_analysis, sample_labels
+
+samples = [
+  ('0.000', '0000001.jpg', [{'label': 'FACE_F', 'score': 0.9, 'box': [1, 2, 3, 4]}, {'label': 'EXPOSED_BELLY', 'score': 0.65, 'box': [5, 6, 7, 8]}]),
+  ('5.000', '0000002.jpg', []),
+  ('10.000', '0000003.jpg', [{'label': 'EXPOSED_BELLY', 'score': 0.7, 'box': [0, 0, 10, 10]}]),
+  ('12.500', '0000004.jpg', [{'label': 'EXPOSED_BELLY', 'score': 0.7, 'box': [0, 0, 10, 10]}])]
+
+class AnalysisTest(unittest.TestCase):
+  def setUp(self):
+    self.folder = Path(tempfile.mkdtemp())
+    self.path = str(self.folder / 'analysis.npz')
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def test_round_trip(self):
+    write_analysis(self.path, samples, {'0000004.jpg': '0000003.jpg'})
+    analysis = load_analysis(self.path)
+    self.assertIsInstance(analysis['score'], np.memmap)
+    self.assertEqual(analysis['timestamps'].tolist(), [0, 5, 10, 12.5])
+    self.assertEqual(analysis['names'].tolist(), [name for timestamp, name, detections in samples])
+    self.assertEqual(analysis['classes'].tolist(), ['EXPOSED_BELLY', 'FACE_F'])
+    self.assertEqual(analysis['sample'].tolist(), [0, 0, 2, 3])
+    self.assertEqual(analysis['box'].tolist(), [[1, 2, 3, 4], [5, 6, 7, 8], [0, 0, 10, 10], [0, 0, 10, 10]])
+    np.testing.assert_allclose(analysis['score'], [0.9, 0.65, 0.7, 0.7], rtol=1e-6)
+    self.assertEqual(analysis['reused'].tolist(), [-1, -1, -1, 2])
+    self.assertEqual([sample_labels(analysis, index) for index in range(len(samples))], [['EXPOSED_BELLY', 'FACE_F'], [], ['EXPOSED_BELLY'], ['EXPOSED_BELLY']])
+
+  def test_no_detections(self):
+    write_analysis(self.path, [('0.000', '0000001.jpg', []), ('5.000', '0000002.jpg', [])])
+    analysis = load_analysis(self.path)
+    self.assertEqual(analysis['sample'].size, 0)
+    self.assertEqual(analysis['box'].shape, (0, 4))
+    self.assertEqual(analysis['reused'].tolist(), [-1, -1])
+    self.assertEqual(sample_labels(analysis, 1), [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,86 @@
+# Tests of the checkpoints of RecFilter3's analysis
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from recfilter_checkpoint import AnalysisJournal, checked_line, read_checked_line, write_marker, marker_matches
+
+samples = [['0.000', '0000001.jpg', []], ['5.000', '0000002.jpg', [{'label': 'FACE_F', 'score': 0.9, 'box': [1, 2, 3, 4]}]], ['10.000', '0000003.jpg', [], '0000002.jpg']]
+
+class CheckedLineTest(unittest.TestCase):
+  def test_lines(self):
+    line = checked_line({'key': 'abc'})
+    cases = [
+      ('complete', line, {'key': 'abc'}),
+      ('torn', line[:-5], None),
+      ('without newline', line[:-1], None),
+      ('damaged', line.replace('abc', 'abd'), None),
+      ('checksum of something else', line[:8] + ' [1]\n', None),
+      ('empty', '', None)]
+    for name, text, entry in cases:
+      with self.subTest(name): self.assertEqual(read_checked_line(text), entry)
+
+class AnalysisJournalTest(unittest.TestCase):
+  def setUp(self):
+    self.folder = Path(tempfile.mkdtemp())
+    self.path = str(self.folder / 'analysis_journal.txt')
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def write_journal(self, key='key'):
+    journal = AnalysisJournal(self.path, key, sync_every=2)
+    journal.start(samples[:1])
+    for sample in samples[1:]: journal.append(sample)
+    journal.close()
+
+  def test_round_trip(self):
+    self.write_journal()
+    self.assertEqual(AnalysisJournal(self.path, 'key').load(), samples)
+
+  def test_other_key(self):
+    self.write_journal()
+    self.assertEqual(AnalysisJournal(self.path, 'other key').load(), [])
+
+  def test_missing(self):
+    self.assertEqual(AnalysisJournal(self.path, 'key').load(), [])
+
+  #reading stops at a line a crash tore apart, the samples in front of it are kept
+  def test_torn_last_line(self):
+    self.write_journal()
+    with open(self.path, 'rb+') as journal_file: journal_file.truncate(os.path.getsize(self.path) - 7)
+    self.assertEqual(AnalysisJournal(self.path, 'key').load(), samples[:2])
+
+  def test_damaged_line(self):
+    self.write_journal()
+    with open(self.path, 'r') as journal_file: lines = journal_file.readlines()
+    lines[2] = lines[2].replace('FACE_F', 'FACE_M')
+    with open(self.path, 'w') as journal_file: journal_file.writelines(lines)
+    self.assertEqual(AnalysisJournal(self.path, 'key').load(), samples[:1])
+
+  def test_start_replaces_and_remove(self):
+    self.write_journal()
+    journal = AnalysisJournal(self.path, 'key')
+    journal.start(samples[:2])
+    journal.close()
+    self.assertEqual(AnalysisJournal(self.path, 'key').load(), samples[:2])
+    journal.remove()
+    self.assertFalse(os.path.exists(self.path))
+
+class MarkerTest(unittest.TestCase):
+  def test_marker(self):
+    folder = Path(tempfile.mkdtemp())
+    try:
+      path = folder / 'complete'
+      self.assertFalse(marker_matches(path, 'key'))
+      write_marker(path, 'key')
+      self.assertTrue(marker_matches(path, 'key'))
+      self.assertFalse(marker_matches(path, 'other key'))
+    finally: shutil.rmtree(folder)
+
+if __name__ == '__main__':
+  unittest.main()
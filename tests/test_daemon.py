@@ -0,0 +1,23 @@
+# Tests of the job states of RecFilter3's worker processes, shared by the daemon, batches and fan-outs
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from recfilter_daemon import exit_state
+
+class ExitStateTest(unittest.TestCase):
+  def test_exit_codes(self):
+    cases = [
+      (None, ('done', '')),
+      (0, ('done', '')),
+      (1, ('failed', '1')),
+      ('12:00:00 INFO:  Step 4 of 6: No segments found. Nothing to cut... :(', ('done', '12:00:00 INFO:  Step 4 of 6: No segments found. Nothing to cut... :(')),
+      ('\nERROR:  ffmpeg failed while streaming sample frames', ('failed', '\nERROR:  ffmpeg failed while streaming sample frames')),
+      ('confirm_overwrite = False', ('failed', 'confirm_overwrite = False')),
+      ('Creation of the temporary directory failed', ('failed', 'Creation of the temporary directory failed'))]
+    for code, expected in cases:
+      with self.subTest(code=code): self.assertEqual(exit_state(code), expected)
+
+if __name__ == '__main__':
+  unittest.main()
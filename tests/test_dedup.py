@@ -0,0 +1,64 @@
+# Tests of the deduplication of near-identical samples
+import sys
+import unittest
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from recfilter_dedup import frame_hash, hash_distance, deduplicated
+
+#A BGR frame whose brightness rises from left to right, flipped it falls
+def gradient_frame(flip=False, noise=0):
+  row = np.linspace(0, 255, 180)
+  if flip: row = row[::-1]
+  frame = np.repeat(np.tile(row, (120, 1))[:, :, None], 3, axis=2)
+  if noise: frame = frame + np.random.default_rng(noise).uniform(-2, 2, frame.shape)
+  return np.clip(frame, 0, 255).astype(np.uint8)
+
+#Stands in for NudeNet, the detections name the analysed sample
+def detect(items):
+  for key, sample in items:
+    detect.analysed.append(key)
+    yield key, [{'label': 'FACE_F', 'score': 0.9, 'box': [0, 0, 1, 1], 'sample': key}]
+
+def run(frames, max_distance, max_reuse):
+  detect.analysed = []
+  return [(key, detections[0]['sample'], reused) for key, detections, reused in deduplicated(list(enumerate(frames)), detect, max_distance, max_reuse)]
+
+class HashTest(unittest.TestCase):
+  def test_distance(self):
+    cases = [
+      ('same frame', gradient_frame(), gradient_frame(), 0, 0),
+      ('slight noise', gradient_frame(), gradient_frame(noise=1), 0, 4),
+      ('flipped', gradient_frame(), gradient_frame(flip=True), 60, 64)]
+    for name, first, second, low, high in cases:
+      with self.subTest(name):
+        distance = hash_distance(frame_hash(first), frame_hash(second))
+        self.assertGreaterEqual(distance, low)
+        self.assertLessEqual(distance, high)
+
+  def test_hash_distance(self):
+    self.assertEqual(hash_distance(0b1011, 0b0010), 2)
+    self.assertEqual(hash_distance(2 ** 64 - 1, 0), 64)
+
+class DeduplicatedTest(unittest.TestCase):
+  def test_reuse(self):
+    frames = [gradient_frame(), gradient_frame(noise=1), gradient_frame(flip=True), gradient_frame(flip=True, noise=2)]
+    self.assertEqual(run(frames, 4, 10), [(0, 0, None), (1, 0, 0), (2, 2, None), (3, 2, 2)])
+    self.assertEqual(detect.analysed, [0, 2])
+
+  def test_off(self):
+    frames = [gradient_frame()] * 3
+    self.assertEqual(run(frames, -1, 10), [(0, 0, None), (1, 1, None), (2, 2, None)])
+
+  #after dedup_max reused samples in a row the next one is analysed again, even if it looks the same
+  def test_dedup_max(self):
+    frames = [gradient_frame()] * 7
+    self.assertEqual(run(frames, 4, 2), [(0, 0, None), (1, 0, 0), (2, 0, 0), (3, 3, None), (4, 3, 3), (5, 3, 3), (6, 6, None)])
+    self.assertEqual(detect.analysed, [0, 3, 6])
+
+  def test_no_reuse_allowed(self):
+    self.assertEqual(run([gradient_frame()] * 3, 4, 0), [(0, 0, None), (1, 1, None), (2, 2, None)])
+
+if __name__ == '__main__':
+  unittest.main()
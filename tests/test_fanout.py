@@ -0,0 +1,84 @@
+# Tests of the fan-out of RecFilter3
+# A short synthetic recording is analysed once with the stub detector of recfilter_benchmark and cut for a preset and a
+# settings code, with a config that leaves the confirm_* keys out, as most configs do.
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import recfilter_benchmark
+
+fanout_config = '''default:
+  gap: 10
+  duration: 5
+  extension: 2
+  include: EXPOSED_BELLY
+  exclude: ''
+  filesuffix: _test
+  videoext: mkv
+loose:
+  gap: 20
+  filesuffix: _loose
+'''
+
+def modules_available():
+  try:
+    import nudenet
+    import onnxruntime
+  except ImportError: return False
+  return True
+
+class SettingsCodeTest(unittest.TestCase):
+  def test_min_score(self):
+    from recfilter_fanout import is_settings_code, settings_code_args
+    self.assertTrue(is_settings_code('v1m850i5g30w04v1'))
+    self.assertEqual(settings_code_args('v1m850i5g30w04v1', {'04': 'EXPOSED_BELLY'}), ['-m', '0.85', '-i', '5', '-g', '30', '-w', 'EXPOSED_BELLY'])
+
+  def test_fanout_args(self):
+    from recfilter_fanout import fanout_args, preset_options
+    argv = ['rec.mp4', '-p', 'freddo', '-n', '--fanout', 'strict', 'v1i5w04v1', '-c=site', '-k']
+    self.assertEqual(fanout_args(argv, 'rec.mp4'), ['-p', 'freddo', '-n', '-c=site', '-k'])
+    self.assertEqual(fanout_args(argv, 'rec.mp4', preset_options), ['-n', '-k'])
+    self.assertEqual(fanout_args(['rec.mp4', '-pfreddo', '--preset=freddo', '-n'], 'rec.mp4', preset_options), ['-n'])
+
+@unittest.skipUnless(shutil.which('ffmpeg') and shutil.which('ffprobe'), 'ffmpeg is not installed')
+@unittest.skipUnless(modules_available(), 'NudeNet is not installed')
+class FanoutTest(unittest.TestCase):
+  def setUp(self):
+    self.folder = Path(tempfile.mkdtemp())
+    self.video_path = recfilter_benchmark.synthetic_video(self.folder, 60, '320x240', 10, 20, 15)
+    self.script_path = recfilter_benchmark.prepare_script(self.folder)
+    with open(self.script_path.parent / 'RecFilter3.config', 'w') as config_file: config_file.write(fanout_config)
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def run_recfilter(self, *args):
+    cmd = [sys.executable, str(self.script_path.parent / 'recfilter_benchmark.py'), 'stub', '0', str(self.script_path), str(self.video_path), '-q', '--nocache'] + list(args)
+    #a home of its own keeps the installation's cache and inference server out of the test
+    env = dict(os.environ, HOME=str(self.folder), USERPROFILE=str(self.folder))
+    return subprocess.run(cmd, cwd=self.folder, env=env, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+
+  def test_fanout_without_confirm_overwrite(self):
+    result = self.run_recfilter('-i', '5', '--fanout', 'loose', 'v1i5g30e2d5w04v1')
+    self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+    self.assertNotIn('failed', result.stdout)
+    stem = self.video_path.stem
+    for suffix in ('_test', '_test_loose', '_test_v1i5g30e2d5w04v1'):
+      self.assertTrue((self.folder / (stem + suffix + '.mkv')).exists(), suffix + ' is missing:\n' + result.stdout)
+    self.assertFalse((self.folder / ('~' + stem)).exists())
+
+  def test_fanout_keep(self):
+    result = self.run_recfilter('-i', '5', '-a', '12', '-b', '20', '-k', '--fanout', 'loose', 'v1i5g30e2d5w04v1')
+    self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+    temp_dir = self.folder / ('~' + self.video_path.stem)
+    #each plan cuts into its own folder instead of the segments folder of the run
+    for segments in ('segments_plan_test_loose', 'segments_plan_test_v1i5g30e2d5w04v1'):
+      self.assertTrue((temp_dir / segments).is_dir(), segments + ' is missing:\n' + result.stdout)
+
+if __name__ == '__main__':
+  unittest.main()
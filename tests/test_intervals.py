@@ -0,0 +1,68 @@
+# Tests of the interval engine of RecFilter3's cut planning
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from recfilter_intervals import plan_segments, complement_segments, snap_segments
+
+def as_lists(segments):
+  return [list(map(float, part)) for part in segments]
+
+class PlanSegmentsTest(unittest.TestCase):
+  #(name, timestamps, extension, gap, min_duration, duration, reaches, starts, ends)
+  cases = [
+    ('no matches', [], 3, 30, 10, 100, None, [], []),
+    ('single match', [50], 3, 30, 0, 100, None, [47], [53]),
+    ('gap merges', [10, 40], 3, 30, 0, 100, None, [7], [43]),
+    ('gap splits', [10, 50], 3, 30, 0, 100, None, [7, 47], [13, 53]),
+    ('space equal to gap merges', [10, 46], 3, 30, 0, 100, None, [7], [49]),
+    ('unsorted timestamps', [50, 10], 3, 30, 0, 100, None, [7, 47], [13, 53]),
+    ('extension clipped at 0', [1], 3, 30, 0, 100, None, [0], [4]),
+    ('extension clipped at duration', [99], 3, 30, 0, 100, None, [96], [100]),
+    ('both ends clipped', [0, 100], 5, 200, 0, 100, None, [0], [100]),
+    ('min_duration drops short segments', [10, 60, 65], 2, 10, 6, 100, None, [58], [67]),
+    ('min_duration keeps equal length', [10], 3, 30, 6, 100, None, [7], [13]),
+    ('zero length is dropped', [100], 0, 30, 0, 100, None, [], []),
+    ('reaches widen the end', [10, 50], 3, 20, 0, 100, [20, 55], [7, 47], [23, 58]),
+    ('reaches close the gap', [10, 50], 3, 30, 0, 100, [30, 55], [7], [58]),
+    ('reaches before the timestamp are ignored', [10], 3, 30, 0, 100, [5], [7], [13]),
+    ('reaches never shrink', [10, 20], 3, 0, 0, 100, [40, 21], [7], [43])]
+
+  def test_cases(self):
+    for name, timestamps, extension, gap, min_duration, duration, reaches, starts, ends in self.cases:
+      with self.subTest(name):
+        self.assertEqual(as_lists(plan_segments(timestamps, extension, gap, min_duration, duration, reaches)), [starts, ends])
+
+class ComplementSegmentsTest(unittest.TestCase):
+  cases = [
+    ('nothing kept', [], [], 100, [0], [100]),
+    ('everything kept', [0], [100], 100, [], []),
+    ('middle kept', [20], [40], 100, [0, 40], [20, 100]),
+    ('two kept', [0, 50], [10, 100], 100, [10], [50])]
+
+  def test_cases(self):
+    for name, starts, ends, duration, gap_starts, gap_ends in self.cases:
+      with self.subTest(name):
+        self.assertEqual(as_lists(complement_segments(starts, ends, duration)), [gap_starts, gap_ends])
+
+class SnapSegmentsTest(unittest.TestCase):
+  keyframes = [0, 2, 4, 6, 8, 10, 12]
+  cases = [
+    ('no keyframes', [3.5], [7.5], [], 0, 20, [3.5], [7.5]),
+    ('no segments', [], [], keyframes, 0, 20, [], []),
+    ('moved outwards', [3], [7], keyframes, 0, 20, [2], [8]),
+    ('on keyframes', [4], [8], keyframes, 0, 20, [4], [8]),
+    ('end behind the last keyframe', [11], [13], keyframes, 0, 20, [10], [20]),
+    ('start in front of the first keyframe', [0.5], [1], [1, 5], 0, 20, [0], [1]),
+    ('overlap after snapping merges', [1, 5.5], [5, 9], keyframes, 0, 20, [0], [10]),
+    ('closer than gap after snapping merges', [1, 9], [3, 11], keyframes, 4, 20, [0], [12]),
+    ('far enough apart stays split', [1, 9], [3, 11], keyframes, 1, 20, [0, 8], [4, 12])]
+
+  def test_cases(self):
+    for name, starts, ends, keyframes, gap, duration, snapped_starts, snapped_ends in self.cases:
+      with self.subTest(name):
+        self.assertEqual(as_lists(snap_segments(starts, ends, keyframes, gap, duration)), [snapped_starts, snapped_ends])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,75 @@
+# Tests of resuming an interrupted analysis of RecFilter3
+# A run with the stub detector of recfilter_benchmark is killed in step 2, the next quiet run has to pick up its journal
+# instead of refusing to overwrite the temporary folder, with a config that leaves confirm_overwrite out.
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import recfilter_benchmark
+
+resume_config = '''default:
+  gap: 10
+  duration: 5
+  extension: 2
+  include: EXPOSED_BELLY
+  exclude: ''
+  filesuffix: _test
+  videoext: mkv
+'''
+
+def modules_available():
+  try:
+    import nudenet
+    import onnxruntime
+  except ImportError: return False
+  return True
+
+def journal_lines(journal_path):
+  try:
+    with open(journal_path, 'r') as journal_file: return sum(1 for line in journal_file if line.endswith('\n'))
+  except OSError: return 0
+
+@unittest.skipUnless(shutil.which('ffmpeg') and shutil.which('ffprobe'), 'ffmpeg is not installed')
+@unittest.skipUnless(modules_available(), 'NudeNet is not installed')
+@unittest.skipUnless(hasattr(signal, 'SIGKILL'), 'the run can\'t be killed')
+class ResumeTest(unittest.TestCase):
+  def setUp(self):
+    self.folder = Path(tempfile.mkdtemp())
+    self.video_path = recfilter_benchmark.synthetic_video(self.folder, 60, '320x240', 10, 20, 15)
+    self.script_path = recfilter_benchmark.prepare_script(self.folder)
+    with open(self.script_path.parent / 'RecFilter3.config', 'w') as config_file: config_file.write(resume_config)
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def recfilter_cmd(self, delay, *args):
+    return [sys.executable, str(self.script_path.parent / 'recfilter_benchmark.py'), 'stub', str(delay), str(self.script_path), str(self.video_path), '-q', '--nocache', '-i', '2'] + list(args)
+
+  def test_resume_quiet(self):
+    #a home of its own keeps the installation's cache and inference server out of the test
+    env = dict(os.environ, HOME=str(self.folder), USERPROFILE=str(self.folder))
+    journal_path = self.folder / ('~' + self.video_path.stem) / 'analysis_journal.txt'
+    process = subprocess.Popen(self.recfilter_cmd(0.2), cwd=self.folder, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    #the header and a few samples
+    deadline = time.time() + 60
+    while (journal_lines(journal_path) < 5) and (process.poll() is None) and (time.time() < deadline): time.sleep(0.05)
+    process.send_signal(signal.SIGKILL)
+    process.wait()
+    analysed = journal_lines(journal_path) - 1
+    self.assertGreater(analysed, 0)
+    result = subprocess.run(self.recfilter_cmd(0), cwd=self.folder, env=env, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+    self.assertIn('Resuming the unfinished analysis', result.stdout)
+    self.assertIn('Resuming the interrupted analysis after', result.stdout)
+    self.assertTrue((self.folder / (self.video_path.stem + '_test.mkv')).exists(), result.stdout)
+    self.assertFalse((self.folder / ('~' + self.video_path.stem)).exists())
+
+if __name__ == '__main__':
+  unittest.main()